@@ -42,7 +42,7 @@
 #       - Code: utils.encrypt_value() / utils.decrypt_value()
 #    
 #    b) Irreversible Data Anonymization (Hashing):
-#       - SHA-256 hashing for patient names → ANON_<hash>
+#       - Keyed HMAC-SHA256 of patient names → ANON_<hash>
 #       - Contact masking: last 4 digits visible → XXX-XXX-4592
 #       - One-way function: cannot reverse to original data
 #       - Code: utils.anonymize_name() / utils.mask_contact()
@@ -145,10 +145,10 @@
 #       - In production: Add Prometheus metrics, Grafana dashboards
 #    
 #    e) Connection Resilience:
-#       - Database connection created fresh for each operation
-#       - check_same_thread=False allows concurrent access
-#       - Connection automatically closed after each operation
-#       - Code: db.py @contextmanager def get_conn()
+#       - Long-lived connections reused from a thread-aware pool
+#       - Separate read-only and read-write pools, capped at POOL_MAX_SIZE
+#       - Idle connections health-checked before reuse; failed ones replaced
+#       - Code: db.py ConnectionPool / @contextmanager def get_conn()
 #
 #    Uptime Display:
 #    - Timestamp recorded at app start
@@ -255,19 +255,24 @@
 #    
 #    Code: utils.py lines 19-29
 #
-# 2. SHA-256 Hashing (Irreversible)
-#    ===============================
-#    Algorithm: SHA-256 cryptographic hash
-#    Salt: Patient name (salted hash for demonstration)
-#    Output: "ANON_" + first 8 chars of hex digest
+# 2. Keyed Pseudonyms (Irreversible)
+#    ================================
+#    Algorithm: HMAC-SHA256 under a secret key (pseudonym.key)
+#    Output: "ANON_" + first PSEUDONYM_LENGTH (default 16) hex chars
 #    
 #    Example:
 #    anonymize_name("John Doe")
-#    → SHA256("John Doe") = 4ff0e5ad0b...
-#    → "ANON_4ff0e5ad"
+#    → HMAC(key, "John Doe") = 9c1e47a2d03b5f81...
+#    → "ANON_9c1e47a2d03b5f81"
+#    
+#    Without the key, names cannot be guessed and hashed (no
+#    rainbow tables). Pseudonyms are deterministic, so they are
+#    searchable through idx_patients_pseudonym; the full HMAC is
+#    kept in name_digest to detect truncation collisions.
 #    
-#    Limitation: Not suitable for sensitive applications
-#    (rainbow tables possible). Use bcrypt for passwords.
+#    Encrypted names and contacts are searched through blind
+#    indexes instead: HMACs (blind_index.key) of the normalised
+#    name, phone digits and name-word prefixes, looked up by index.
 #    
 #    Code: utils.py lines 38-42
 #
@@ -694,15 +699,21 @@
 # - Page load: ~500ms (Streamlit overhead)
 # - Data display (10 records): ~200ms
 #
+# Measured (python benchmark.py suite, 100k patients; benchmark_baseline.json):
+# - Patient page fetch: ~0.3ms p50; role-masked table rows (50 per page): ~0.5-2ms p50
+# - Activity aggregation: ~14ms p50; Backup export: ~55k rows/s
+# - Anonymize All ~26k rows/s, Encrypt All ~14k rows/s (background jobs)
+# Live per-rerun breakdown (DB / crypto / UI): admin Diagnostics tab, perf_log.jsonl
+#
 # Bottlenecks & Solutions:
 # =======================
 # 1. Streamlit re-runs entire script on interaction
-#    Solution: Use @st.cache_data decorator (already used for uptime)
-#    Future: Migrate to Streamlit 1.26+ with better performance
+#    Solution: data_cache.py wraps the db reads in @st.cache_data, keyed by role,
+#    query arguments and per-table versions bumped once by every write transaction
 #
 # 2. Encryption/Decryption loops over all patients
 #    Solution: Batch encrypt only changed records
-#    Future: Background job for encryption (Celery + Redis)
+#    Background: jobs.py runs them off the request path with resumable checkpoints
 #
 # 3. SQLite concurrency limitations
 #    Solution: Use PostgreSQL with connection pooling (pgbouncer)
@@ -0,0 +1,243 @@
+# audit.py
+"""
+Buffered audit-log writer.
+
+db.add_log hands finished log rows to an AuditWriter instead of opening a
+transaction per entry. A single background thread drains the queue in FIFO
+order and writes batches with executemany, so entries land in the order they
+were logged. AUDIT_MODE picks the durability guarantee:
+
+    sync   write in the caller's thread, one transaction per entry (old behaviour)
+    ack    caller blocks until its entry is committed; concurrent callers share a commit
+    async  caller returns immediately; batches flush every FLUSH_INTERVAL seconds or
+           FLUSH_BATCH_SIZE entries, on flush() (logout) and at interpreter exit
+
+Entries are never dropped silently. A batch that still fails after retries
+is appended to FALLBACK_FILE and reported through logging.error. A producer
+that finds the queue full waits up to ENQUEUE_TIMEOUT, then spills its entry
+to FALLBACK_FILE itself. After the next successful write, spilled entries are
+replayed into the database in batches. Each batch is removed from the file
+once it commits. The writer thread survives any error. If it cannot even
+spill a batch, those entries are logged as lost and their ack callers get
+AuditWriteError. Ack callers wait at most ACK_TIMEOUT. flush() logs a
+warning and returns False when it times out.
+"""
+import atexit
+import concurrent.futures
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+AUDIT_MODE = os.environ.get("AUDIT_MODE", "async")
+FLUSH_BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.5       # seconds an async entry may wait before being written
+MAX_QUEUE = 10000          # producers block (never drop) when this many entries are pending
+WRITE_RETRIES = 3
+ENQUEUE_TIMEOUT = 5.0      # seconds a producer waits on a full queue before spilling its entry
+ACK_TIMEOUT = 10.0         # seconds an ack caller waits for its commit
+FALLBACK_FILE = "audit_fallback.jsonl"
+
+_FLUSH = object()  # queue marker: write everything queued before it, then signal
+
+class AuditWriteError(RuntimeError):
+    """An acknowledged audit entry was not confirmed as written."""
+
+class AuditWriter:
+    def __init__(self, write_batch, mode=None, batch_size=FLUSH_BATCH_SIZE, interval=FLUSH_INTERVAL, max_queue=MAX_QUEUE):
+        self.write_batch = write_batch
+        self.mode = mode or AUDIT_MODE
+        if self.mode not in ("sync", "ack", "async"):
+            raise ValueError(f"Unknown audit mode: {self.mode}")
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._replay_due = True  # a previous process may have left spilled entries
+        self._unwritten = 0  # queued or in a batch being written; guarded by _lock
+        self.stats = {"submitted": 0, "written": 0, "batches": 0, "spilled": 0, "replayed": 0, "lost": 0}
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, n in deltas.items():
+                self.stats[name] += n
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                    self._thread.start()
+
+    def submit(self, row):
+        """Queue one log row (a tuple matching the logs INSERT)."""
+        self._count(submitted=1)
+        if self.mode == "sync":
+            self.write_batch([row])
+            self._count(written=1, batches=1)
+            self._replay_fallback()
+            return
+        self._ensure_thread()
+        done = concurrent.futures.Future() if self.mode == "ack" else None
+        self._add_unwritten(1)
+        try:
+            self._queue.put((row, done), timeout=ENQUEUE_TIMEOUT)
+        except queue.Full:
+            self._add_unwritten(-1)
+            self._spill([row], f"audit queue full for {ENQUEUE_TIMEOUT}s")
+            return
+        if done is not None:
+            try:
+                done.result(ACK_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                logging.error(f"Audit entry not committed within {ACK_TIMEOUT}s; {self.pending()} entries queued")
+                raise AuditWriteError(f"audit entry not committed within {ACK_TIMEOUT}s (still queued)") from None
+            except Exception as e:
+                raise AuditWriteError(f"audit entry could not be written: {e}") from e
+
+    def flush(self, timeout=None):
+        """Block until everything submitted so far has been written (or spilled).
+
+        Returns False, after logging why, if that did not happen within timeout.
+        """
+        if self.mode == "sync" or self._thread is None:
+            return True
+        self._ensure_thread()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        done = concurrent.futures.Future()
+        try:
+            self._queue.put((_FLUSH, done), timeout=timeout)
+            done.result(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            return True
+        except (queue.Full, concurrent.futures.TimeoutError):
+            logging.warning(f"Audit flush timed out after {timeout}s; {self.pending()} entries still queued")
+        except Exception as e:
+            logging.error(f"Audit flush failed: {e}")
+        return False
+
+    def pending(self):
+        """Entries submitted but not yet written, spilled or given up on."""
+        return self._unwritten
+
+    def _add_unwritten(self, n):
+        with self._lock:
+            self._unwritten += n
+
+    def _collect(self):
+        """Wait for the first entry, then gather a batch according to the mode."""
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(items) < self.batch_size and items[-1][0] is not _FLUSH:
+            try:
+                if self.mode == "async":
+                    items.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                else:
+                    items.append(self._queue.get_nowait())  # ack: commit whatever has piled up
+            except queue.Empty:
+                break
+        return items
+
+    def _write(self, rows):
+        delay = 0.1
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                self.write_batch(rows)
+                self._count(written=len(rows), batches=1)
+                self._replay_fallback()  # the database takes writes again
+                return
+            except Exception as e:
+                if attempt == WRITE_RETRIES:
+                    self._spill(rows, e)
+                    return
+                time.sleep(delay)
+                delay *= 2
+
+    def _spill(self, rows, error):
+        logging.error(f"Audit log write failed ({error}); {len(rows)} entries appended to {FALLBACK_FILE}")
+        with self._spill_lock, open(FALLBACK_FILE, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(list(row)) + "\n")
+        self._count(spilled=len(rows))
+        self._replay_due = True
+
+    def fallback_entries(self):
+        """Spilled entries still waiting to be replayed into the database."""
+        total = 0
+        for path in (FALLBACK_FILE, f"{FALLBACK_FILE}.replaying"):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    total += sum(1 for line in f if line.strip())
+            except FileNotFoundError:
+                pass
+        return total
+
+    def _replay_fallback(self):
+        """Write spilled entries back, oldest first; a batch leaves the file once it has committed.
+
+        FALLBACK_FILE is first renamed to <FALLBACK_FILE>.replaying, so new spills go to a fresh
+        file meanwhile. A replay cut short resumes from what is left in that file.
+        """
+        if not self._replay_due or not self._replay_lock.acquire(blocking=False):
+            return
+        replaying = f"{FALLBACK_FILE}.replaying"
+        try:
+            self._replay_due = False
+            while True:
+                if not os.path.exists(replaying):
+                    with self._spill_lock:
+                        if not os.path.exists(FALLBACK_FILE):
+                            return
+                        os.replace(FALLBACK_FILE, replaying)
+                with open(replaying, encoding="utf-8") as f:
+                    lines = [line for line in f if line.strip()]
+                while lines:
+                    batch, rest = lines[:self.batch_size], lines[self.batch_size:]
+                    rows = []
+                    for line in batch:
+                        try:
+                            rows.append(tuple(json.loads(line)))
+                        except ValueError:
+                            logging.error(f"Unreadable entry in {replaying} dropped: {line.strip()}")
+                    self.write_batch(rows)
+                    tmp = f"{replaying}.tmp"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.writelines(rest)
+                    os.replace(tmp, replaying)
+                    self._count(replayed=len(rows))
+                    lines = rest
+                os.remove(replaying)
+                logging.warning(f"Replayed spilled audit entries from {FALLBACK_FILE}")
+        except Exception as e:
+            self._replay_due = True  # try again after the next successful write
+            logging.warning(f"Audit fallback replay paused: {e}")
+        finally:
+            self._replay_lock.release()
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            rows = [row for row, _ in items if row is not _FLUSH]
+            error = None
+            try:
+                if rows:
+                    self._write(rows)
+            except Exception as e:  # the fallback file failed too; keep the thread alive for the next batch
+                error = e
+                self._count(lost=len(rows))
+                logging.exception(f"Audit writer could not persist {len(rows)} entries: {rows}")
+            self._add_unwritten(-len(rows))
+            for _, done in items:
+                if done is None:
+                    continue
+                if error is None:
+                    done.set_result(True)
+                else:
+                    done.set_exception(error)
+
+def register_shutdown_flush(writer):
+    atexit.register(writer.flush, 5.0)
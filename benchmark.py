@@ -0,0 +1,439 @@
+# benchmark.py
+"""
+Benchmarks for the dashboard's storage and crypto layers.
+
+Each benchmark builds its own throwaway database in a temp directory, so
+hospital.db is never touched. Run one with:
+
+    python benchmark.py storage --seconds 5 --readers 4 --writers 2
+    python benchmark.py crypto --sizes 10000 100000 1000000
+    python benchmark.py export --sizes 10000 100000 1000000
+    python benchmark.py anonymize --sizes 1000000
+    python benchmark.py suite --sizes 10000 100000 --out results.json
+
+suite drives the dashboard's hot paths end to end on seed_data databases and
+compares the result with benchmark_baseline.json (see bench_suite).
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import db
+import db_setup
+import export
+from crypto_engine import ParallelCrypto
+from cryptography.fernet import Fernet
+
+@contextmanager
+def temp_database(profile=None):
+    """Point db/db_setup at a fresh database in a temp dir for the duration of the block."""
+    saved = (db.DB_PATH, db_setup.DB_PATH, db.STORAGE_PROFILE)
+    tmpdir = tempfile.mkdtemp(prefix="hospital_bench_")
+    path = os.path.join(tmpdir, "bench.db")
+    db.close_pools()
+    db.DB_PATH = db_setup.DB_PATH = path
+    if profile:
+        db.STORAGE_PROFILE = profile
+    try:
+        db_setup.ensure_db()
+        yield path
+    finally:
+        db.close_pools()
+        db.DB_PATH, db_setup.DB_PATH, db.STORAGE_PROFILE = saved
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+# ---------------------------------------------------------------- storage
+
+def _run_mixed_load(seconds, readers, writers):
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    stop = time.monotonic() + seconds
+
+    def reader():
+        n = e = 0
+        while time.monotonic() < stop:
+            try:
+                db.fetch_patients()
+                db.fetch_logs(limit=50)
+                n += 1
+            except Exception:
+                e += 1
+        with lock:
+            counts["reads"] += n
+            counts["errors"] += e
+
+    def writer():
+        n = e = 0
+        while time.monotonic() < stop:
+            try:
+                # add_logs commits here; add_log would only measure the audit queue, in both profiles
+                db.add_logs([(1, "bench", "admin", "bench_write", "benchmark")])
+                db.update_patient(1, diagnosis=f"Flu {n}")
+                n += 1
+            except Exception:
+                e += 1
+        with lock:
+            counts["writes"] += n
+            counts["errors"] += e
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer) for _ in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    counts["reads_per_sec"] = round(counts["reads"] / seconds, 1)
+    counts["writes_per_sec"] = round(counts["writes"] / seconds, 1)
+    return counts
+
+def bench_storage(args):
+    """Concurrent read/write throughput: legacy rollback journal vs the configured profile."""
+    results = {}
+    saved_retries = db.BUSY_RETRIES
+    try:
+        for label, profile, retries in (("before", "legacy", 0), ("after", args.profile, saved_retries)):
+            db.BUSY_RETRIES = retries
+            with temp_database(profile):
+                results[label] = {"profile": profile, **_run_mixed_load(args.seconds, args.readers, args.writers)}
+    finally:
+        db.BUSY_RETRIES = saved_retries
+    return results
+
+# ---------------------------------------------------------------- crypto
+
+def _worker_counts(max_workers):
+    counts, n = [], 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    return counts + [max_workers]
+
+def bench_crypto(args):
+    """Rows/sec for encrypt and decrypt of patient-name-like values as workers are added."""
+    key = Fernet.generate_key()
+    results = []
+    for size in args.sizes:
+        values = [f"Patient {i:07d}" for i in range(size)]
+        tokens = None
+        for workers in _worker_counts(args.max_workers):
+            with ParallelCrypto(key=key, workers=workers, chunk_size=args.chunk_size) as engine:
+                engine.encrypt(values[:engine.batch_size])  # warm the pool up outside the timing
+                start = time.perf_counter()
+                tokens, _ = engine.encrypt(values)
+                enc_secs = time.perf_counter() - start
+                start = time.perf_counter()
+                engine.decrypt(tokens)
+                dec_secs = time.perf_counter() - start
+            results.append({
+                "rows": size,
+                "workers": workers,
+                "encrypt_rows_per_sec": round(size / enc_secs),
+                "decrypt_rows_per_sec": round(size / dec_secs),
+            })
+            print(f"rows={size:>9,} workers={workers:>2} encrypt={size / enc_secs:>10,.0f}/s decrypt={size / dec_secs:>10,.0f}/s")
+    return results
+
+# ---------------------------------------------------------------- export
+
+def _seed_patients(n, chunk_size=50_000):
+    """Insert n synthetic patients straight through executemany."""
+    with db.get_conn() as conn:
+        for start in range(0, n, chunk_size):
+            conn.executemany(
+                "INSERT INTO patients (name, contact, diagnosis, date_added) VALUES (?, ?, ?, ?)",
+                [(f"Patient {i:07d}", f"0300-555-{i % 10000:04d}", "Flu", "2025-01-01T00:00:00")
+                 for i in range(start, min(start + chunk_size, n))],
+            )
+        db.bump_table_versions_with(conn.cursor(), "patients")
+
+def _legacy_export(path):
+    """The old Backup tab: whole table into a DataFrame, row-wise apply, to_csv."""
+    import pandas as pd
+    from utils import anonymize_name, mask_contact
+    df = pd.DataFrame(db.fetch_patients())
+    df["name"] = df.apply(lambda r: r.get("anonymized_name") or anonymize_name(r.get("name", "")), axis=1)
+    df["contact"] = df.apply(lambda r: r.get("anonymized_contact") or mask_contact(r.get("contact", "")), axis=1)
+    with open(path, "wb") as f:
+        f.write(df[export.PATIENT_EXPORT_COLUMNS].to_csv(index=False).encode())
+    return len(df)
+
+def _measure_export(db_path, method, out_path, results):
+    """Child process: run one export and report its peak RSS (ru_maxrss is KiB on Linux)."""
+    db.DB_PATH = db_path
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    rows = _legacy_export(out_path) if method == "dataframe" else export.export_patients(out_path)
+    secs = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put({"rows": rows, "seconds": round(secs, 2), "peak_rss_mb": round(peak / 1024, 1),
+                 "growth_mb": round((peak - baseline) / 1024, 1)})
+
+def bench_export(args):
+    """Peak memory of an anonymized patient export vs row count: DataFrame path vs streaming."""
+    ctx = multiprocessing.get_context("spawn")  # fresh interpreter per run so peaks don't carry over
+    results = []
+    for size in args.sizes:
+        with temp_database() as path:
+            _seed_patients(size)
+            out_path = os.path.join(os.path.dirname(path), "export.csv")
+            for method in args.methods:
+                queue = ctx.Queue()
+                proc = ctx.Process(target=_measure_export, args=(path, method, out_path, queue))
+                proc.start()
+                result = {"method": method, **queue.get()}
+                proc.join()
+                results.append(result)
+                print(f"rows={size:>9,} method={method:<9} peak={result['peak_rss_mb']:>8.1f} MB "
+                      f"growth={result['growth_mb']:>8.1f} MB time={result['seconds']:>7.2f}s")
+    return results
+
+# ---------------------------------------------------------------- anonymize
+
+def bench_anonymize(args):
+    """Row-wise df.apply of anonymize_name/mask_contact vs the column versions."""
+    import pandas as pd
+    import utils
+    results = []
+    for size in args.sizes:
+        # Realistic repetition: names recur, contacts are mostly distinct
+        df = pd.DataFrame({
+            "name": [f"Patient {i % (size // 4 or 1):07d}" for i in range(size)],
+            "contact": [f"0300-{i // 10000 % 1000:03d}-{i % 10000:04d}" for i in range(size)],
+        })
+        start = time.perf_counter()
+        row_names = df.apply(lambda r: utils.anonymize_name(r["name"]), axis=1)
+        row_contacts = df.apply(lambda r: utils.mask_contact(r["contact"]), axis=1)
+        row_secs = time.perf_counter() - start
+        start = time.perf_counter()
+        col_names = utils.anonymize_names(df["name"])
+        col_contacts = utils.mask_contacts(df["contact"])
+        col_secs = time.perf_counter() - start
+        assert row_names.equals(col_names) and row_contacts.equals(col_contacts)
+        results.append({
+            "rows": size,
+            "row_wise_seconds": round(row_secs, 2),
+            "column_seconds": round(col_secs, 2),
+            "speedup": round(row_secs / col_secs, 1),
+        })
+        print(f"rows={size:>9,} row-wise={row_secs:>7.2f}s column={col_secs:>7.2f}s speedup={row_secs / col_secs:>5.1f}x")
+    return results
+
+# ---------------------------------------------------------------- suite
+
+BASELINE_FILE = "benchmark_baseline.json"
+SUITE_TOLERANCE = 0.25  # a metric more than 25% worse than the baseline is a regression
+
+def _percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    return sorted_values[max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)]
+
+def _measure(func, repeat):
+    """Time func() repeat times, then run it once more under tracemalloc for its peak allocation.
+
+    func returns the number of rows it processed. Timed runs are untraced, since
+    tracemalloc slows allocation-heavy code down several times.
+    """
+    func()  # warm-up: first connections, pseudonym write-back, page cache
+    timings, rows = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = func()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    timings.sort()
+    return {
+        "runs": repeat,
+        "rows": rows,
+        "p50_ms": round(1000 * _percentile(timings, 50), 3),
+        "p95_ms": round(1000 * _percentile(timings, 95), 3),
+        "p99_ms": round(1000 * _percentile(timings, 99), 3),
+        "mean_ms": round(1000 * sum(timings) / repeat, 3),
+        "rows_per_sec": round(rows / timings[len(timings) // 2]) if timings[len(timings) // 2] else None,
+        "peak_mb": round(peak / 2**20, 2),
+    }
+
+def _suite_scenarios(tmpdir, page_size):
+    """name -> (func, bulk). Bulk scenarios touch every row and get fewer repeats."""
+    import pandas as pd
+    import auth
+    import jobs
+    from patient_view import ROLE_COLUMNS, build_patient_rows
+
+    def login():
+        user, error = auth.login("admin", "admin123")  # default account from db_setup
+        assert user, error
+        return 1
+
+    def fetch_page():
+        return len(db.fetch_patients_page(page_size)[0])
+
+    def fetch_all():
+        return len(db.fetch_patients())
+
+    def render(role, show_decrypted=False):
+        def run():
+            patients, _ = db.fetch_patients_page(page_size, columns=ROLE_COLUMNS[role])
+            return len(pd.DataFrame(build_patient_rows(patients, role, show_decrypted)))
+        return run
+
+    def bulk_job(kind):
+        def run():
+            jobs.submit_job(kind, {"reprocess_all": True})
+            jobs.run_pending("benchmark")
+            return jobs.list_jobs(1, [kind])[0]["done"]
+        return run
+
+    def backup():
+        return export.export_patients(os.path.join(tmpdir, "export.csv"))
+
+    def activity():
+        # The Activity tab: both rollup queries, the daily pivot and the recent-events page
+        start_day = (datetime.utcnow() - timedelta(days=90)).date().isoformat()
+        daily = db.fetch_activity_by_day(start_day)
+        pd.DataFrame(daily).pivot(index="day", columns="action", values="count").fillna(0)
+        pd.DataFrame(db.fetch_activity_by_user(start_day)).set_index("username")
+        db.fetch_logs_page(50)
+        return len(daily)
+
+    return {
+        "login": (login, False),
+        "fetch_patients_page": (fetch_page, False),
+        "render_admin": (render("admin"), False),
+        "render_admin_decrypted": (render("admin", True), False),
+        "render_doctor": (render("doctor"), False),
+        "render_receptionist": (render("receptionist"), False),
+        "activity": (activity, False),
+        "fetch_patients_all": (fetch_all, True),
+        "backup_export": (backup, True),
+        "anonymize_all": (bulk_job("anonymize"), True),
+        "encrypt_all": (bulk_job("encrypt"), True),
+    }
+
+def _compare(results, baseline, tolerance):
+    """Regressions of p50 latency and peak memory against the baseline's matching (size, scenario)."""
+    previous = {(r["size"], r["scenario"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        base = previous.get((r["size"], r["scenario"]))
+        if not base:
+            continue
+        for metric in ("p50_ms", "peak_mb"):
+            # Below 1 ms / 1 MB differences are noise, not regressions
+            if r[metric] > max(base[metric], 1.0) * (1 + tolerance):
+                regressions.append({"size": r["size"], "scenario": r["scenario"], "metric": metric,
+                                    "baseline": base[metric], "current": r[metric],
+                                    "change": round(r[metric] / base[metric] - 1, 3) if base[metric] else None})
+    return regressions
+
+def bench_suite(args):
+    """Latency percentiles, throughput and peak memory of the dashboard's hot paths at each dataset size.
+
+    Every size gets a fresh seed_data database with as many audit logs as
+    patients, half of them anonymized and half encrypted. Results are compared
+    with the baseline file; --save-baseline replaces it.
+    """
+    import seed_data
+    results = []
+    for size in args.sizes:
+        with temp_database() as path:
+            seed_data.seed(path, patients=size, users=50, logs=size, seed_value=1)
+            scenarios = _suite_scenarios(os.path.dirname(path), args.page_size)
+            for name, (func, bulk) in scenarios.items():
+                if args.scenarios and name not in args.scenarios:
+                    continue
+                result = {"size": size, "scenario": name, **_measure(func, args.bulk_repeat if bulk else args.repeat)}
+                results.append(result)
+                print(f"size={size:>9,} {name:<24} p50={result['p50_ms']:>10.2f}ms p95={result['p95_ms']:>10.2f}ms "
+                      f"p99={result['p99_ms']:>10.2f}ms {result['rows_per_sec'] or 0:>12,} rows/s peak={result['peak_mb']:>8.2f} MB")
+
+    report = {
+        "created_at": datetime.utcnow().isoformat(),
+        "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "results": results,
+        "regressions": [],
+    }
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = _compare(results, json.load(f), args.tolerance)
+        for r in report["regressions"]:
+            print(f"REGRESSION size={r['size']:,} {r['scenario']} {r['metric']}: {r['baseline']} -> {r['current']}")
+        print(f"{len(report['regressions'])} regression(s) against {args.baseline}")
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return report
+
+BENCHMARKS = {
+    "storage": bench_storage,
+    "crypto": bench_crypto,
+    "export": bench_export,
+    "anonymize": bench_anonymize,
+    "suite": bench_suite,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hospital dashboard benchmarks")
+    sub = parser.add_subparsers(dest="name", required=True)
+
+    p = sub.add_parser("storage", help="concurrent read/write throughput before/after WAL + retries")
+    p.add_argument("--seconds", type=float, default=5.0)
+    p.add_argument("--readers", type=int, default=4)
+    p.add_argument("--writers", type=int, default=2)
+    p.add_argument("--profile", default=db.STORAGE_PROFILE, choices=sorted(db.STORAGE_PROFILES))
+
+    p = sub.add_parser("crypto", help="parallel Fernet throughput vs worker count")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    p.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--chunk-size", type=int, default=2000)
+
+    p = sub.add_parser("export", help="peak memory of patient export vs row count")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    p.add_argument("--methods", nargs="+", choices=["dataframe", "streaming"], default=["dataframe", "streaming"])
+
+    p = sub.add_parser("anonymize", help="row-wise vs column anonymize_name/mask_contact")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+
+    p = sub.add_parser("suite", help="end-to-end hot paths at several dataset sizes, compared with a baseline")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    p.add_argument("--scenarios", nargs="+", help="only these scenarios (default: all)")
+    p.add_argument("--repeat", type=int, default=30, help="timed runs per interactive scenario")
+    p.add_argument("--bulk-repeat", type=int, default=3, help="timed runs per whole-table scenario")
+    p.add_argument("--page-size", type=int, default=50)
+    p.add_argument("--baseline", default=BASELINE_FILE)
+    p.add_argument("--save-baseline", action="store_true", help="write this run as the new baseline")
+    p.add_argument("--tolerance", type=float, default=SUITE_TOLERANCE)
+    p.add_argument("--out", help="also write the JSON report here")
+
+    args = parser.parse_args(argv)
+    results = BENCHMARKS[args.name](args)
+    if args.name == "suite":
+        # Non-zero exit on regressions so CI or a pre-release script can gate on it
+        raise SystemExit(1 if results["regressions"] else 0)
+    print(json.dumps({"benchmark": args.name, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+# cli.py
+"""
+Headless entry point for bulk data-protection work, e.g. from cron.
+
+    python cli.py anonymize --chunk-size 5000
+    python cli.py encrypt --workers 8 --reprocess-all
+    python cli.py retention --days 730 --dry-run
+    python cli.py export patients patients.parquet --format parquet --mode decrypted --workers 4
+    python cli.py rotate start            # then `rotate resume` after an interruption
+    python cli.py status
+
+anonymize, encrypt and retention run as jobs in the jobs table, in the
+foreground of this process. The work is checkpointed per chunk. Re-running
+the same command after a crash, kill or Ctrl-C continues from the last
+checkpoint, because submit_job hands back the unfinished job instead of
+starting a new one. Ctrl-C puts the job back in the queue straight away, so
+the dashboard's runner or the next cli.py run can pick it up. Exports are a
+single stream and start again from the beginning. Rotation keeps its own
+checkpoints (key_rotation.py).
+
+--dry-run only counts what would be processed. Exit status is 0 on success,
+1 on failure or when the job is busy elsewhere, and 130 after Ctrl-C.
+"""
+import argparse
+import getpass
+import os
+import socket
+import sys
+import time
+
+import db
+import export
+import jobs
+import key_rotation
+from retention import RETENTION_DAYS, retention_cutoff
+
+PROGRESS_INTERVAL = 2.0  # seconds between progress lines
+
+def progress_printer(label, total=None, quiet=False, already=0):
+    """Return progress(done, total=None) that prints rate and ETA at most every PROGRESS_INTERVAL seconds.
+
+    already is the count done before this process started (a resumed job); it is left out of the rate.
+    """
+    start = last = time.monotonic()
+    tty = sys.stdout.isatty()
+
+    def progress(done, new_total=None):
+        nonlocal last, total
+        total = new_total or total
+        now = time.monotonic()
+        if quiet or (now - last < PROGRESS_INTERVAL and (not total or done < total)):
+            return
+        last = now
+        rate = (done - already) / (now - start) if now > start else 0
+        line = f"  {label}: {done:,}"
+        if total:
+            eta = f", ETA {(total - done) / rate:,.0f}s" if rate and done < total else ""
+            line += f" / {total:,} ({100 * done / total:.1f}%){eta}"
+        line += f" {rate:,.0f} rows/s"
+        # Overwrite in a terminal; one line per update in a cron log
+        print(line.ljust(90), end="\r" if tty else "\n", flush=True)
+    return progress
+
+def _cli_user():
+    return {"user_id": None, "username": f"cli:{getpass.getuser()}", "role": "system"}
+
+def _owner():
+    return f"cli:{socket.gethostname()}:{os.getpid()}"
+
+# ---------------------------------------------------------------- jobs
+
+def run_job_command(kind, params, dry_run=False, quiet=False):
+    """Submit (or pick up the unfinished) kind job and run it here. Returns the exit status."""
+    total = jobs.HANDLERS[kind][0](params)
+    if dry_run:
+        print(f"Dry run: {kind} would process {total:,} records" +
+              (f" added before {params['cutoff']}" if "cutoff" in params else ""))
+        return 0
+    if not total:
+        print(f"Nothing to {kind}.")
+        return 0
+
+    job_id = jobs.submit_job(kind, dict(params), _cli_user())
+    job = jobs.claim_next_job(_owner(), job_id)
+    if job is None:
+        job = jobs.get_job(job_id)
+        print(f"Job #{job_id} ({kind}) is {job['status']} by {job['owner'] or 'another runner'}, "
+              f"last checkpoint {job['updated_at']}. Retry after {jobs.STALE_AFTER}s if that runner has died.")
+        return 1
+    if job["done"]:
+        print(f"Resuming job #{job_id} ({kind}) after {job['done']:,} records")
+    else:
+        print(f"Running job #{job_id} ({kind}): {job['total']:,} records")
+    # Chunk size and workers are how this process runs, not part of the job; they override a resumed job's
+    job["params"].update({k: params[k] for k in ("chunk_size", "workers") if params.get(k)})
+
+    start = time.perf_counter()
+    try:
+        status = jobs.run_job(job, progress_printer(kind, job["total"], quiet, job["done"]))
+    except KeyboardInterrupt:
+        jobs.release_job(job_id, job["owner"])
+        print(f"\nInterrupted; job #{job_id} kept its progress and is queued again. Re-run to continue.")
+        return 130
+    if status == "lost":
+        print(f"\nJob #{job_id} was taken over by another runner after this one stalled for {jobs.STALE_AFTER}s; "
+              "its last chunk here was rolled back.")
+        return 1
+    job = jobs.get_job(job_id)
+    secs = time.perf_counter() - start
+    print(f"\nJob #{job_id} {status}: {job['done']:,} / {job['total']:,} records in {secs:.1f}s"
+          + (f" - {job['error']}" if job["error"] else ""))
+    return 0 if status == "finished" else 1
+
+# ---------------------------------------------------------------- export / rotate
+
+def run_export(args):
+    filters = {k: v for k, v in (("action", args.action), ("username", args.username), ("role", args.role),
+                                 ("start_day", args.start_day), ("end_day", args.end_day)) if v}
+    if args.what == "patients":
+        if filters:
+            raise SystemExit("Log filters only apply to `export logs`")
+        total = db.count_patients()
+    else:
+        total = db.count_logs(**filters)
+    if args.dry_run:
+        print(f"Dry run: would export {total:,} {args.what} rows to {args.path} ({args.format})")
+        return 0
+
+    progress = progress_printer(f"export {args.what}", total, args.quiet)
+    start = time.perf_counter()
+    if args.what == "patients":
+        engine = None
+        if args.mode == "decrypted" and args.workers != 1:
+            from crypto_engine import ParallelCrypto
+            engine = ParallelCrypto(workers=args.workers)
+        try:
+            written = export.export_patients(args.path, args.format, args.mode, args.chunk_size, progress, engine)
+        finally:
+            if engine:
+                engine.close()
+    else:
+        written = export.export_logs(args.path, args.format, args.chunk_size, progress, **filters)
+    db.add_log(None, _cli_user()["username"], "system", f"export_{args.what}",
+               f"{written} rows ({args.format}{', ' + args.mode if args.what == 'patients' else ''}) to {args.path}")
+    print(f"\nExported {written:,} rows to {args.path} in {time.perf_counter() - start:.1f}s")
+    return 0
+
+def run_rotate(args):
+    if args.action == "status" or args.dry_run:
+        rotation = key_rotation.rotation_status()
+        print(rotation or "No rotations recorded.")
+        if args.dry_run:
+            print(f"Dry run: {db.count_patients(encrypted=True):,} encrypted records would be re-encrypted")
+        return 0
+    if args.action == "start":
+        print(f"Started rotation {key_rotation.start_rotation()}")
+    total = db.count_patients(encrypted=True)
+    result = key_rotation.run_rotation(args.chunk_size, progress_printer("rotate", total, args.quiet))
+    print(f"\nRotation {result['rotation_id']} {result['status']}: {result['rotated']:,} rotated, {result['failed']:,} failed")
+    return 0 if result["status"] == "finished" else 1
+
+def show_status(args):
+    for job in jobs.list_jobs(args.limit):
+        print(f"{job['job_id']:>5} {job['kind']:<10} {job['status']:<16} {job['done']:>10,}/{job['total']:<10,} "
+              f"{job['created_by']:<16} {job['updated_at'][:19]} {job['error'] or ''}")
+    rotation = key_rotation.rotation_status()
+    if rotation:
+        print(f"Last key rotation: #{rotation['rotation_id']} {rotation['status']}, {rotation['rotated']:,} rotated")
+    return 0
+
+# ---------------------------------------------------------------- main
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk anonymize, encrypt, retention, export and key rotation")
+    parser.add_argument("--db", default=db.DB_PATH, help="database file (default: %(default)s)")
+    parser.add_argument("--quiet", action="store_true", help="no progress lines")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def job_parser(name, help):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("--chunk-size", type=int, default=jobs.JOB_CHUNK_SIZE, help="rows per transaction/checkpoint")
+        p.add_argument("--dry-run", action="store_true", help="only count what would be processed")
+        return p
+
+    p = job_parser("anonymize", "store pseudonyms for changed (or all) records")
+    p.add_argument("--reprocess-all", action="store_true")
+    p = job_parser("encrypt", "encrypt names and contacts of changed (or all) records")
+    p.add_argument("--reprocess-all", action="store_true")
+    p.add_argument("--workers", type=int, help="encryption processes (default: CPU count)")
+    p = job_parser("retention", "redact records older than the retention period")
+    p.add_argument("--days", type=int, default=RETENTION_DAYS)
+    p.add_argument("--cutoff", help="ISO timestamp; overrides --days")
+
+    p = sub.add_parser("export", help="stream patients or audit logs to a file")
+    p.add_argument("what", choices=["patients", "logs"])
+    p.add_argument("path")
+    p.add_argument("--format", choices=export.FORMATS, default="csv")
+    p.add_argument("--mode", choices=export.PATIENT_MODES, default="anonymized", help="patients only")
+    p.add_argument("--chunk-size", type=int, default=export.EXPORT_CHUNK_SIZE)
+    p.add_argument("--workers", type=int, help="decryption processes for --mode decrypted (1 = in-process)")
+    p.add_argument("--dry-run", action="store_true")
+    for name in ("--action", "--username", "--role", "--start-day", "--end-day"):
+        p.add_argument(name, help="logs only")
+
+    p = sub.add_parser("rotate", help="rotate the Fernet key and re-encrypt")
+    p.add_argument("action", choices=["start", "resume", "status"])
+    p.add_argument("--chunk-size", type=int, default=key_rotation.CHUNK_SIZE)
+    p.add_argument("--dry-run", action="store_true")
+
+    p = sub.add_parser("status", help="recent jobs and the last key rotation")
+    p.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        parser.error(f"database not found: {args.db} (create it with db_setup.py)")
+    db.DB_PATH = args.db
+
+    if args.command in ("anonymize", "encrypt"):
+        params = {"reprocess_all": args.reprocess_all, "chunk_size": args.chunk_size}
+        if args.command == "encrypt":
+            params["workers"] = args.workers
+        status = run_job_command(args.command, params, args.dry_run, args.quiet)
+    elif args.command == "retention":
+        params = {"cutoff": args.cutoff or retention_cutoff(args.days), "trigger": "cli", "chunk_size": args.chunk_size}
+        status = run_job_command("retention", params, args.dry_run, args.quiet)
+    elif args.command == "export":
+        status = run_export(args)
+    elif args.command == "rotate":
+        status = run_rotate(args)
+    else:
+        status = show_status(args)
+    db.flush_logs()
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,9 @@
 # create_key.py (quick one-liner)
-from utils import generate_fernet_key
+import os
+import sys
+from utils import generate_fernet_key, KEY_FILE
+# Overwriting an existing key makes every stored ciphertext unreadable; rotate instead
+if os.path.exists(KEY_FILE) and "--force" not in sys.argv:
+    sys.exit(f"{KEY_FILE} already exists. Use 'python key_rotation.py start' to rotate it, or --force to overwrite.")
 k = generate_fernet_key()
-open('fernet.key','wb').write(k)
+open(KEY_FILE,'wb').write(k)
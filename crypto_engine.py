@@ -0,0 +1,114 @@
+# crypto_engine.py
+"""
+Parallel Fernet encryption/decryption for large tables.
+
+Values are split into chunks and fanned out over a process pool; the key is
+handed to each worker once through the pool initializer, and results come
+back in input order. Small inputs are handled in-process, where pool start-up
+would cost more than it saves.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import utils
+from instrumentation import timed
+
+CHUNK_SIZE = 2000            # values per task sent to a worker
+MIN_PARALLEL_ITEMS = 5000    # below this, run in the calling process
+# "spawn" is the safe default inside threaded servers such as Streamlit
+START_METHOD = os.environ.get("CRYPTO_START_METHOD", "spawn")
+
+_worker_key = None
+
+def _init_worker(key):
+    global _worker_key
+    _worker_key = key
+
+def _encrypt_chunk(chunk):
+    return utils.encrypt_many(chunk, _worker_key)
+
+def _decrypt_chunk(chunk):
+    return utils.decrypt_many(chunk, _worker_key)
+
+class ParallelCrypto:
+    """Process-pool backed encrypt_many/decrypt_many with the same return shape as utils."""
+
+    def __init__(self, key=None, workers=None, chunk_size=CHUNK_SIZE):
+        self._explicit_key = key
+        if not self.key:
+            raise ValueError("Fernet key not loaded")
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self._pool = None
+        self._pool_key = None
+        self._lock = threading.Lock()  # one engine is shared by every Streamlit session
+
+    @property
+    def key(self):
+        """The explicit key, or the current keyring so workers follow a key rotation."""
+        return self._explicit_key or utils.current_keys()
+
+    @property
+    def batch_size(self):
+        """A good number of values to hand over per call: one chunk per worker."""
+        return self.chunk_size * self.workers
+
+    def _executor(self):
+        """The worker pool for the current keys; call with self._lock held."""
+        key = self.key
+        if self._pool is not None and self._pool_key != key:
+            self._pool.shutdown()  # keys changed since the workers were started
+            self._pool = None
+        if self._pool is None:
+            self._pool_key = key
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(START_METHOD),
+                initializer=_init_worker,
+                initargs=(key,),
+            )
+        return self._pool
+
+    def _run(self, chunk_func, local_func, values):
+        items = values.tolist() if hasattr(values, "tolist") else list(values)
+        if self.workers == 1 or len(items) < MIN_PARALLEL_ITEMS:
+            return local_func(values, self.key)
+
+        chunks = [items[i:i + self.chunk_size] for i in range(0, len(items), self.chunk_size)]
+        results, errors = [], {}
+        with self._lock:  # map submits every chunk up front, so a restart cannot close the pool under it
+            mapped = self._executor().map(chunk_func, chunks)
+        for n, (chunk_results, chunk_errors) in enumerate(mapped):
+            offset = n * self.chunk_size
+            results.extend(chunk_results)
+            errors.update({offset + pos: msg for pos, msg in chunk_errors.items()})
+
+        index = getattr(values, "index", None)
+        if index is not None and not callable(index):
+            import pandas as pd
+            labels = list(index)
+            errors = {labels[pos]: msg for pos, msg in errors.items()}
+            return pd.Series(results, index=index, dtype=object, name=getattr(values, "name", None)), errors
+        return results, errors
+
+    @timed("utils.parallel_encrypt")  # same category as utils.encrypt_many, so nesting is not double-counted
+    def encrypt(self, values):
+        return self._run(_encrypt_chunk, utils.encrypt_many, values)
+
+    @timed("utils.parallel_decrypt")
+    def decrypt(self, values):
+        return self._run(_decrypt_chunk, utils.decrypt_many, values)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,102 @@
+# data_cache.py
+"""
+Cached db.py reads for the Streamlit app.
+
+Each wrapped read goes through st.cache_data, keyed by the session's role,
+the query arguments and the current version of every table the read depends
+on. Every write transaction bumps table_versions for the tables it touched
+(db.bump_table_versions_with), so any write (add_patient, update_patient,
+bulk jobs, audit logs, another process) invalidates exactly the entries
+built from that table. A rerun that changed nothing costs one small version lookup per read.
+
+The signed-in user's profile (role, consent) is cached per session instead,
+see session_profile.
+"""
+import os
+import threading
+import time
+
+import streamlit as st
+
+import db
+
+CACHE_TTL = 600           # seconds; a backstop only, invalidation is version-driven
+CACHE_MAX_ENTRIES = 256   # per wrapped function
+
+# Seconds a session trusts its cached profile; consent changes made by another process take up to this long
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", "30"))
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def cached_read(*tables):
+    """Cache a db read until one of the given tables changes."""
+    def decorator(func):
+        name = func.__name__
+        _stats[name] = {"calls": 0, "misses": 0, "miss_seconds": 0.0}
+
+        def load(role, versions, args, kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            with _stats_lock:
+                _stats[name]["misses"] += 1
+                _stats[name]["miss_seconds"] += time.perf_counter() - start
+            return result
+        # st.cache_data identifies functions by name, so give each wrapper its own
+        load.__name__ = load.__qualname__ = f"cached_{name}"
+        load = st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)(load)
+
+        def wrapper(*args, **kwargs):
+            if "logs" in tables and db.audit_writer.pending():
+                db.flush_logs()  # queued audit entries count as written; the db reads themselves never flush
+            all_versions = db.fetch_table_versions()
+            versions = tuple(all_versions.get(t) for t in tables)
+            role = (st.session_state.get("user") or {}).get("role")
+            with _stats_lock:
+                _stats[name]["calls"] += 1
+            return load(role, versions, args, kwargs)
+        wrapper.__name__ = name
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+fetch_patients_page = cached_read("patients")(db.fetch_patients_page)
+count_patients = cached_read("patients")(db.count_patients)
+get_patient = cached_read("patients")(db.get_patient)
+fetch_logs_page = cached_read("logs")(db.fetch_logs_page)
+count_logs = cached_read("logs")(db.count_logs)
+fetch_log_actions = cached_read("logs")(db.fetch_log_actions)
+fetch_activity_by_day = cached_read("logs")(db.fetch_activity_by_day)
+fetch_activity_by_user = cached_read("logs")(db.fetch_activity_by_user)
+
+def cache_stats():
+    """Per-function calls, hits, misses, hit rate and time spent on misses (this process, all sessions)."""
+    with _stats_lock:
+        rows = []
+        for name, s in _stats.items():
+            hits = s["calls"] - s["misses"]
+            rows.append({
+                "function": name,
+                "calls": s["calls"],
+                "hits": hits,
+                "misses": s["misses"],
+                "hit_rate": round(hits / s["calls"], 3) if s["calls"] else None,
+                "miss_ms_avg": round(1000 * s["miss_seconds"] / s["misses"], 2) if s["misses"] else None,
+            })
+        return rows
+
+def session_profile(user_id):
+    """The user's row from db.get_user_by_id, cached in session_state.
+
+    Re-read after PROFILE_CACHE_TTL seconds, or at once when set_consent has run in
+    this process, so steady-state reruns do not touch the database.
+    """
+    cached = st.session_state.get("profile_cache")
+    generation = db.consent_generation()
+    if (cached and cached["user_id"] == user_id and cached["generation"] == generation
+            and time.monotonic() - cached["loaded_at"] < PROFILE_CACHE_TTL):
+        return cached["profile"]
+    profile = db.get_user_by_id(user_id)
+    st.session_state["profile_cache"] = {"user_id": user_id, "generation": generation,
+                                         "loaded_at": time.monotonic(), "profile": profile}
+    return profile
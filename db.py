@@ -1,43 +1,299 @@
 # db.py
+import functools
+import itertools
+import os
+import random
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
 
+import audit
+from instrumentation import timed, count_statement, is_recording, PERF_TRACE
+from utils import blind_index, blind_indexes
+
 DB_PATH = "hospital.db"
 
+# Storage profiles: PRAGMAs applied to every connection. Select with HOSPITAL_DB_PROFILE.
+STORAGE_PROFILES = {
+    # WAL lets readers run alongside a writer; NORMAL sync is safe in WAL mode
+    "default": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -16000,        # negative = KiB, i.e. ~16 MB page cache
+        "mmap_size": 268435456,      # 256 MB memory-mapped I/O
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,        # ms SQLite itself waits on a lock before SQLITE_BUSY
+    },
+    # fsync on every commit, for deployments that prefer durability over write latency
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -16000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 10000,
+    },
+    # large one-off loads (seeding, migrations); a crash mid-load may corrupt the file
+    "bulk_load": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -262144,
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+        "busy_timeout": 30000,
+    },
+    # SQLite defaults as shipped before profiles existed (kept for benchmarking)
+    "legacy": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "busy_timeout": 0,
+    },
+}
+STORAGE_PROFILE = os.environ.get("HOSPITAL_DB_PROFILE", "default")
+
+# Retry policy for SQLITE_BUSY / "database is locked" that outlives busy_timeout
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.05      # seconds, doubled on each attempt
+BUSY_BACKOFF_MAX = 1.0
+
+def apply_storage_profile(conn, profile=None, readonly=False):
+    """Apply the PRAGMAs of a storage profile to an open connection."""
+    settings = STORAGE_PROFILES[profile or STORAGE_PROFILE]
+    for pragma, value in settings.items():
+        if readonly and pragma == "journal_mode":
+            continue  # journal mode is persistent in the file and needs write access
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return settings
+
+# Result codes; the sqlite3 constants and OperationalError.sqlite_errorcode only exist from Python 3.11
+SQLITE_BUSY = getattr(sqlite3, "SQLITE_BUSY", 5)
+SQLITE_LOCKED = getattr(sqlite3, "SQLITE_LOCKED", 6)
+
+def is_busy_error(exc):
+    if not isinstance(exc, sqlite3.OperationalError):
+        return False
+    code = getattr(exc, "sqlite_errorcode", None)
+    if code is not None and code & 0xFF in (SQLITE_BUSY, SQLITE_LOCKED):  # extended codes, e.g. SQLITE_BUSY_SNAPSHOT
+        return True
+    msg = str(exc).lower()
+    return "database is locked" in msg or "database is busy" in msg
+
+def with_busy_retry(func):
+    """Retry a db helper with exponential backoff and jitter while the database is locked.
+
+    Calls nested inside another helper's connection are not retried here: the
+    outermost call owns the transaction and retries it as a whole.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        delay = BUSY_BACKOFF
+        attempt = 0
+        while True:
+            nested = get_pool().holds_connection() or get_pool(readonly=True).holds_connection()
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if nested or attempt >= BUSY_RETRIES or not is_busy_error(e):
+                    raise
+            attempt += 1
+            time.sleep(delay * (0.5 + random.random()))
+            delay = min(delay * 2, BUSY_BACKOFF_MAX)
+    return wrapper
+
+# Connection pool settings
+POOL_MAX_SIZE = 8            # max open connections per pool (read-only and read-write pools are separate)
+POOL_TIMEOUT = 10.0          # seconds to wait for a free connection before giving up
+HEALTH_CHECK_INTERVAL = 30.0 # idle seconds after which a pooled connection is pinged before reuse
+
+class ConnectionPool:
+    """Thread-aware pool of long-lived SQLite connections for one database file.
+
+    A thread that is already inside get_conn() gets the same connection back,
+    so nested helpers share one transaction. Otherwise a connection is checked
+    out (preferring the one this thread used last), and returned on exit.
+    """
+
+    def __init__(self, db_path, readonly=False, max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT):
+        self.db_path = db_path
+        self.readonly = readonly
+        self.max_size = max_size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = []  # list of [conn, last_used]
+        self._local = threading.local()
+        self._closed = False
+
+    def _connect(self):
+        timeout = STORAGE_PROFILES[STORAGE_PROFILE].get("busy_timeout", 5000) / 1000
+        if self.readonly:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=timeout, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, timeout=timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        apply_storage_profile(conn, readonly=self.readonly)
+        return conn
+
+    def holds_connection(self):
+        """True if the calling thread is currently inside connection()."""
+        return getattr(self._local, "conn", None) is not None
+
+    def _is_healthy(self, conn, last_used):
+        if time.monotonic() - last_used < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError(f"connection pool exhausted ({self.max_size} connections in use)")
+        try:
+            preferred = getattr(self._local, "last", None)
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    entry = next((e for e in self._idle if e[0] is preferred), self._idle[-1])
+                    self._idle.remove(entry)
+                conn, last_used = entry
+                if self._is_healthy(conn, last_used):
+                    return conn
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, conn):
+        try:
+            with self._lock:
+                if self._closed:
+                    conn.close()
+                else:
+                    self._idle.append([conn, time.monotonic()])
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            yield held
+            return
+
+        conn = self._acquire()
+        if PERF_TRACE:
+            # Count statements only for threads recording a rerun; bulk jobs skip the per-row callback
+            conn.set_trace_callback(count_statement if is_recording() else None)
+        self._local.conn = conn
+        try:
+            yield conn
+            if not self.readonly:
+                conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            raise
+        finally:
+            self._local.conn = None
+            self._local.last = conn
+            self._release(conn)
+
+    def stats(self):
+        with self._lock:
+            idle = len(self._idle)
+        return {"db_path": self.db_path, "readonly": self.readonly, "idle": idle, "max_size": self.max_size}
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(readonly=False):
+    """Return the pool for the current DB_PATH, creating it on first use."""
+    key = (DB_PATH, readonly)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(DB_PATH, readonly=readonly)
+    return pool
+
+def close_pools():
+    """Close every pooled connection (used on shutdown and when DB_PATH changes)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
 @contextmanager
-def get_conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    try:
+def get_conn(readonly=False):
+    """Borrow a pooled connection. Read-write connections commit on success and roll back on error."""
+    with get_pool(readonly).connection() as conn:
         yield conn
-    finally:
-        conn.commit()
-        conn.close()
 
 # Users
+@timed()
+@with_busy_retry
 def fetch_users():
-    with get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("SELECT user_id, username, password_hash, role FROM users")
         return [dict(r) for r in cur.fetchall()]
 
+@timed()
+@with_busy_retry
 def get_user_by_username(username):
-    with get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("SELECT user_id, username, password_hash, role FROM users WHERE username = ?", (username,))
         row = cur.fetchone()
         return dict(row) if row else None
 
+@timed()
+@with_busy_retry
+def get_user_by_id(user_id):
+    """The user's profile (no password hash), including consent status."""
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, username, role, consent_given, consent_date FROM users WHERE user_id = ?", (user_id,))
+        row = cur.fetchone()
+        return dict(row) if row else None
+
 # Patients
+@timed()
+@with_busy_retry
 def add_patient(name, contact, diagnosis, date_added):
+    name_bidx, contact_bidx, terms = blind_index(name, contact)
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute("""
-            INSERT INTO patients (name, contact, diagnosis, date_added)
-            VALUES (?, ?, ?, ?)
-        """, (name, contact, diagnosis, date_added))
-        return cur.lastrowid
+            INSERT INTO patients (name, contact, diagnosis, date_added, name_bidx, contact_bidx)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (name, contact, diagnosis, date_added, name_bidx, contact_bidx))
+        pid = cur.lastrowid
+        replace_name_terms_with(cur, [(pid, terms)])
+        bump_table_versions_with(cur, "patients")
+        return pid
 
+@timed()
+@with_busy_retry
 def update_patient(patient_id, **fields):
     if not fields:
         return
@@ -46,41 +302,595 @@ def update_patient(patient_id, **fields):
         set_clause = ", ".join([f"{k} = ?" for k in fields.keys()])
         params = list(fields.values()) + [patient_id]
         cur.execute(f"UPDATE patients SET {set_clause} WHERE patient_id = ?", params)
+        if "name" in fields or "contact" in fields:
+            row = cur.execute("SELECT name, contact FROM patients WHERE patient_id = ?", (patient_id,)).fetchone()
+            if row:
+                write_blind_index_with(cur, [(patient_id, row[0], row[1])])
+        bump_table_versions_with(cur, "patients")
 
+@timed()
+@with_busy_retry
 def fetch_patients(raw=False):
-    with get_conn() as conn:
+    """Load every patient. Prefer fetch_patients_page / iter_patient_pages on large tables."""
+    with get_conn(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("SELECT * FROM patients ORDER BY patient_id")
         rows = [dict(r) for r in cur.fetchall()]
         return rows
 
+PATIENT_COLUMNS = (
+    "patient_id", "name", "contact", "diagnosis",
+    "anonymized_name", "anonymized_contact",
+    "encrypted_name", "encrypted_contact", "date_added",
+    "pii_version", "encrypted_version", "anonymized_version", "retention_applied_at", "name_digest",
+    "name_bidx", "contact_bidx",
+)
+# stale= filter values; each predicate matches a partial index created by db_setup.
+# Rows redacted by the retention engine are never stale: there is nothing left to derive.
+STALE_PREDICATES = {
+    "encrypted": "(encrypted_version IS NULL OR encrypted_version < pii_version) AND retention_applied_at IS NULL",
+    "anonymized": "(anonymized_version IS NULL OR anonymized_version < pii_version) AND retention_applied_at IS NULL",
+}
+PAGE_SIZE = 50
+
+def _patient_filters(diagnosis=None, added_from=None, added_to=None, encrypted=None, stale=None, retained=None,
+                     pseudonym=None, name_bidx=None, contact_bidx=None, name_terms=None):
+    """Build a WHERE fragment for the patient filters.
+
+    diagnosis: case-insensitive substring; added_from / added_to: ISO timestamps
+    (inclusive / exclusive); encrypted: True for rows with ciphertext, False for rows without;
+    stale: "encrypted" or "anonymized" for rows whose derived columns are out of date;
+    retained: True / False for rows the retention engine has / has not redacted;
+    pseudonym: exact stored ANON_ id (indexed);
+    name_bidx / contact_bidx / name_terms: blind-index hashes from utils.blind_search_filters
+    (indexed; every term must match).
+    """
+    clauses, params = [], []
+    if pseudonym:
+        clauses.append("anonymized_name = ?")
+        params.append(pseudonym)
+    if name_bidx is not None:
+        clauses.append("name_bidx = ?")
+        params.append(name_bidx)
+    if contact_bidx is not None:
+        clauses.append("contact_bidx = ?")
+        params.append(contact_bidx)
+    for term in name_terms or ():
+        clauses.append("patient_id IN (SELECT patient_id FROM patient_name_terms WHERE term = ?)")
+        params.append(term)
+    if stale:
+        if stale not in STALE_PREDICATES:
+            raise ValueError(f"Unknown stale filter: {stale}")
+        clauses.append(STALE_PREDICATES[stale])
+    if diagnosis:
+        clauses.append("diagnosis LIKE ?")
+        params.append(f"%{diagnosis}%")
+    if added_from:
+        clauses.append("date_added >= ?")
+        params.append(added_from)
+    if added_to:
+        clauses.append("date_added < ?")
+        params.append(added_to)
+    if encrypted is True:
+        clauses.append("COALESCE(encrypted_name, '') != ''")
+    elif encrypted is False:
+        clauses.append("COALESCE(encrypted_name, '') = ''")
+    if retained is True:
+        clauses.append("retention_applied_at IS NOT NULL")
+    elif retained is False:
+        clauses.append("retention_applied_at IS NULL")
+    return clauses, params
+
+def _patient_columns(columns):
+    if not columns:
+        return list(PATIENT_COLUMNS)
+    unknown = set(columns) - set(PATIENT_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown patient columns: {sorted(unknown)}")
+    return ["patient_id"] + [c for c in columns if c != "patient_id"]
+
+def _patients_page_query(page_size=PAGE_SIZE, after_id=None, columns=None, **filters):
+    cols = _patient_columns(columns)
+    clauses, params = _patient_filters(**filters)
+    if after_id is not None:
+        clauses.append("patient_id > ?")
+        params.append(after_id)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return f"SELECT {', '.join(cols)} FROM patients {where} ORDER BY patient_id LIMIT ?", params + [page_size + 1]
+
+def _count_patients_query(**filters):
+    clauses, params = _patient_filters(**filters)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return f"SELECT COUNT(*) FROM patients {where}", params
+
+@timed()
+@with_busy_retry
+def fetch_patients_page(page_size=PAGE_SIZE, after_id=None, columns=None, **filters):
+    """Keyset-paginated patient query.
+
+    Returns (rows, next_cursor). Pass next_cursor back as after_id for the
+    following page; it is None once the last page has been returned.
+    """
+    sql, params = _patients_page_query(page_size, after_id, columns, **filters)
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = [dict(r) for r in cur.fetchall()]
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, rows[-1]["patient_id"]
+    return rows, None
+
+def iter_patient_pages(page_size=1000, columns=None, after_id=None, **filters):
+    """Yield successive pages of patients (after after_id) without holding the whole table in memory."""
+    while True:
+        rows, after_id = fetch_patients_page(page_size, after_id, columns, **filters)
+        if rows:
+            yield rows
+        if after_id is None:
+            return
+
+@timed()
+@with_busy_retry
+def count_patients(**filters):
+    sql, params = _count_patients_query(**filters)
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        return cur.fetchone()[0]
+
+def _retention_due_query(cutoff, limit):
+    return ("SELECT patient_id FROM patients WHERE retention_applied_at IS NULL AND date_added < ? "
+            "ORDER BY date_added LIMIT ?", [cutoff, limit])
+
+@timed()
+@with_busy_retry
+def fetch_retention_due(cutoff, limit):
+    """Ids of up to limit unredacted patients added before cutoff, oldest first.
+
+    Served by the partial index on date_added over unredacted rows; rows leave
+    the index as they are redacted, so repeated calls need no cursor.
+    """
+    with get_conn(readonly=True) as conn:
+        return [r[0] for r in conn.execute(*_retention_due_query(cutoff, limit))]
+
+@timed()
+@with_busy_retry
+def get_patient(patient_id):
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM patients WHERE patient_id = ?", (patient_id,))
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+# Bulk operations
+BULK_CHUNK_SIZE = 5000
+
+def _chunked(rows, size):
+    it = iter(rows)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+@timed()
+@with_busy_retry
+def _write_patient_chunk(sql, chunk, audit_entry, checkpoint):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.executemany(sql, chunk)
+        bump_table_versions_with(cur, "patients")
+        if audit_entry:
+            _insert_logs(cur, [(*audit_entry, f"ID:{row[-1]}") for row in chunk])
+            refresh_log_rollups_with(cur)
+        if checkpoint:
+            checkpoint(cur, chunk)
+
+@timed()
+def bulk_update_patients(columns, rows, chunk_size=BULK_CHUNK_SIZE, progress=None, audit=None, checkpoint=None):
+    """Run UPDATE patients SET <columns> for many rows, one transaction per chunk.
+
+    rows is any iterable (it is consumed lazily) of tuples holding the new
+    column values followed by the patient_id. audit, if given, is
+    (user_id, username, role, action): a matching "ID:<patient_id>" log entry
+    is written per row in the same transaction. checkpoint(cursor, chunk), if
+    given, runs inside each chunk's transaction so resumable jobs can record
+    progress atomically with the data. progress(done) is called after each
+    chunk commits. Returns the number of rows written.
+    """
+    unknown = set(columns) - (set(PATIENT_COLUMNS) - {"patient_id"})
+    if not columns or unknown:
+        raise ValueError(f"Invalid patient columns for bulk update: {sorted(unknown) or columns}")
+    sql = f"UPDATE patients SET {', '.join(f'{c} = ?' for c in columns)} WHERE patient_id = ?"
+    done = 0
+    for chunk in _chunked(rows, chunk_size):
+        _write_patient_chunk(sql, chunk, audit_entry=audit, checkpoint=checkpoint)
+        done += len(chunk)
+        if progress:
+            progress(done)
+    return done
+
+class PseudonymCollision(ValueError):
+    """Two different names would share one ANON_ pseudonym."""
+
+def _pseudonym_collision_query(pairs):
+    values = ", ".join("(?, ?)" for _ in pairs)
+    sql = f"""
+        WITH written(pseudonym, digest) AS (VALUES {values})
+        SELECT pseudonym FROM written
+        WHERE EXISTS (SELECT 1 FROM patients WHERE anonymized_name = written.pseudonym AND name_digest < written.digest)
+           OR EXISTS (SELECT 1 FROM patients WHERE anonymized_name = written.pseudonym AND name_digest > written.digest)
+        LIMIT 1
+    """
+    return sql, [v for pair in pairs for v in pair]
+
+def _check_pseudonym_collisions(cur, pairs, batch=400):
+    """Raise PseudonymCollision if any (pseudonym, digest) is already stored with another digest.
+
+    Two index seeks per distinct pseudonym on idx_patients_pseudonym, however many rows share it.
+    """
+    pairs = sorted({(p, d) for p, d in pairs if p and d})
+    for start in range(0, len(pairs), batch):
+        row = cur.execute(*_pseudonym_collision_query(pairs[start:start + batch])).fetchone()
+        if row:
+            raise PseudonymCollision(f"Pseudonym {row[0]} would stand for two different names; "
+                                     "raise PSEUDONYM_LENGTH and re-run anonymize with --reprocess-all")
+
+PSEUDONYM_COLUMNS = ["anonymized_name", "anonymized_contact", "name_digest", "anonymized_version"]
+
+@timed()
+def store_pseudonyms(rows, chunk_size=BULK_CHUNK_SIZE, progress=None, audit=None, checkpoint=None):
+    """bulk_update_patients for PSEUDONYM_COLUMNS rows, rejecting pseudonym collisions.
+
+    rows are (anonymized_name, anonymized_contact, name_digest, anonymized_version, patient_id).
+    The collision check runs inside each chunk's transaction, after the chunk is
+    written, so clashes within the chunk are caught too and nothing is committed.
+    """
+    def guarded(cur, chunk):
+        _check_pseudonym_collisions(cur, [(r[0], r[2]) for r in chunk])
+        if checkpoint:
+            checkpoint(cur, chunk)
+    return bulk_update_patients(PSEUDONYM_COLUMNS, rows, chunk_size, progress, audit, guarded)
+
+# Blind indexes (see utils.blind_index)
+def replace_name_terms_with(cur, entries):
+    """Replace the name search terms of (patient_id, terms) entries using an open cursor."""
+    entries = list(entries)
+    cur.executemany("DELETE FROM patient_name_terms WHERE patient_id = ?", [(pid,) for pid, _ in entries])
+    cur.executemany("INSERT OR IGNORE INTO patient_name_terms (term, patient_id) VALUES (?, ?)",
+                    [(term, pid) for pid, terms in entries for term in terms])
+
+def _store_blind_indexes_with(cur, entries):
+    """Write (patient_id, name_bidx, contact_bidx, name_terms) entries; name_terms None keeps the stored terms."""
+    cur.executemany("UPDATE patients SET name_bidx = ?, contact_bidx = ? WHERE patient_id = ?",
+                    [(name_bidx, contact_bidx, pid) for pid, name_bidx, contact_bidx, _ in entries])
+    replace_name_terms_with(cur, [(pid, terms) for pid, _, _, terms in entries if terms is not None])
+
+def write_blind_index_with(cur, rows):
+    """Recompute the blind indexes of (patient_id, name, contact) rows using an open cursor."""
+    rows = list(rows)
+    indexes = blind_indexes([r[1] for r in rows], [r[2] for r in rows])
+    _store_blind_indexes_with(cur, [(r[0], *index) for r, index in zip(rows, indexes)])
+
+@timed()
+def store_encrypted(rows, chunk_size=BULK_CHUNK_SIZE, progress=None, audit=None, checkpoint=None):
+    """bulk_update_patients for the ciphertext columns that also writes changed blind indexes.
+
+    rows are (encrypted_name, encrypted_contact, encrypted_version, patient_id, blind_index), where
+    blind_index is (name_bidx, contact_bidx, name_terms) from utils.blind_index, or None when the
+    stored one is current; name_terms None likewise keeps the stored terms. Rewriting an
+    unchanged indexed value costs as much as changing it, hence the Nones. Everything for a
+    chunk is written in its transaction.
+    """
+    pending = {}  # patient_id -> blind_index for the chunk in flight; kept until it commits, for busy retries
+
+    def values():
+        for *row, index in rows:
+            if index is not None:
+                pending[row[-1]] = index
+            yield tuple(row)
+
+    def with_blind_indexes(cur, chunk):
+        ids = {r[-1] for r in chunk}
+        for pid in [pid for pid in pending if pid not in ids]:
+            del pending[pid]  # earlier chunks have committed
+        _store_blind_indexes_with(cur, [(r[-1], *pending[r[-1]]) for r in chunk if r[-1] in pending])
+        if checkpoint:
+            checkpoint(cur, chunk)
+    return bulk_update_patients(["encrypted_name", "encrypted_contact", "encrypted_version"], values(),
+                                chunk_size, progress, audit, with_blind_indexes)
+
 # Logs
-def add_log(user_id, username, role, action, details=""):
+def _insert_log_rows(cur, rows):
+    """Insert full (user_id, username, role, action, timestamp, details) rows using an open cursor."""
+    cur.executemany("""
+        INSERT INTO logs (user_id, username, role, action, timestamp, details)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
+    bump_table_versions_with(cur, "logs")
+
+def _insert_logs(cur, entries):
+    """Insert (user_id, username, role, action, details) tuples using an open cursor."""
     from datetime import datetime
+    ts = datetime.utcnow().isoformat()
+    _insert_log_rows(cur, [(*e[:4], ts, e[4]) for e in entries])
+
+@timed()
+@with_busy_retry
+def _write_log_batch(rows):
     with get_conn() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO logs (user_id, username, role, action, timestamp, details)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (user_id, username, role, action, datetime.utcnow().isoformat(), details))
+        _insert_log_rows(cur, rows)
+        refresh_log_rollups_with(cur)
 
-def fetch_logs(limit=500):
+def refresh_log_rollups_with(cur):
+    """Fold logs newer than the rollup watermark into the daily rollup tables.
+
+    Runs on the caller's cursor so it shares the log writer's transaction;
+    writers are serialised, so every log_id up to MAX(log_id) is visible here.
+    Outside a transaction (catch-up callers) it takes the write lock first, so no
+    other writer can fold the same range between reading the watermark and moving it.
+    The caller commits.
+    """
+    if not cur.connection.in_transaction:
+        cur.execute("BEGIN IMMEDIATE")
+    row = cur.execute("SELECT last_log_id FROM log_rollup_state WHERE id = 1").fetchone()
+    if row is None:
+        return 0  # state row missing; db_setup.ensure_db creates it
+    last = row[0] or 0
+    newest = cur.execute("SELECT COALESCE(MAX(log_id), 0) FROM logs").fetchone()[0]
+    if newest <= last:
+        return 0
+    cur.execute("""
+        INSERT INTO log_rollup_daily_action (day, action, count)
+        SELECT substr(timestamp, 1, 10), COALESCE(action, ''), COUNT(*)
+        FROM logs WHERE log_id > ? AND log_id <= ?
+        GROUP BY 1, 2
+        ON CONFLICT(day, action) DO UPDATE SET count = count + excluded.count
+    """, (last, newest))
+    cur.execute("""
+        INSERT INTO log_rollup_daily_user (day, username, count)
+        SELECT substr(timestamp, 1, 10), COALESCE(username, ''), COUNT(*)
+        FROM logs WHERE log_id > ? AND log_id <= ?
+        GROUP BY 1, 2
+        ON CONFLICT(day, username) DO UPDATE SET count = count + excluded.count
+    """, (last, newest))
+    cur.execute("UPDATE log_rollup_state SET last_log_id = ? WHERE id = 1", (newest,))
+    return newest - last
+
+@timed()
+@with_busy_retry
+def refresh_log_rollups():
+    """Catch-up job: bring the rollups up to date with the logs table."""
+    with get_conn() as conn:
+        return refresh_log_rollups_with(conn.cursor())
+
+# add_log goes through a buffered writer; see audit.py for the AUDIT_MODE guarantees
+audit_writer = audit.AuditWriter(_write_log_batch)
+audit.register_shutdown_flush(audit_writer)
+
+@timed()
+@with_busy_retry
+def add_logs(entries):
+    """Insert many (user_id, username, role, action, details) log entries in one transaction."""
     with get_conn() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT * FROM logs ORDER BY log_id DESC LIMIT ?", (limit,))
+        _insert_logs(cur, entries)
+        refresh_log_rollups_with(cur)
+
+@timed()
+def add_log(user_id, username, role, action, details=""):
+    """Record an audit entry. The timestamp is taken now, even if the write is deferred."""
+    from datetime import datetime
+    audit_writer.submit((user_id, username, role, action, datetime.utcnow().isoformat(), details))
+
+@timed()
+def flush_logs(timeout=5.0):
+    """Wait until every queued audit entry is in the database."""
+    return audit_writer.flush(timeout)
+
+@timed()
+def fetch_logs(limit=500):
+    """Newest log entries first."""
+    return fetch_logs_page(limit)[0]
+
+def _log_filters(action=None, username=None, role=None, start_day=None, end_day=None):
+    """WHERE fragment for the log filters; start_day/end_day are inclusive YYYY-MM-DD dates."""
+    from datetime import date, timedelta
+    clauses, params = [], []
+    for column, value in (("action", action), ("username", username), ("role", role)):
+        if value:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if start_day:
+        clauses.append("timestamp >= ?")
+        params.append(start_day)
+    if end_day:
+        clauses.append("timestamp < ?")
+        params.append((date.fromisoformat(end_day) + timedelta(days=1)).isoformat())
+    return clauses, params
+
+def _logs_page_query(page_size=PAGE_SIZE, before=None, **filters):
+    clauses, params = _log_filters(**filters)
+    if before is not None:
+        # Row-value keyset on (timestamp, log_id); served by the logs(..., timestamp) indexes
+        clauses.append("(timestamp, log_id) < (?, ?)")
+        params.extend(before)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return (f"SELECT * FROM logs {where} ORDER BY timestamp DESC, log_id DESC LIMIT ?",
+            params + [page_size + 1])
+
+@timed()
+@with_busy_retry
+def fetch_logs_page(page_size=PAGE_SIZE, before=None, **filters):
+    """Keyset-paginated audit log, newest first.
+
+    Filters: action, username, role, start_day, end_day. Returns (rows,
+    next_cursor); pass next_cursor back as before= for the next (older) page.
+    """
+    sql, params = _logs_page_query(page_size, before, **filters)
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = [dict(r) for r in cur.fetchall()]
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, (rows[-1]["timestamp"], rows[-1]["log_id"])
+    return rows, None
+
+@timed()
+@with_busy_retry
+def count_logs(action=None, username=None, role=None, start_day=None, end_day=None):
+    """Number of log entries matching the filters.
+
+    Answered from the daily rollups unless the filters need the raw table
+    (role, or action and username together), in which case the count is
+    served by an index range.
+    """
+    if not role and not (action and username):
+        if username:
+            table, column, value = "log_rollup_daily_user", "username", username
+        else:
+            table, column, value = "log_rollup_daily_action", "action", action
+        clauses, params = ["day >= ?", "day <= ?"], [start_day or "", end_day or "9999-12-31"]
+        if value:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+        sql = f"SELECT COALESCE(SUM(count), 0) FROM {table} WHERE {' AND '.join(clauses)}"
+    else:
+        clauses, params = _log_filters(action, username, role, start_day, end_day)
+        sql = f"SELECT COUNT(*) FROM logs WHERE {' AND '.join(clauses)}"
+    with get_conn(readonly=True) as conn:
+        return conn.execute(sql, params).fetchone()[0]
+
+@timed()
+@with_busy_retry
+def fetch_log_actions():
+    """Distinct action names, from the (small) rollup table."""
+    with get_conn(readonly=True) as conn:
+        return [r[0] for r in conn.execute("SELECT DISTINCT action FROM log_rollup_daily_action ORDER BY action")]
+
+# Activity rollups
+@timed()
+@with_busy_retry
+def fetch_activity_by_day(start_day=None):
+    """[(day, action, count)] from the rollup table, optionally from start_day (YYYY-MM-DD) on."""
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT day, action, count FROM log_rollup_daily_action
+            WHERE day >= ? ORDER BY day
+        """, (start_day or "",))
         return [dict(r) for r in cur.fetchall()]
 
+@timed()
+@with_busy_retry
+def fetch_activity_by_user(start_day=None):
+    """[(username, actions)] summed from the per-day user rollup, busiest first."""
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT username, SUM(count) AS actions FROM log_rollup_daily_user
+            WHERE day >= ? GROUP BY username ORDER BY actions DESC
+        """, (start_day or "",))
+        return [dict(r) for r in cur.fetchall()]
+
+# Change tracking
+# Read-cache versions (data_cache.py). Bumped once per write transaction rather than by
+# per-row triggers, which doubled the cost of bulk chunks. Every write to a versioned table
+# must call this in its transaction: the helpers in this module do, and so do the raw
+# writers in db_setup.py, seed_data.py and benchmark.py.
+def bump_table_versions_with(cur, *tables):
+    """Bump the table_versions counters of tables (db_setup.VERSIONED_TABLES) using an open cursor."""
+    cur.executemany("UPDATE table_versions SET version = version + 1 WHERE table_name = ?", [(t,) for t in tables])
+
+@timed()
+@with_busy_retry
+def fetch_table_versions():
+    """{table: version} counters bumped by every write transaction (see bump_table_versions_with)."""
+    with get_conn(readonly=True) as conn:
+        return {r[0]: r[1] for r in conn.execute("SELECT table_name, version FROM table_versions")}
+
+# Query plan checks
+def query_plan_checks():
+    """(name, sql, params, allow_scan) for the queries the dashboard runs on large tables.
+
+    allow_scan marks queries that walk a b-tree in order under a LIMIT (e.g.
+    newest-N logs) and therefore stop early even though EXPLAIN reports SCAN.
+    fetch_users and fetch_patients are whole-table reads by design and are not listed.
+    """
+    cutoff = "2025-01-01T00:00:00"
+    return [
+        ("get_user_by_username", "SELECT user_id, username, password_hash, role FROM users WHERE username = ?", ["admin"], False),
+        ("check_consent", "SELECT consent_given FROM users WHERE user_id = ?", [1], False),
+        ("get_user_by_id", "SELECT user_id, username, role, consent_given, consent_date FROM users WHERE user_id = ?", [1], False),
+        ("get_patient", "SELECT * FROM patients WHERE patient_id = ?", [1], False),
+        ("fetch_patients_page", *_patients_page_query(after_id=100), False),
+        ("fetch_patients_page first page", *_patients_page_query(), True),
+        ("fetch_patients_page date range", *_patients_page_query(added_from=cutoff, added_to=cutoff), False),
+        ("fetch_patients_page stale encrypted", *_patients_page_query(stale="encrypted"), False),
+        ("fetch_patients_page stale anonymized", *_patients_page_query(stale="anonymized"), False),
+        ("fetch_patients_page pseudonym", *_patients_page_query(pseudonym="ANON_0"), False),
+        ("pseudonym collision check", *_pseudonym_collision_query([("ANON_0", "0")]), False),
+        ("fetch_patients_page name search", *_patients_page_query(name_terms=[1, 2]), False),
+        ("count_patients name search", *_count_patients_query(name_terms=[1, 2]), False),
+        ("fetch_patients_page exact name", *_patients_page_query(name_bidx=1), False),
+        ("fetch_patients_page contact", *_patients_page_query(contact_bidx=1), False),
+        ("name terms by patient", "SELECT term FROM patient_name_terms WHERE patient_id = ?", [1], False),
+        ("count_patients retention due", *_count_patients_query(added_to=cutoff, retained=False), False),
+        ("fetch_retention_due", *_retention_due_query(cutoff, 1000), False),
+        ("count_patients stale encrypted", *_count_patients_query(stale="encrypted"), False),
+        ("fetch_logs_page first page", *_logs_page_query(), True),
+        ("fetch_logs_page", *_logs_page_query(before=(cutoff, 100)), False),
+        ("fetch_logs_page action", *_logs_page_query(before=(cutoff, 100), action="login"), False),
+        ("fetch_logs_page username", *_logs_page_query(before=(cutoff, 100), username="admin"), False),
+        ("fetch_logs_page time range", *_logs_page_query(start_day="2025-01-01", end_day="2025-01-31"), False),
+        ("fetch_logs_page role", *_logs_page_query(role="admin"), False),
+        ("count_logs role", "SELECT COUNT(*) FROM logs WHERE role = ?", ["admin"], False),
+        ("rollup watermark range", "SELECT COUNT(*) FROM logs WHERE log_id > ? AND log_id <= ?", [0, 100], False),
+        ("activity by day", "SELECT day, action, count FROM log_rollup_daily_action WHERE day >= ? ORDER BY day", ["2025-01-01"], False),
+    ]
+
+def plan_full_scans(conn, sql, params=()):
+    """EXPLAIN QUERY PLAN details of sql that read a whole table without an index."""
+    # Scans of CTEs and VALUES lists are fine; only real tables count
+    tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    details = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+    return [d for d in details if d.startswith("SCAN ") and " USING " not in d and d.split()[1] in tables]
+
+def find_full_scans(conn=None):
+    """Run EXPLAIN QUERY PLAN over query_plan_checks() and return [(name, plan_detail)] for full table scans."""
+    def scans(c):
+        return [(name, detail) for name, sql, params, allow_scan in query_plan_checks() if not allow_scan
+                for detail in plan_full_scans(c, sql, params)]
+    if conn is not None:
+        return scans(conn)
+    with get_conn(readonly=True) as c:
+        return scans(c)
+
 # Consent Management
+@timed()
+@with_busy_retry
 def check_consent(user_id):
     """Check if user has already given GDPR consent."""
-    with get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.cursor()
         cur.execute("SELECT consent_given FROM users WHERE user_id = ?", (user_id,))
         row = cur.fetchone()
         return bool(row['consent_given']) if row else False
 
+# Bumped by set_consent; sessions holding a cached profile re-read it when this changes
+_consent_generation = 0
+
+def consent_generation():
+    return _consent_generation
+
+@timed()
+@with_busy_retry
 def set_consent(user_id, username, role, consent=True):
     """Set GDPR consent status for user and log the action."""
+    global _consent_generation
     from datetime import datetime
     with get_conn() as conn:
         cur = conn.cursor()
@@ -88,6 +898,8 @@ def set_consent(user_id, username, role, consent=True):
             "UPDATE users SET consent_given = ?, consent_date = ? WHERE user_id = ?",
             (1 if consent else 0, datetime.utcnow().isoformat() if consent else None, user_id)
         )
+        bump_table_versions_with(cur, "users")
+    _consent_generation += 1
     # Log the action
     add_log(user_id, username, role, "consent_given" if consent else "consent_declined", 
             f"User {'accepted' if consent else 'declined'} GDPR consent")
@@ -3,15 +3,62 @@ import sqlite3
 from datetime import datetime
 import os
 import hashlib
+from db import apply_storage_profile
 
 DB_PATH = "hospital.db"
 
 def hash_password(password: str, salt: str = "static_salt_for_demo") -> str:
     return hashlib.sha256((salt + password).encode()).hexdigest()
 
-def ensure_db():
-    need_seed = not os.path.exists(DB_PATH)
+# (index name, "table(columns)"). users(username) is already covered by the
+# UNIQUE constraint's automatic index, so it is not duplicated here.
+INDEXES = [
+    ("idx_logs_action_timestamp", "logs(action, timestamp)"),
+    ("idx_logs_username_timestamp", "logs(username, timestamp)"),
+    ("idx_logs_timestamp", "logs(timestamp)"),
+    ("idx_logs_role_timestamp", "logs(role, timestamp)"),
+    ("idx_patients_date_added", "patients(date_added)"),
+    ("idx_patients_pseudonym", "patients(anonymized_name, name_digest)"),
+    ("idx_patients_name_bidx", "patients(name_bidx)"),
+    ("idx_patients_contact_bidx", "patients(contact_bidx)"),
+    ("idx_name_terms_patient", "patient_name_terms(patient_id)"),
+    ("idx_jobs_status", "jobs(status, job_id)"),
+]
+# Superseded indexes dropped on upgrade (logs(username) -> logs(username, timestamp))
+RETIRED_INDEXES = ["idx_logs_username"]
+
+# Partial indexes over rows whose derived columns are out of date; the predicates
+# match db.STALE_PREDICATES so the stale= filters can use them
+PENDING_INDEXES = {
+    "idx_patients_encrypt_pending":
+        "(encrypted_version IS NULL OR encrypted_version < pii_version) AND retention_applied_at IS NULL",
+    "idx_patients_anonymize_pending":
+        "(anonymized_version IS NULL OR anonymized_version < pii_version) AND retention_applied_at IS NULL",
+}
+
+# Tables whose writes bump table_versions (read-cache invalidation, db.bump_table_versions_with)
+VERSIONED_TABLES = ["patients", "logs", "users"]
+
+def check_query_plans():
+    """Fail loudly if any checked db.py query plans a full table scan."""
+    from db import find_full_scans
     conn = sqlite3.connect(DB_PATH)
+    try:
+        problems = find_full_scans(conn)
+    finally:
+        conn.close()
+    for name, detail in problems:
+        print(f"FULL SCAN in {name}: {detail}")
+    if not problems:
+        print("Query plans OK: no full table scans.")
+    return not problems
+
+def ensure_db(db_path=None):
+    """Create or migrate the database at db_path (default DB_PATH); seed demo data if it is new."""
+    db_path = db_path or DB_PATH
+    need_seed = not os.path.exists(db_path)
+    conn = sqlite3.connect(db_path)
+    apply_storage_profile(conn)  # switches the file to WAL so readers don't block on writers
     c = conn.cursor()
 
     # users table
@@ -37,10 +84,26 @@ def ensure_db():
         anonymized_contact TEXT,
         encrypted_name TEXT,
         encrypted_contact TEXT,
-        date_added TEXT
+        date_added TEXT,
+        pii_version INTEGER DEFAULT 1,
+        encrypted_version INTEGER DEFAULT NULL,
+        anonymized_version INTEGER DEFAULT NULL,
+        retention_applied_at TEXT DEFAULT NULL,
+        name_digest TEXT DEFAULT NULL,
+        name_bidx INTEGER DEFAULT NULL,
+        contact_bidx INTEGER DEFAULT NULL
     );
     """)
 
+    # blind-index search terms: one row per name word / word prefix hash and patient
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS patient_name_terms (
+        term INTEGER NOT NULL,
+        patient_id INTEGER NOT NULL,
+        PRIMARY KEY (term, patient_id)
+    ) WITHOUT ROWID;
+    """)
+
     # logs table
     c.execute("""
     CREATE TABLE IF NOT EXISTS logs (
@@ -54,6 +117,83 @@ def ensure_db():
     );
     """)
 
+    # activity rollups: log counts per day x action and per day x user, kept
+    # current by db.refresh_log_rollups from the last_log_id watermark
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS log_rollup_daily_action (
+        day TEXT,
+        action TEXT,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (day, action)
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS log_rollup_daily_user (
+        day TEXT,
+        username TEXT,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (day, username)
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS log_rollup_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_log_id INTEGER DEFAULT 0
+    );
+    """)
+    c.execute("INSERT OR IGNORE INTO log_rollup_state (id, last_log_id) VALUES (1, 0)")
+
+    # key rotation progress (see key_rotation.py)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS key_rotations (
+        rotation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key_fingerprint TEXT,
+        status TEXT,
+        last_patient_id INTEGER DEFAULT 0,
+        rotated INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        started_at TEXT,
+        updated_at TEXT,
+        finished_at TEXT
+    );
+    """)
+
+    # retention engine runs (see retention.py)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS retention_runs (
+        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        trigger TEXT,
+        cutoff TEXT,
+        status TEXT,
+        processed INTEGER DEFAULT 0,
+        seconds REAL,
+        rows_per_sec REAL,
+        error TEXT,
+        started_at TEXT,
+        finished_at TEXT
+    );
+    """)
+
+    # background jobs (see jobs.py)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        params TEXT,
+        status TEXT NOT NULL,
+        total INTEGER DEFAULT 0,
+        done INTEGER DEFAULT 0,
+        last_patient_id INTEGER DEFAULT 0,
+        owner TEXT,
+        error TEXT,
+        created_by TEXT,
+        created_at TEXT,
+        started_at TEXT,
+        updated_at TEXT,
+        finished_at TEXT
+    );
+    """)
+
     conn.commit()
 
     # Migration: Add consent columns if they don't exist
@@ -67,6 +207,102 @@ def ensure_db():
     except sqlite3.OperationalError:
         pass  # Column already exists
 
+    # Migration: per-row change tracking so encrypt/anonymize only touch dirty rows.
+    # pii_version is bumped whenever name/contact change; encrypted_version and
+    # anonymized_version record which pii_version the derived columns were built from.
+    for column in ("pii_version INTEGER DEFAULT 1",
+                   "encrypted_version INTEGER DEFAULT NULL",
+                   "anonymized_version INTEGER DEFAULT NULL"):
+        try:
+            c.execute(f"ALTER TABLE patients ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+
+    # Migration: retention_applied_at marks rows the retention engine has redacted.
+    # Rows redacted by the old manual "Process Now" are recognised by their markers.
+    try:
+        c.execute("ALTER TABLE patients ADD COLUMN retention_applied_at TEXT DEFAULT NULL")
+        c.execute("""
+            UPDATE patients SET retention_applied_at = ?
+            WHERE name = 'ARCHIVED' AND anonymized_name = 'REDACTED'
+        """, (datetime.utcnow().isoformat(),))
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+    # Migration: keyed pseudonyms (utils.PSEUDONYM_KEY_FILE) replace the unsalted sha256 ones.
+    # name_digest holds the full HMAC for collision checks. Old pseudonyms are cleared and
+    # marked stale, so views re-derive them and the next anonymize job stores the new ones.
+    try:
+        c.execute("ALTER TABLE patients ADD COLUMN name_digest TEXT DEFAULT NULL")
+        c.execute("""
+            UPDATE patients SET anonymized_name = NULL, anonymized_version = NULL
+            WHERE retention_applied_at IS NULL AND anonymized_name IS NOT NULL
+        """)
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+    # Migration: blind indexes (utils.BLIND_INDEX_KEY_FILE) for search over encrypted names and
+    # contacts. They are built with the ciphertext, so encrypted rows are marked stale and the
+    # next Encrypt All indexes them.
+    try:
+        c.execute("ALTER TABLE patients ADD COLUMN name_bidx INTEGER DEFAULT NULL")
+        c.execute("ALTER TABLE patients ADD COLUMN contact_bidx INTEGER DEFAULT NULL")
+        c.execute("""
+            UPDATE patients SET encrypted_version = NULL
+            WHERE retention_applied_at IS NULL AND encrypted_version IS NOT NULL
+        """)
+    except sqlite3.OperationalError:
+        pass  # Columns already exist
+
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS patients_pii_version
+    AFTER UPDATE OF name, contact ON patients
+    WHEN OLD.name IS NOT NEW.name OR OLD.contact IS NOT NEW.contact
+    BEGIN
+        UPDATE patients SET pii_version = COALESCE(OLD.pii_version, 1) + 1
+        WHERE patient_id = NEW.patient_id;
+    END;
+    """)
+
+    # Per-table change counters for the dashboard's read cache (data_cache.py), bumped once
+    # per write transaction by db.bump_table_versions_with. They used to be bumped by per-row
+    # triggers, which doubled the cost of bulk chunks; those triggers are dropped on upgrade.
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS table_versions (
+        table_name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+    for table in VERSIONED_TABLES:
+        c.execute("INSERT OR IGNORE INTO table_versions (table_name, version) VALUES (?, 0)", (table,))
+        for event in ("insert", "update", "delete"):
+            c.execute(f"DROP TRIGGER IF EXISTS {table}_{event}_version")
+
+    # Managed secondary indexes for the Logs, Activity, Retention and search views
+    for name in RETIRED_INDEXES:
+        c.execute(f"DROP INDEX IF EXISTS {name}")
+    for name, sql in INDEXES:
+        c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {sql}")
+
+    # Partial indexes holding only the dirty rows, so "what needs work" is O(changes).
+    # Redaction changes name, which bumps pii_version, so redacted rows are kept out
+    # explicitly; indexes created before that condition existed are rebuilt.
+    for name, predicate in PENDING_INDEXES.items():
+        sql = c.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone()
+        if sql and "retention_applied_at" not in sql[0]:
+            c.execute(f"DROP INDEX {name}")
+        c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON patients(patient_id) WHERE {predicate}")
+    # Unredacted rows by age: the retention engine takes the oldest due rows from here
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_patients_retention_due ON patients(date_added)
+    WHERE retention_applied_at IS NULL
+    """)
+
+    conn.commit()
+
+    # Catch-up: fold any logs written before the rollups existed
+    from db import refresh_log_rollups_with, write_blind_index_with
+    refresh_log_rollups_with(c)
     conn.commit()
 
     # seed default users only if fresh DB
@@ -93,12 +329,20 @@ def ensure_db():
             INSERT INTO patients (name, contact, diagnosis, anonymized_name, anonymized_contact, encrypted_name, encrypted_contact, date_added)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             """, p)
+            write_blind_index_with(c, [(c.lastrowid, p[0], p[1])])
 
         conn.commit()
         print("Seeded database with sample users and patients.")
 
+    # Migrations and seeding write outside db.py's helpers; drop whatever a running app has cached
+    from db import bump_table_versions_with
+    bump_table_versions_with(c, *VERSIONED_TABLES)
+    conn.commit()
     conn.close()
-    print(f"Database file: {DB_PATH} created/updated.")
+    print(f"Database file: {db_path} created/updated.")
 
 if __name__ == "__main__":
+    import sys
     ensure_db()
+    if "--check-plans" in sys.argv and not check_query_plans():
+        sys.exit(1)
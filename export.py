@@ -0,0 +1,199 @@
+# export.py
+"""
+Streaming exports of patients and audit logs.
+
+Rows are read from the database in keyset pages, transformed one chunk at a
+time (decrypt, or anonymize names and mask contacts) and written
+incrementally, so memory stays bounded by the chunk size rather than the
+table size. CSV is always available; Parquet and Arrow IPC need pyarrow
+(installed with Streamlit).
+
+    python export.py patients patients.csv --mode anonymized
+    python export.py patients patients.parquet --format parquet --mode decrypted
+    python export.py logs audit.arrow --format arrow --action login
+"""
+import argparse
+import csv
+import getpass
+import io
+
+from db import iter_patient_pages, fetch_logs_page, add_log, flush_logs
+from utils import anonymize_names, mask_contacts, decrypt_many
+
+EXPORT_CHUNK_SIZE = 5000
+PATIENT_EXPORT_COLUMNS = ["patient_id", "name", "contact", "diagnosis", "date_added"]
+LOG_EXPORT_COLUMNS = ["log_id", "timestamp", "user_id", "username", "role", "action", "details"]
+PATIENT_MODES = ("anonymized", "decrypted")
+FORMATS = ("csv", "parquet", "arrow")
+INTEGER_COLUMNS = {"patient_id", "log_id", "user_id"}
+MIME_TYPES = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+}
+
+# ---------------------------------------------------------------- readers
+
+def transform_patients(rows, mode="anonymized", engine=None):
+    """Return export rows for one chunk of patient dicts.
+
+    anonymized: stored pseudonyms, or anonymize_names/mask_contacts of the plaintext.
+    decrypted: decrypted encrypted_name/encrypted_contact, falling back to the stored value.
+    engine: optional crypto_engine.ParallelCrypto for the decrypt pass.
+    """
+    if mode not in PATIENT_MODES:
+        raise ValueError(f"Unknown export mode: {mode}")
+    out = []
+    if mode == "decrypted":
+        decrypt = engine.decrypt if engine else decrypt_many
+        names, _ = decrypt([r.get("encrypted_name") for r in rows])
+        contacts, _ = decrypt([r.get("encrypted_contact") for r in rows])
+        for r, name, contact in zip(rows, names, contacts):
+            out.append({
+                "patient_id": r["patient_id"],
+                "name": name if name is not None else r.get("name"),
+                "contact": contact if contact is not None else r.get("contact"),
+                "diagnosis": r.get("diagnosis"),
+                "date_added": r.get("date_added"),
+            })
+    else:
+        names = anonymize_names([r.get("name") for r in rows])
+        contacts = mask_contacts([r.get("contact") for r in rows])
+        for r, name, contact in zip(rows, names, contacts):
+            out.append({
+                "patient_id": r["patient_id"],
+                "name": r.get("anonymized_name") or name,
+                "contact": r.get("anonymized_contact") or contact,
+                "diagnosis": r.get("diagnosis"),
+                "date_added": r.get("date_added"),
+            })
+    return out
+
+def iter_patient_export(mode="anonymized", chunk_size=EXPORT_CHUNK_SIZE, engine=None, **filters):
+    """Yield transformed chunks of patients (lists of dicts)."""
+    columns = ["name", "contact", "diagnosis", "date_added"]
+    columns += ["encrypted_name", "encrypted_contact"] if mode == "decrypted" else ["anonymized_name", "anonymized_contact"]
+    for page in iter_patient_pages(chunk_size, columns=columns, **filters):
+        yield transform_patients(page, mode, engine)
+
+def iter_log_export(chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    """Yield chunks of log dicts, newest first, using the same filters as the Logs tab."""
+    cursor = None
+    while True:
+        rows, cursor = fetch_logs_page(chunk_size, cursor, **filters)
+        if rows:
+            yield rows
+        if cursor is None:
+            return
+
+# ---------------------------------------------------------------- writers
+
+def _open_binary(out):
+    """Return (file, should_close) for a path or an already-open binary file."""
+    if isinstance(out, (str, bytes)) or hasattr(out, "__fspath__"):
+        return open(out, "wb"), True
+    return out, False
+
+def write_csv(chunks, columns, out, progress=None):
+    """Write chunks of dicts as CSV, one writerows call per chunk. Returns the row count."""
+    f, should_close = _open_binary(out)
+    text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+    count = 0
+    try:
+        writer = csv.DictWriter(text, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        for chunk in chunks:
+            writer.writerows(chunk)
+            count += len(chunk)
+            if progress:
+                progress(count)
+        text.flush()
+    finally:
+        text.detach()  # leave the underlying file open for the caller
+        if should_close:
+            f.close()
+    return count
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise ValueError("Parquet/Arrow export requires pyarrow (pip install pyarrow)")
+
+def _write_arrow_batches(chunks, columns, out, open_writer, progress=None):
+    """Write each chunk as its own record batch / row group so only one chunk is held in memory."""
+    pa = _require_pyarrow()
+    schema = pa.schema([(c, pa.int64() if c in INTEGER_COLUMNS else pa.string()) for c in columns])
+    f, should_close = _open_binary(out)
+    count = 0
+    writer = open_writer(f, schema)
+    try:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pylist([{c: r.get(c) for c in columns} for r in chunk], schema=schema))
+            count += len(chunk)
+            if progress:
+                progress(count)
+    finally:
+        writer.close()
+        if should_close:
+            f.close()
+    return count
+
+def write_parquet(chunks, columns, out, progress=None):
+    _require_pyarrow()
+    import pyarrow.parquet as pq
+    return _write_arrow_batches(chunks, columns, out, lambda f, schema: pq.ParquetWriter(f, schema), progress)
+
+def write_arrow(chunks, columns, out, progress=None):
+    pa = _require_pyarrow()
+    return _write_arrow_batches(chunks, columns, out, lambda f, schema: pa.ipc.new_file(f, schema), progress)
+
+WRITERS = {"csv": write_csv, "parquet": write_parquet, "arrow": write_arrow}
+
+# ---------------------------------------------------------------- entry points
+
+def export_patients(out, fmt="csv", mode="anonymized", chunk_size=EXPORT_CHUNK_SIZE, progress=None, engine=None, **filters):
+    """Stream patients to out (path or binary file). Returns the number of rows written."""
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    chunks = iter_patient_export(mode, chunk_size, engine, **filters)
+    return WRITERS[fmt](chunks, PATIENT_EXPORT_COLUMNS, out, progress)
+
+def export_logs(out, fmt="csv", chunk_size=EXPORT_CHUNK_SIZE, progress=None, **filters):
+    """Stream audit log entries to out (path or binary file). Returns the number of rows written."""
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    flush_logs()  # entries still in the audit queue belong in the export
+    return WRITERS[fmt](iter_log_export(chunk_size, **filters), LOG_EXPORT_COLUMNS, out, progress)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream patients or audit logs to CSV/Parquet/Arrow")
+    parser.add_argument("what", choices=["patients", "logs"])
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--mode", choices=PATIENT_MODES, default="anonymized", help="patients only")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    parser.add_argument("--action")
+    parser.add_argument("--username")
+    parser.add_argument("--role")
+    parser.add_argument("--start-day")
+    parser.add_argument("--end-day")
+    args = parser.parse_args(argv)
+
+    progress = lambda n: print(f"  {n:,} rows written", flush=True)
+    if args.what == "patients":
+        n = export_patients(args.path, args.format, args.mode, args.chunk_size, progress)
+    else:
+        filters = {k: v for k, v in (("action", args.action), ("username", args.username), ("role", args.role),
+                                     ("start_day", args.start_day), ("end_day", args.end_day)) if v}
+        n = export_logs(args.path, args.format, args.chunk_size, progress, **filters)
+    # Same audit entry as `cli.py export`; decrypted exports carry PII
+    add_log(None, f"cli:{getpass.getuser()}", "system", f"export_{args.what}",
+            f"{n} rows ({args.format}{', ' + args.mode if args.what == 'patients' else ''}) to {args.path}")
+    if not flush_logs():
+        raise SystemExit(f"Exported {n:,} rows to {args.path}, but the audit entry was not confirmed as written")
+    print(f"Exported {n:,} rows to {args.path}")
+
+if __name__ == "__main__":
+    main()
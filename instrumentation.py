@@ -0,0 +1,184 @@
+# instrumentation.py
+"""
+Lightweight timing for the dashboard's hot paths.
+
+    @timed()                        # db.py and utils.py functions
+    with span("page.patients"):     # blocks of the Streamlit script
+
+Every span adds its duration to process-wide totals (calls, total and max
+per name). Between start_rerun() and end_rerun() in one thread, which is one
+Streamlit script run, spans are also collected for that rerun. The rerun
+also counts the SQL statements executed on its connections, through a
+sqlite3 trace callback that db.py installs on a pooled connection only while
+a recording thread holds it, so background jobs do not pay for it. Statement
+text is never kept, because expanded SQL contains patient data. Time is
+split by span prefix (db, utils): only the outermost span of each prefix
+counts, so nested calls are not double-counted. What remains of the rerun
+is Streamlit, pandas and page code.
+
+end_rerun appends one JSON line per rerun to PERF_LOG. A session can also
+ask for a cProfile of its reruns. Reruns cut short by st.rerun() or st.stop()
+are not recorded.
+
+PERF_TRACE=0 turns spans into plain calls; PERF_LOG="" disables the file.
+"""
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+PERF_TRACE = os.environ.get("PERF_TRACE", "1") != "0"
+PERF_LOG = os.environ.get("PERF_LOG", "perf_log.jsonl")
+CATEGORIES = ("db", "utils")  # span prefixes reported as separate shares of a rerun
+PROFILE_TOP = 30              # functions kept from a cProfile run, by cumulative time
+
+_local = threading.local()
+_totals = {}  # name -> [calls, total seconds, max seconds]
+_totals_lock = threading.Lock()
+_log_lock = threading.Lock()
+
+def _enter(name):
+    category = name.split(".", 1)[0]
+    depth = getattr(_local, "depth", None)
+    if depth is None:
+        depth = _local.depth = {}
+    depth[category] = depth.get(category, 0) + 1
+    return category, time.perf_counter()
+
+def _exit(name, category, start):
+    seconds = time.perf_counter() - start
+    _local.depth[category] -= 1
+    with _totals_lock:
+        total = _totals.get(name)
+        if total is None:
+            total = _totals[name] = [0, 0.0, 0.0]
+        total[0] += 1
+        total[1] += seconds
+        total[2] = max(total[2], seconds)
+    rerun = getattr(_local, "rerun", None)
+    if rerun is not None:
+        calls_seconds = rerun["spans"].setdefault(name, [0, 0.0])
+        calls_seconds[0] += 1
+        calls_seconds[1] += seconds
+        if category in CATEGORIES and _local.depth[category] == 0:
+            rerun["categories"][category] += seconds
+
+@contextmanager
+def span(name):
+    """Time the block as name ("category.what")."""
+    if not PERF_TRACE:
+        yield
+        return
+    category, start = _enter(name)
+    try:
+        yield
+    finally:
+        _exit(name, category, start)
+
+def timed(name=None):
+    """Decorator: time every call as a span, named module.function by default."""
+    def decorator(func):
+        label = name or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PERF_TRACE:
+                return func(*args, **kwargs)
+            category, start = _enter(label)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _exit(label, category, start)
+        return wrapper
+    return decorator
+
+def is_recording():
+    """True if the calling thread is between start_rerun and end_rerun."""
+    return getattr(_local, "rerun", None) is not None
+
+def count_statement(statement):
+    """sqlite3 trace callback: count a statement against the calling thread's rerun."""
+    rerun = getattr(_local, "rerun", None)
+    if rerun is None or statement.startswith("--"):  # "-- TRIGGER ..." lines are part of their statement
+        return
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+    rerun["queries"] += 1
+    rerun["statements"][kind] = rerun["statements"].get(kind, 0) + 1
+
+# ---------------------------------------------------------------- reruns
+
+def start_rerun(profile=False):
+    """Start recording spans and statements for the calling thread, optionally under cProfile."""
+    rerun = {"at": datetime.utcnow().isoformat(), "start": time.perf_counter(), "spans": {},
+             "categories": dict.fromkeys(CATEGORIES, 0.0), "queries": 0, "statements": {}, "profiler": None}
+    if profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            rerun["profiler"] = profiler
+        except ValueError as e:  # another profiler is already active
+            logging.warning(f"Rerun profiling unavailable: {e}")
+    _local.rerun = rerun
+
+def end_rerun(**fields):
+    """Stop recording and return the rerun summary, also appended to PERF_LOG.
+
+    fields (session, role, tab, ...) are added to the summary as-is. Returns
+    None if this thread was not recording.
+    """
+    rerun = getattr(_local, "rerun", None)
+    if rerun is None:
+        return None
+    _local.rerun = None
+    total = time.perf_counter() - rerun["start"]
+    summary = {
+        "at": rerun["at"],
+        **fields,
+        "total_ms": round(1000 * total, 2),
+        **{f"{c}_ms": round(1000 * s, 2) for c, s in rerun["categories"].items()},
+        "other_ms": round(1000 * (total - sum(rerun["categories"].values())), 2),
+        "queries": rerun["queries"],
+        "statements": rerun["statements"],
+        "spans": {name: {"calls": calls, "ms": round(1000 * seconds, 3)}
+                  for name, (calls, seconds) in sorted(rerun["spans"].items(), key=lambda kv: -kv[1][1])},
+    }
+    profiler = rerun["profiler"]
+    if profiler is not None:
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        summary["profile"] = out.getvalue()
+    write_perf_log({k: v for k, v in summary.items() if k != "profile"})
+    return summary
+
+def write_perf_log(record):
+    """Append one JSON line to PERF_LOG; failures are logged, never raised."""
+    if not PERF_LOG:
+        return
+    try:
+        line = json.dumps(record, default=str)
+        with _log_lock, open(PERF_LOG, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        logging.error(f"Perf log write failed: {e}")
+
+# ---------------------------------------------------------------- totals
+
+def span_totals():
+    """Process-wide calls, total, mean and max per span, largest total first."""
+    with _totals_lock:
+        items = [(name, *t) for name, t in _totals.items()]
+    return [{"span": name, "calls": calls, "total_ms": round(1000 * total, 2),
+             "mean_ms": round(1000 * total / calls, 3), "max_ms": round(1000 * peak, 2)}
+            for name, calls, total, peak in sorted(items, key=lambda i: -i[2])]
+
+def reset_totals():
+    with _totals_lock:
+        _totals.clear()
@@ -0,0 +1,319 @@
+# jobs.py
+"""
+Background jobs for long-running bulk operations (anonymize, encrypt, retention).
+
+    python jobs.py submit anonymize      # queue a job
+    python jobs.py run                   # process queued and orphaned jobs, then exit (cron)
+    python jobs.py list
+    python jobs.py cancel 12
+
+Jobs are rows in the jobs table. A JobRunner thread claims one job at a time
+and runs the handler for its kind. Handlers stream patients in keyset pages
+and write each chunk through db.bulk_update_patients with a checkpoint that
+records last_patient_id and the running count in the same transaction, so a
+chunk is either fully applied and counted or not at all. A running job whose
+owner stops checkpointing for STALE_AFTER seconds (browser refresh, crash,
+server restart) is claimed again and continues after its checkpoint. Each
+claim gets a fresh owner token, and every checkpoint verifies it in the
+chunk's transaction. A runner that was only slow therefore rolls back its
+chunk and stops instead of writing alongside the new owner.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from db import get_conn, iter_patient_pages, store_encrypted, store_pseudonyms, count_patients, with_busy_retry
+from retention import run_retention, retention_cutoff
+from utils import name_digests, pseudonym_from_digest, mask_contacts, blind_indexes
+
+JOB_CHUNK_SIZE = 2000
+POLL_INTERVAL = 2.0    # seconds between checks for new jobs when idle
+STALE_AFTER = 60       # seconds without a checkpoint before a running job counts as orphaned
+ACTIVE_STATUSES = ("queued", "running", "cancel_requested")
+
+class JobCancelled(Exception):
+    pass
+
+class JobLost(Exception):
+    """Another runner claimed the job after this one went STALE_AFTER without a checkpoint."""
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+# ---------------------------------------------------------------- handlers
+#
+# Each kind has count(params) -> rows to process and run(job, checkpoint, audit) -> rows written.
+# run must resume from job["last_patient_id"] and pass checkpoint to bulk_update_patients.
+
+def _chunk_size(job):
+    return job["params"].get("chunk_size") or JOB_CHUNK_SIZE
+
+def _anonymize_filters(params):
+    return {} if params.get("reprocess_all") else {"stale": "anonymized"}
+
+def _run_anonymize(job, checkpoint, audit):
+    filters = _anonymize_filters(job["params"])
+
+    def rows():
+        for page in iter_patient_pages(_chunk_size(job), columns=["name", "contact", "pii_version"],
+                                       after_id=job["last_patient_id"], **filters):
+            digests = name_digests([p.get("name") for p in page])
+            contacts = mask_contacts([p.get("contact") for p in page])
+            for p, digest, contact in zip(page, digests, contacts):
+                yield pseudonym_from_digest(digest), contact, digest or None, p["pii_version"], p["patient_id"]
+
+    return store_pseudonyms(rows(), chunk_size=_chunk_size(job), audit=audit, checkpoint=checkpoint)
+
+def _encrypt_filters(params):
+    return {} if params.get("reprocess_all") else {"stale": "encrypted"}
+
+def _run_encrypt(job, checkpoint, audit):
+    from crypto_engine import ParallelCrypto
+    filters = _encrypt_filters(job["params"])
+
+    with ParallelCrypto(workers=job["params"].get("workers")) as engine:
+        def rows():
+            for page in iter_patient_pages(engine.batch_size, columns=["name", "contact", "pii_version", "name_bidx", "contact_bidx"],
+                                           after_id=job["last_patient_id"], **filters):
+                names, name_errors = engine.encrypt([p.get("name") or "" for p in page])
+                contacts, contact_errors = engine.encrypt([p.get("contact") or "" for p in page])
+                # Blind indexes for search are built from the same plaintext, in this process
+                indexes = blind_indexes([p.get("name") for p in page], [p.get("contact") for p in page])
+                for i, p in enumerate(page):
+                    if i in name_errors or i in contact_errors:
+                        logging.error(f"Encrypt error: ID {p['patient_id']}: {name_errors.get(i) or contact_errors.get(i)}")
+                        continue
+                    name_bidx, contact_bidx, terms = indexes[i]
+                    if (name_bidx, contact_bidx) == (p["name_bidx"], p["contact_bidx"]):
+                        index = None  # same values, same key: stored indexes and terms still match
+                    else:
+                        index = (name_bidx, contact_bidx, None if name_bidx is not None and name_bidx == p["name_bidx"] else terms)
+                    yield names[i], contacts[i], p["pii_version"], p["patient_id"], index
+
+        return store_encrypted(rows(), chunk_size=_chunk_size(job), audit=audit, checkpoint=checkpoint)
+
+def _run_retention(job, checkpoint, audit):
+    # Redacted rows leave the due set, so a resumed job just starts a new pass
+    run = run_retention(job["params"]["cutoff"], _chunk_size(job), trigger=job["params"].get("trigger", "manual"),
+                        audit=audit, checkpoint=checkpoint)
+    return run["processed"]
+
+HANDLERS = {
+    "anonymize": (lambda params: count_patients(**_anonymize_filters(params)), _run_anonymize),
+    "encrypt": (lambda params: count_patients(**_encrypt_filters(params)), _run_encrypt),
+    "retention": (lambda params: count_patients(added_to=params["cutoff"], retained=False), _run_retention),
+}
+AUDIT_ACTIONS = {"anonymize": "anonymize", "encrypt": "encrypt", "retention": "retention_cleanup"}
+
+# ---------------------------------------------------------------- job table
+
+def _job_dict(row):
+    job = dict(row)
+    job["params"] = json.loads(job["params"] or "{}")
+    return job
+
+@with_busy_retry
+def submit_job(kind, params=None, user=None):
+    """Queue a job and return its id. An active job of the same kind is returned instead of a duplicate."""
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    params = params or {}
+    if user:
+        params["user"] = {k: user[k] for k in ("user_id", "username", "role")}
+    total = HANDLERS[kind][0](params)
+    with get_conn() as conn:
+        cur = conn.cursor()
+        # Write lock before the duplicate check, so two submitters cannot both miss the other's row
+        if not conn.in_transaction:
+            cur.execute("BEGIN IMMEDIATE")
+        cur.execute(f"SELECT job_id FROM jobs WHERE kind = ? AND status IN ({','.join('?' * len(ACTIVE_STATUSES))})",
+                    (kind, *ACTIVE_STATUSES))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+        cur.execute("""
+            INSERT INTO jobs (kind, params, status, total, created_by, created_at, updated_at)
+            VALUES (?, ?, 'queued', ?, ?, ?, ?)
+        """, (kind, json.dumps(params), total, (user or {}).get("username", "system"), _now(), _now()))
+        return cur.lastrowid
+
+@with_busy_retry
+def get_job(job_id):
+    with get_conn(readonly=True) as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return _job_dict(row) if row else None
+
+@with_busy_retry
+def list_jobs(limit=10, kinds=None):
+    """Most recent jobs first, optionally only the given kinds."""
+    sql, params = "SELECT * FROM jobs", []
+    if kinds:
+        sql += f" WHERE kind IN ({','.join('?' * len(kinds))})"
+        params += list(kinds)
+    with get_conn(readonly=True) as conn:
+        return [_job_dict(r) for r in conn.execute(sql + " ORDER BY job_id DESC LIMIT ?", (*params, limit))]
+
+@with_busy_retry
+def active_job(kind):
+    """The queued, running or cancelling job of kind, or None."""
+    with get_conn(readonly=True) as conn:
+        row = conn.execute(f"SELECT * FROM jobs WHERE kind = ? AND status IN ({','.join('?' * len(ACTIVE_STATUSES))}) "
+                           "ORDER BY job_id DESC LIMIT 1", (kind, *ACTIVE_STATUSES)).fetchone()
+        return _job_dict(row) if row else None
+
+@with_busy_retry
+def cancel_job(job_id):
+    """Cancel a queued job now, or ask a running one to stop at its next checkpoint."""
+    with get_conn() as conn:
+        conn.execute("UPDATE jobs SET status = 'cancelled', finished_at = ?, updated_at = ? WHERE job_id = ? AND status = 'queued'",
+                     (_now(), _now(), job_id))
+        # updated_at restarts the stale clock: the runner gets STALE_AFTER to reach its next checkpoint
+        conn.execute("UPDATE jobs SET status = 'cancel_requested', updated_at = ? WHERE job_id = ? AND status = 'running'",
+                     (_now(), job_id))
+
+@with_busy_retry
+def claim_next_job(owner, job_id=None):
+    """Atomically take the oldest queued or orphaned job (or only job_id) for owner. Returns the job or None."""
+    stale = (datetime.utcnow() - timedelta(seconds=STALE_AFTER)).isoformat()
+    token = f"{owner}:{uuid.uuid4().hex[:8]}"
+    with get_conn() as conn:
+        cur = conn.cursor()
+        # Orphaned jobs that were already asked to stop are just closed
+        cur.execute("UPDATE jobs SET status = 'cancelled', finished_at = ?, updated_at = ? "
+                    "WHERE status = 'cancel_requested' AND updated_at < ?", (_now(), _now(), stale))
+        cur.execute(f"""
+            UPDATE jobs SET status = 'running', owner = ?, started_at = COALESCE(started_at, ?), updated_at = ?
+            WHERE job_id = (
+                SELECT job_id FROM jobs
+                WHERE (status = 'queued' OR (status = 'running' AND updated_at < ?)){" AND job_id = ?" if job_id else ""}
+                ORDER BY job_id LIMIT 1
+            )
+        """, (token, _now(), _now(), stale, *([job_id] if job_id else [])))
+        if not cur.rowcount:
+            return None
+        return _job_dict(cur.execute("SELECT * FROM jobs WHERE owner = ?", (token,)).fetchone())
+
+@with_busy_retry
+def _finish(job_id, owner, status, error=None):
+    with get_conn() as conn:
+        conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ?, finished_at = ? WHERE job_id = ? AND owner = ?",
+                     (status, error, _now(), _now(), job_id, owner))
+
+@with_busy_retry
+def release_job(job_id, owner):
+    """Hand a running job back to the queue (owner, its claim token, is stopping); progress is kept."""
+    with get_conn() as conn:
+        conn.execute("UPDATE jobs SET status = 'queued', owner = NULL, updated_at = ? WHERE job_id = ? AND owner = ? AND status = 'running'",
+                     (_now(), job_id, owner))
+        conn.execute("UPDATE jobs SET status = 'cancelled', finished_at = ?, updated_at = ? "
+                     "WHERE job_id = ? AND owner = ? AND status = 'cancel_requested'",
+                     (_now(), _now(), job_id, owner))
+
+def run_job(job, progress=None):
+    """Run a claimed job to completion, cancellation or failure. Returns the final status.
+
+    Returns "lost" if another runner took the job over; it is left to that runner.
+    progress(done, total) is called after each checkpoint.
+    """
+    job_id, token = job["job_id"], job["owner"]
+
+    def checkpoint(cur, chunk):
+        status, owner = cur.execute("SELECT status, owner FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if owner != token:
+            raise JobLost()  # rolls back this chunk; the new owner redoes it
+        if status != "running":
+            # cancel_requested, or already closed by the sweep in claim_next_job: stop and roll back this chunk
+            raise JobCancelled() if status in ("cancel_requested", "cancelled") else JobLost()
+        cur.execute("UPDATE jobs SET done = done + ?, last_patient_id = ?, updated_at = ? WHERE job_id = ?",
+                    (len(chunk), chunk[-1][-1], _now(), job_id))
+        if progress:
+            progress(*cur.execute("SELECT done, total FROM jobs WHERE job_id = ?", (job_id,)).fetchone())
+
+    user = job["params"].get("user") or {"user_id": None, "username": "system", "role": "system"}
+    audit = (user["user_id"], user["username"], user["role"], AUDIT_ACTIONS[job["kind"]])
+    try:
+        HANDLERS[job["kind"]][1](job, checkpoint, audit)
+        status, error = "finished", None
+    except JobCancelled:
+        status, error = "cancelled", None
+    except JobLost:
+        logging.warning(f"Job {job_id} ({job['kind']}) was claimed by another runner; stopping")
+        return "lost"
+    except Exception as e:
+        logging.error(f"Job {job_id} ({job['kind']}) failed: {e}")
+        status, error = "failed", f"{type(e).__name__}: {e}"
+    _finish(job_id, token, status, error)
+    return status
+
+def run_pending(owner=None):
+    """Process jobs until none are claimable. Returns the number of jobs run."""
+    owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+    count = 0
+    while True:
+        job = claim_next_job(owner)
+        if job is None:
+            return count
+        run_job(job)
+        count += 1
+
+class JobRunner:
+    """Daemon thread that keeps claiming and running jobs; wake() skips the idle wait."""
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="job-runner", daemon=True)
+            self._thread.start()
+        return self
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                run_pending(self.owner)
+            except Exception as e:
+                logging.error(f"Job runner error: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Queue, run and inspect background jobs")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("submit")
+    p.add_argument("kind", choices=sorted(HANDLERS))
+    p.add_argument("--reprocess-all", action="store_true")
+    p.add_argument("--cutoff", help="retention: ISO timestamp; rows added before it are redacted (default: policy cutoff)")
+    sub.add_parser("run")
+    sub.add_parser("list")
+    p = sub.add_parser("cancel")
+    p.add_argument("job_id", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "submit":
+        params = {"reprocess_all": args.reprocess_all}
+        if args.kind == "retention":
+            params["cutoff"] = args.cutoff or retention_cutoff()
+        print(f"Queued job {submit_job(args.kind, params)}")
+    elif args.command == "run":
+        print(f"Ran {run_pending()} job(s)")
+    elif args.command == "list":
+        for job in list_jobs(50):
+            print(f"{job['job_id']:>5} {job['kind']:<10} {job['status']:<16} {job['done']:>10,}/{job['total']:<10,} {job['error'] or ''}")
+    else:
+        cancel_job(args.job_id)
+        print(f"Cancel requested for job {args.job_id}")
+
+if __name__ == "__main__":
+    main()
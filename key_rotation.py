@@ -0,0 +1,184 @@
+# key_rotation.py
+"""
+Resumable Fernet key rotation for encrypted_name / encrypted_contact.
+
+    python key_rotation.py start     # new primary key, old key kept for decryption
+    python key_rotation.py resume    # re-encrypt remaining rows (safe to re-run after a crash)
+    python key_rotation.py status
+
+While a rotation is running the keyring holds both keys (fernet.key is the
+new primary, fernet.key.previous the old ones), so the dashboard keeps
+decrypting every row. Patients are streamed in keyset pages and each chunk is
+re-encrypted and checkpointed in one transaction, so memory stays bounded and
+an interrupted run continues where it stopped.
+
+An Encrypt All job that is already running may still hold the old primary
+key (a page in flight, or up to utils.KEY_RELOAD_INTERVAL). It could then
+write old-key ciphertext behind the rotation cursor. So start refuses to run
+while an encrypt job is active. The old keys are only retired after a
+verification pass has re-encrypted any row the primary key alone cannot
+read, and only while no encrypt job is active. Otherwise the rotation stays
+running and `resume` finishes it.
+"""
+import argparse
+import hashlib
+import os
+from datetime import datetime
+
+import utils
+from cryptography.fernet import Fernet, InvalidToken
+from db import get_conn, iter_patient_pages, bulk_update_patients, add_log
+from jobs import active_job
+
+CHUNK_SIZE = 2000
+
+def key_fingerprint(key: bytes) -> str:
+    return hashlib.sha256(key).hexdigest()[:16]
+
+def _write_file_atomic(path, data: bytes):
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _refuse_during_encrypt_job(action):
+    job = active_job("encrypt")
+    if job:
+        raise RuntimeError(f"Encrypt job #{job['job_id']} is {job['status']}; cannot {action} until it ends "
+                           "(it may still write ciphertext under the old key)")
+
+def active_rotation():
+    """Return the unfinished rotation row, or None."""
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM key_rotations WHERE status = 'running' ORDER BY rotation_id DESC LIMIT 1")
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+def start_rotation():
+    """Install a new primary key, keep the old ones for decryption, and open a rotation record."""
+    if active_rotation():
+        raise RuntimeError("A key rotation is already running; resume it first")
+    _refuse_during_encrypt_job("start a rotation")
+    utils.reload_keys()
+    old_keys = [k for k in [utils.FERNET_KEY, *utils.PREVIOUS_KEYS] if k]
+    if not old_keys:
+        raise ValueError("Fernet key not loaded")
+
+    new_key = Fernet.generate_key()
+    # Previous keys first: if we crash between the two writes, nothing is lost
+    _write_file_atomic(utils.PREVIOUS_KEYS_FILE, b"\n".join(old_keys) + b"\n")
+    _write_file_atomic(utils.KEY_FILE, new_key)
+    utils.reload_keys()
+
+    now = datetime.utcnow().isoformat()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO key_rotations (key_fingerprint, status, started_at, updated_at)
+            VALUES (?, 'running', ?, ?)
+        """, (key_fingerprint(new_key), now, now))
+        rotation_id = cur.lastrowid
+    add_log(None, "system", "system", "key_rotation", f"started rotation {rotation_id}")
+    return rotation_id
+
+def run_rotation(chunk_size=CHUNK_SIZE, progress=None):
+    """Re-encrypt every remaining row under the primary key. Returns the final rotation row."""
+    rotation = active_rotation()
+    if not rotation:
+        raise RuntimeError("No key rotation in progress")
+    utils.reload_keys()
+    if not utils.FERNET_KEY:
+        raise ValueError("Fernet key not loaded")
+    if key_fingerprint(utils.FERNET_KEY) != rotation["key_fingerprint"]:
+        raise RuntimeError("fernet.key does not match the key this rotation started with")
+
+    keyring = utils.get_cipher()
+    rotation_id = rotation["rotation_id"]
+    failed = 0
+
+    def rotated_rows(only_stale=False):
+        """Rows re-encrypted under the primary key; only_stale skips rows the primary alone can read."""
+        nonlocal failed
+        pages = iter_patient_pages(chunk_size, columns=["encrypted_name", "encrypted_contact"],
+                                   after_id=0 if only_stale else rotation["last_patient_id"], encrypted=True)
+        for page in pages:
+            for p in page:
+                if only_stale and all(_readable_with(primary, p.get(c)) for c in ("encrypted_name", "encrypted_contact")):
+                    continue
+                try:
+                    name = keyring.rotate(p["encrypted_name"].encode()).decode()
+                    contact = keyring.rotate(p["encrypted_contact"].encode()).decode() if p.get("encrypted_contact") else p.get("encrypted_contact")
+                except Exception:
+                    failed += 1  # unreadable under every key; left untouched and counted
+                    continue
+                yield name, contact, p["patient_id"]
+
+    def checkpoint(cur, chunk):
+        cur.execute("""
+            UPDATE key_rotations
+            SET last_patient_id = ?, rotated = rotated + ?, failed = ?, updated_at = ?
+            WHERE rotation_id = ?
+        """, (chunk[-1][-1], len(chunk), rotation["failed"] + failed, datetime.utcnow().isoformat(), rotation_id))
+
+    bulk_update_patients(["encrypted_name", "encrypted_contact"], rotated_rows(), chunk_size=chunk_size,
+                         progress=progress, checkpoint=checkpoint)
+
+    # Verification before the old keys can go: nothing may still need them
+    _refuse_during_encrypt_job("finish the rotation")
+    primary = Fernet(utils.FERNET_KEY)
+    failed = 0  # the verification pass sees every row again, so it recounts unreadable ones
+    stragglers = bulk_update_patients(["encrypted_name", "encrypted_contact"], rotated_rows(only_stale=True),
+                                      chunk_size=chunk_size)
+
+    total_failed = failed
+    with get_conn() as conn:
+        conn.execute("""
+            UPDATE key_rotations SET status = ?, rotated = rotated + ?, failed = ?, updated_at = ?, finished_at = ?
+            WHERE rotation_id = ?
+        """, ("finished" if not total_failed else "finished_with_errors", stragglers, total_failed,
+              datetime.utcnow().isoformat(), datetime.utcnow().isoformat(), rotation_id))
+    if not total_failed and os.path.exists(utils.PREVIOUS_KEYS_FILE):
+        # Every ciphertext now uses the primary key; retire the old ones
+        os.remove(utils.PREVIOUS_KEYS_FILE)
+        utils.reload_keys()
+    add_log(None, "system", "system", "key_rotation",
+            f"finished rotation {rotation_id}: {stragglers} re-encrypted on verification, {total_failed} failed")
+    return rotation_status(rotation_id)
+
+def _readable_with(cipher, token):
+    if not token:
+        return True
+    try:
+        cipher.decrypt(token.encode())
+        return True
+    except InvalidToken:
+        return False
+
+def rotation_status(rotation_id=None):
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        if rotation_id is None:
+            cur.execute("SELECT * FROM key_rotations ORDER BY rotation_id DESC LIMIT 1")
+        else:
+            cur.execute("SELECT * FROM key_rotations WHERE rotation_id = ?", (rotation_id,))
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rotate the Fernet key and re-encrypt patient data")
+    parser.add_argument("command", choices=["start", "resume", "status"])
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.command == "status":
+        print(rotation_status() or "No rotations recorded.")
+        return
+    if args.command == "start":
+        print(f"Started rotation {start_rotation()}")
+    print(run_rotation(args.chunk_size, progress=lambda done: print(f"  {done:,} rows re-encrypted", flush=True)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# patient_view.py
+"""
+Role-based rows for the dashboard's patient table.
+
+Lives outside streamlit_app.py so the benchmark suite can build exactly the
+rows each role sees without running the UI.
+"""
+import logging
+
+from db import store_pseudonyms, PseudonymCollision
+from utils import name_digest, pseudonym_from_digest, mask_contact, decrypt_many
+
+# Columns each role's table needs from the DB
+ROLE_COLUMNS = {
+    "admin": ["name", "contact", "diagnosis", "anonymized_name", "anonymized_contact", "encrypted_name", "encrypted_contact", "pii_version"],
+    "doctor": ["name", "contact", "diagnosis", "anonymized_name", "anonymized_contact", "pii_version"],
+    "receptionist": ["name", "contact", "diagnosis"],
+}
+
+def fill_missing_pseudonyms(patients, user=None):
+    """Derive pseudonyms for rows that have none stored, and persist them so later renders just read them.
+
+    The write-back is audited like the anonymize job: an "anonymize" entry per row, attributed to
+    user (the viewer) or to system, in the same transaction.
+    """
+    derived = []
+    for p in patients:
+        if (p.get("anonymized_name") or not p.get("name")) and (p.get("anonymized_contact") or not p.get("contact")):
+            continue
+        digest = name_digest(p.get("name") or "")
+        p["anonymized_name"] = pseudonym_from_digest(digest)
+        p["anonymized_contact"] = mask_contact(p.get("contact") or "")
+        derived.append((p["anonymized_name"], p["anonymized_contact"], digest or None, p.get("pii_version"), p["patient_id"]))
+    if derived:
+        try:
+            user = user or {"user_id": None, "username": "system", "role": "system"}
+            store_pseudonyms(derived, audit=(user["user_id"], user["username"], user["role"], "anonymize"))
+        except PseudonymCollision as e:
+            logging.error(f"Pseudonym write-back refused: {e}")
+        except Exception as e:
+            # Display still works from the in-memory values; the next render retries the write
+            logging.warning(f"Pseudonym write-back failed: {e}")
+
+def build_patient_rows(patients, role, show_decrypted=False, user=None):
+    """Table rows for one page of patients, masked for role."""
+    if role == "admin" and show_decrypted:
+        # One pass over the page with a single cipher; failures come back as None
+        decrypted_names, _ = decrypt_many([p.get("encrypted_name") for p in patients])
+        decrypted_contacts, _ = decrypt_many([p.get("encrypted_contact") for p in patients])
+    if role in ("admin", "doctor"):
+        fill_missing_pseudonyms(patients, user)
+
+    rows = []
+    for i, p in enumerate(patients):
+        row = {"patient_id": p["patient_id"], "diagnosis": p.get("diagnosis", "")}
+
+        if role == "admin":
+            if show_decrypted:
+                if p.get("encrypted_name"):
+                    row["name"] = decrypted_names[i] if decrypted_names[i] is not None else p.get("name") or "[Decryption Failed]"
+                else:
+                    row["name"] = p.get("name") or "(Plaintext)"
+
+                if p.get("encrypted_contact"):
+                    row["contact"] = decrypted_contacts[i] if decrypted_contacts[i] is not None else p.get("contact") or "[Decryption Failed]"
+                else:
+                    row["contact"] = p.get("contact") or "(Plaintext)"
+            else:
+                row["name"] = p["anonymized_name"]
+                row["contact"] = p["anonymized_contact"]
+            row["anonymized_name"] = p.get("anonymized_name") or ""
+            row["anonymized_contact"] = p.get("anonymized_contact") or ""
+
+        elif role == "doctor":
+            row["name"] = p["anonymized_name"]
+            row["contact"] = p["anonymized_contact"]
+        elif role == "receptionist":
+            row["name"] = p.get("name") or ""
+            row["contact"] = p.get("contact") or ""
+
+        rows.append(row)
+    return rows
@@ -0,0 +1,152 @@
+# retention.py
+"""
+GDPR retention engine: redact patients older than RETENTION_DAYS.
+
+    python retention.py run              # one pass now (point cron at this)
+    python retention.py run --days 730
+    python retention.py status           # recent runs with throughput
+
+Due rows are taken oldest first from a partial index on date_added that only
+holds unredacted rows, and redacted in batched transactions through
+db.bulk_update_patients. Each row gets retention_applied_at, its plaintext,
+ciphertext, name digest and blind-index search terms are cleared, and it
+drops out of the index, so a
+pass that is interrupted simply continues on the next run. Every run is recorded in
+retention_runs with its row count and rows/sec.
+
+Inside the dashboard, RetentionScheduler queues a retention job every
+RETENTION_INTERVAL seconds (0 disables it), skipping ticks with nothing due.
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from db import get_conn, bulk_update_patients, count_patients, fetch_retention_due, replace_name_terms_with, with_busy_retry
+
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", "365"))
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "3600"))  # seconds between scheduled runs
+RETENTION_BATCH_SIZE = 2000
+
+# Columns written per redacted row, followed by retention_applied_at
+REDACT_COLUMNS = ["name", "contact", "anonymized_name", "anonymized_contact", "encrypted_name", "encrypted_contact",
+                  "name_digest", "name_bidx", "contact_bidx"]
+REDACT_VALUES = ("ARCHIVED", "ARCHIVED", "REDACTED", "REDACTED", None, None, None, None, None)
+
+def retention_cutoff(days=None, now=None):
+    """ISO timestamp before which records are due."""
+    now = now or datetime.utcnow()
+    return (now - timedelta(days=RETENTION_DAYS if days is None else days)).isoformat()
+
+@with_busy_retry
+def _start_run(trigger, cutoff):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO retention_runs (trigger, cutoff, status, started_at) VALUES (?, ?, 'running', ?)",
+                    (trigger, cutoff, datetime.utcnow().isoformat()))
+        return cur.lastrowid
+
+@with_busy_retry
+def _finish_run(run_id, status, seconds, error=None):
+    with get_conn() as conn:
+        conn.execute("""
+            UPDATE retention_runs
+            SET status = ?, seconds = ?, rows_per_sec = ROUND(processed / MAX(?, 0.001), 1), error = ?, finished_at = ?
+            WHERE run_id = ?
+        """, (status, round(seconds, 3), seconds, error, datetime.utcnow().isoformat(), run_id))
+
+def run_retention(cutoff=None, batch_size=RETENTION_BATCH_SIZE, trigger="manual", audit=None, checkpoint=None, progress=None):
+    """Redact every unredacted patient added before cutoff. Returns the finished retention_runs row.
+
+    audit and checkpoint are passed to bulk_update_patients (the job runner
+    uses checkpoint for progress and cancellation); progress(done) runs after each batch.
+    """
+    cutoff = cutoff or retention_cutoff()
+    run_id = _start_run(trigger, cutoff)
+    start = time.perf_counter()
+    processed = 0
+
+    def record(cur, chunk):
+        cur.execute("UPDATE retention_runs SET processed = processed + ? WHERE run_id = ?", (len(chunk), run_id))
+        replace_name_terms_with(cur, [(row[-1], []) for row in chunk])
+        if checkpoint:
+            checkpoint(cur, chunk)
+
+    try:
+        while True:
+            ids = fetch_retention_due(cutoff, batch_size)
+            if not ids:
+                break
+            applied_at = datetime.utcnow().isoformat()
+            processed += bulk_update_patients(REDACT_COLUMNS + ["retention_applied_at"],
+                                              [(*REDACT_VALUES, applied_at, pid) for pid in ids],
+                                              chunk_size=batch_size, audit=audit, checkpoint=record)
+            if progress:
+                progress(processed)
+    except BaseException as e:
+        _finish_run(run_id, "interrupted", time.perf_counter() - start, f"{type(e).__name__}: {e}")
+        raise
+    _finish_run(run_id, "finished", time.perf_counter() - start)
+    return retention_runs(1)[0]
+
+@with_busy_retry
+def retention_runs(limit=10):
+    """Most recent runs first."""
+    with get_conn(readonly=True) as conn:
+        return [dict(r) for r in conn.execute("SELECT * FROM retention_runs ORDER BY run_id DESC LIMIT ?", (limit,))]
+
+class RetentionScheduler:
+    """Daemon thread that calls run(cutoff) every interval seconds (run defaults to run_retention)."""
+
+    def __init__(self, run=None, interval=RETENTION_INTERVAL):
+        self.run = run or (lambda cutoff: run_retention(cutoff, trigger="schedule"))
+        self.interval = interval
+        self.next_run_at = None
+        self._thread = None
+
+    def start(self):
+        if self.interval > 0 and (self._thread is None or not self._thread.is_alive()):
+            self._thread = threading.Thread(target=self._loop, name="retention-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def tick(self):
+        """Call run if any record is due; returns whether it did. Empty ticks queue no job and record no run."""
+        cutoff = retention_cutoff()
+        if not count_patients(added_to=cutoff, retained=False):
+            return False
+        self.run(cutoff)
+        return True
+
+    def _loop(self):
+        while True:
+            self.next_run_at = datetime.utcnow() + timedelta(seconds=self.interval)
+            time.sleep(self.interval)
+            try:
+                self.tick()
+            except Exception as e:
+                logging.error(f"Scheduled retention failed: {e}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply the GDPR retention policy")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("run")
+    p.add_argument("--days", type=int, default=RETENTION_DAYS)
+    p.add_argument("--batch-size", type=int, default=RETENTION_BATCH_SIZE)
+    sub.add_parser("status")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        audit = (None, "system", "system", "retention_cleanup")
+        run = run_retention(retention_cutoff(args.days), args.batch_size, trigger="cli", audit=audit,
+                            progress=lambda n: print(f"  {n:,} records redacted", flush=True))
+        print(f"Redacted {run['processed']:,} records in {run['seconds']}s ({run['rows_per_sec']:,} rows/s)")
+    else:
+        for run in retention_runs(20):
+            print(f"{run['run_id']:>5} {run['started_at'][:19]} {run['trigger']:<9} {run['status']:<12} "
+                  f"{run['processed']:>10,} rows {run['rows_per_sec'] or 0:>10,} rows/s")
+
+if __name__ == "__main__":
+    main()
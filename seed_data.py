@@ -0,0 +1,208 @@
+# seed_data.py
+"""
+Synthetic data for reproducing production-scale behaviour locally.
+
+    python seed_data.py --db bench.db --patients 1000000 --users 200 --logs 2000000
+    python seed_data.py --db big.db --patients 10000000 --logs 10000000 --years 8 --seed 7
+
+The database is created (or migrated) with db_setup.ensure_db, then rows are
+bulk-inserted with executemany in large transactions under the bulk_load
+storage profile. Secondary indexes are dropped for the load and rebuilt
+afterwards. Patients get dates spread over --years years, denser towards
+the present. Most names recur, as in a real register. A configurable share
+is anonymized and/or encrypted, the latter with the loaded Fernet key and
+with blind indexes and name search terms, as Encrypt All would write them.
+Audit logs follow a weighted action mix in timestamp order.
+"""
+import argparse
+import itertools
+import math
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import utils
+from db import apply_storage_profile, refresh_log_rollups_with, bump_table_versions_with
+from db_setup import ensure_db, hash_password, INDEXES
+
+BATCH_SIZE = 50_000
+
+FIRST_NAMES = ["Ahmed", "Ayesha", "Ali", "Fatima", "Hassan", "Zainab", "Omar", "Sara", "Bilal", "Hira",
+               "John", "Mary", "James", "Linda", "Robert", "Emma", "David", "Olivia", "Daniel", "Sophia",
+               "Usman", "Maryam", "Hamza", "Amna", "Imran", "Sana", "Kamran", "Nadia", "Tariq", "Iqra"]
+LAST_NAMES = ["Khan", "Ahmed", "Malik", "Hussain", "Sheikh", "Qureshi", "Butt", "Chaudhry", "Raza", "Siddiqui",
+              "Smith", "Johnson", "Brown", "Williams", "Jones", "Garcia", "Miller", "Davis", "Wilson", "Taylor"]
+# (diagnosis, weight)
+DIAGNOSES = [("Flu", 20), ("Hypertension", 15), ("Diabetes", 12), ("Fracture", 8), ("Asthma", 8),
+             ("Migraine", 7), ("Allergy", 7), ("Gastritis", 6), ("Bronchitis", 5), ("Anemia", 4),
+             ("Covid-19", 4), ("Dengue", 2), ("Appendicitis", 1), ("Pneumonia", 1)]
+# (action, weight, roles that perform it)
+LOG_ACTIONS = [("view_patients", 50, ("admin", "doctor", "receptionist")), ("login", 15, ("admin", "doctor", "receptionist")),
+               ("logout", 12, ("admin", "doctor", "receptionist")), ("add_patient", 10, ("admin", "receptionist")),
+               ("update_patient", 6, ("admin", "receptionist")), ("anonymize", 2, ("admin",)),
+               ("encrypt", 2, ("admin",)), ("export_patients", 1, ("admin",)), ("export_logs", 1, ("admin",)),
+               ("consent_given", 1, ("admin", "doctor", "receptionist"))]
+ROLES = [("doctor", 45), ("receptionist", 40), ("admin", 15)]
+
+def _batches(rows, size=BATCH_SIZE):
+    it = iter(rows)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+def _timestamp(rng, now, years):
+    """A time in the last `years` years; density grows linearly towards now."""
+    age = years * 365.25 * (1 - math.sqrt(rng.random()))
+    return (now - timedelta(days=age)).isoformat()
+
+def generate_users(rng, count, start=0):
+    password = hash_password("password")  # every synthetic account: <username> / password
+    pick_role = lambda: rng.choices([r for r, _ in ROLES], [w for _, w in ROLES])[0]
+    for i in range(start, start + count):
+        yield (f"user{i:05d}", password, pick_role(), 1 if rng.random() < 0.9 else 0)
+
+def generate_patients(rng, count, now, years, anonymized=0.5, encrypted=0.5, distinct_contacts=200_000):
+    names = [f"{f} {l}" for f in FIRST_NAMES for l in LAST_NAMES]
+    diagnoses = [d for d, _ in DIAGNOSES]
+    cum_weights = list(itertools.accumulate(w for _, w in DIAGNOSES))
+    try:
+        cipher = utils.get_cipher()
+    except ValueError:
+        cipher = None  # no fernet.key: nothing can be encrypted
+    tokens = {}  # one token per distinct plaintext keeps encryption off the critical path
+    name_bidxs, contact_bidxs = {}, {}
+
+    def encrypt(value):
+        token = tokens.get(value)
+        if token is None:
+            token = tokens[value] = cipher.encrypt(value.encode()).decode()
+        return token
+
+    def name_bidx(value):
+        if value not in name_bidxs:
+            name_bidxs[value] = utils.blind_index(value, "")[0]
+        return name_bidxs[value]
+
+    def contact_bidx(value):
+        if value not in contact_bidxs:
+            contact_bidxs[value] = utils.blind_index("", value)[1]
+        return contact_bidxs[value]
+
+    for _ in range(count):
+        name = rng.choice(names)
+        contact = f"03{rng.randrange(distinct_contacts):09d}"
+        contact = f"{contact[:4]}-{contact[4:7]}-{contact[7:]}"
+        anon = rng.random() < anonymized
+        enc = cipher is not None and rng.random() < encrypted
+        digest = utils.name_digest(name) if anon else None
+        yield (name, contact, rng.choices(diagnoses, cum_weights=cum_weights)[0],
+               utils.pseudonym_from_digest(digest) if anon else None, utils.mask_contact(contact) if anon else None,
+               digest, encrypt(name) if enc else None, encrypt(contact) if enc else None,
+               _timestamp(rng, now, years), 1 if enc else None, 1 if anon else None,
+               name_bidx(name) if enc else None, contact_bidx(contact) if enc else None)
+
+def generate_name_terms(conn, after_id):
+    """(term, patient_id) rows for patients after after_id that have a blind index."""
+    terms = {}
+    rows = conn.execute("SELECT patient_id, name FROM patients WHERE patient_id > ? AND name_bidx IS NOT NULL", (after_id,))
+    for patient_id, name in rows:
+        if name not in terms:
+            terms[name] = utils.blind_index(name, "")[2]
+        for term in terms[name]:
+            yield term, patient_id
+
+def generate_logs(rng, count, users, now, years):
+    actions = [a for a, _, _ in LOG_ACTIONS]
+    cum_weights = list(itertools.accumulate(w for _, w, _ in LOG_ACTIONS))
+    action_roles = {a: roles for a, _, roles in LOG_ACTIONS}
+    by_role = {}
+    for user_id, username, role in users:
+        by_role.setdefault(role, []).append((user_id, username, role))
+    # Timestamps are generated in order so log_id order matches time order, as in production
+    span = years * 365.25 * 86400
+    start = now - timedelta(seconds=span)
+    points = sorted(span * math.sqrt(rng.random()) for _ in range(count))
+    for offset in points:
+        action = rng.choices(actions, cum_weights=cum_weights)[0]
+        roles = [r for r in action_roles[action] if r in by_role]
+        if not roles:
+            continue
+        user_id, username, role = rng.choice(by_role[rng.choice(roles)])
+        yield (user_id, username, role, action, (start + timedelta(seconds=offset)).isoformat(), f"synthetic {action}")
+
+def _insert(conn, sql, rows, label, total):
+    start = time.perf_counter()
+    done = 0
+    for batch in _batches(rows):
+        conn.executemany(sql, batch)
+        conn.commit()
+        done += len(batch)
+        print(f"  {label}: {done:,}" + (f" / {total:,}" if total else ""), end="\r", flush=True)
+    secs = time.perf_counter() - start
+    print(f"  {label}: {done:,} rows in {secs:.1f}s ({done / secs if secs else 0:,.0f} rows/s)")
+    return done
+
+def seed(db_path, patients=0, users=0, logs=0, years=5, anonymized=0.5, encrypted=0.5, seed_value=None):
+    """Bulk-load synthetic rows into db_path. Returns {table: rows inserted}."""
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    ensure_db(db_path)
+    conn = sqlite3.connect(db_path)
+    apply_storage_profile(conn, "bulk_load")
+    counts = {}
+    try:
+        for name, _ in INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")  # rebuilt once below, far cheaper than per row
+
+        if users:
+            start = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            counts["users"] = _insert(conn, "INSERT INTO users (username, password_hash, role, consent_given) VALUES (?, ?, ?, ?)",
+                                      generate_users(rng, users, start), "users", users)
+        if patients:
+            last_id = conn.execute("SELECT COALESCE(MAX(patient_id), 0) FROM patients").fetchone()[0]
+            counts["patients"] = _insert(conn, """
+                INSERT INTO patients (name, contact, diagnosis, anonymized_name, anonymized_contact, name_digest,
+                                      encrypted_name, encrypted_contact, date_added, encrypted_version, anonymized_version,
+                                      name_bidx, contact_bidx)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, generate_patients(rng, patients, now, years, anonymized, encrypted), "patients", patients)
+            counts["patient_name_terms"] = _insert(conn, "INSERT OR IGNORE INTO patient_name_terms (term, patient_id) VALUES (?, ?)",
+                                                   generate_name_terms(conn, last_id), "name terms", None)
+        if logs:
+            user_rows = conn.execute("SELECT user_id, username, role FROM users").fetchall()
+            counts["logs"] = _insert(conn, "INSERT INTO logs (user_id, username, role, action, timestamp, details) VALUES (?, ?, ?, ?, ?, ?)",
+                                     generate_logs(rng, logs, user_rows, now, years), "logs", logs)
+            refresh_log_rollups_with(conn.cursor())
+            conn.commit()
+
+        start = time.perf_counter()
+        for name, sql in INDEXES:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {sql}")
+        bump_table_versions_with(conn.cursor(), *[t for t in ("users", "patients", "logs") if t in counts])
+        conn.commit()
+        print(f"  indexes rebuilt in {time.perf_counter() - start:.1f}s")
+    finally:
+        conn.close()
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-generate synthetic patients, users and audit logs")
+    parser.add_argument("--db", default="hospital.db", help="database file (created if missing)")
+    parser.add_argument("--patients", type=int, default=0)
+    parser.add_argument("--users", type=int, default=0)
+    parser.add_argument("--logs", type=int, default=0)
+    parser.add_argument("--years", type=float, default=5, help="spread dates over this many years")
+    parser.add_argument("--anonymized", type=float, default=0.5, help="share of patients already anonymized")
+    parser.add_argument("--encrypted", type=float, default=0.5, help="share of patients already encrypted")
+    parser.add_argument("--seed", type=int, help="random seed for a reproducible dataset")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    counts = seed(args.db, args.patients, args.users, args.logs, args.years, args.anonymized, args.encrypted, args.seed)
+    print(f"Seeded {args.db} with {counts} in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,27 @@
 import streamlit as st
-from db import fetch_patients, add_patient, update_patient, fetch_logs, add_log, check_consent, set_consent
+from db import add_patient, update_patient, add_log, flush_logs, set_consent, audit_writer
+from data_cache import (fetch_patients_page, count_patients, get_patient, fetch_logs_page, count_logs,
+                        fetch_log_actions, fetch_activity_by_day, fetch_activity_by_user, cache_stats,
+                        session_profile)
 from auth import login, hash_password
-from utils import anonymize_name, mask_contact, FERNET_KEY, encrypt_value, decrypt_value, generate_fernet_key
+from db_setup import ensure_db
+from crypto_engine import ParallelCrypto
+from jobs import JobRunner, submit_job, list_jobs, cancel_job, ACTIVE_STATUSES
+from retention import RETENTION_DAYS, RetentionScheduler, retention_cutoff, retention_runs
+from export import export_patients, export_logs, transform_patients, FORMATS, MIME_TYPES
+from patient_view import ROLE_COLUMNS, build_patient_rows
+from instrumentation import start_rerun, end_rerun, span, timed, span_totals, reset_totals, PERF_LOG
+from audit import FALLBACK_FILE
+from utils import FERNET_KEY, decrypt_many, generate_fernet_key, blind_search_filters
+from contextlib import ExitStack
 from datetime import datetime, timedelta
 import pandas as pd
 import time
 import os
+import tempfile
+import shlex
 import logging
+import uuid
 # Configure logging for audit trail
 logging.basicConfig(level=logging.INFO)
 st.set_page_config(
@@ -433,6 +448,24 @@ st.markdown("""
     }
 </style>
 """, unsafe_allow_html=True)
+@st.cache_resource
+def init_database():
+    """Create tables and apply pending migrations once per server process."""
+    ensure_db()
+init_database()
+@st.cache_resource
+def get_job_runner():
+    """One job-runner thread per server process; on start it also resumes jobs orphaned by a restart."""
+    return JobRunner().start()
+get_job_runner()
+@st.cache_resource
+def get_retention_scheduler():
+    """Queues a retention job every RETENTION_INTERVAL seconds, when records are due, while the server runs."""
+    def queue_retention(cutoff):
+        submit_job("retention", {"cutoff": cutoff, "trigger": "schedule"})
+        get_job_runner().wake()
+    return RetentionScheduler(queue_retention).start()
+get_retention_scheduler()
 # Initialize session state
 if "user" not in st.session_state:
     st.session_state["user"] = None
@@ -440,6 +473,10 @@ if "start_time" not in st.session_state:
     st.session_state["start_time"] = datetime.now()
 if "current_tab" not in st.session_state:
     st.session_state["current_tab"] = "patients"
+if "perf_session" not in st.session_state:
+    st.session_state["perf_session"] = uuid.uuid4().hex[:8]
+# Time this rerun (spans, query count, optional cProfile); shown on the admin Diagnostics tab
+start_rerun(profile=st.session_state.get("perf_profile", False))
 def uptime_str():
     """Calculate uptime since session started"""
     elapsed = datetime.now() - st.session_state["start_time"]
@@ -454,7 +491,7 @@ def display_uptime():
 # ============== LOGIN PAGE ==============
 if st.session_state["user"] is None:
     col1, col2, col3 = st.columns([1, 2, 1])
-    with col2:
+    with col2, span("page.login"):
       
         st.markdown('<h1 class="login-header">Hospital Dashboard</h1>', unsafe_allow_html=True)
         st.markdown('<p class="login-subtitle">Secure GDPR-Compliant Access</p>', unsafe_allow_html=True)
@@ -500,9 +537,13 @@ if st.session_state["user"] is None:
     st.stop()
 # ============== MAIN APP ==============
 user = st.session_state["user"]
-role = user["role"]
-# Check consent from database
-user_has_consent = check_consent(user['user_id'])
+# Role and consent come from a per-session profile cache (refreshed on TTL or set_consent)
+profile = session_profile(user['user_id'])
+if profile is None:
+    st.session_state["user"] = None  # account no longer exists
+    st.rerun()
+role = user["role"] = profile["role"]
+user_has_consent = bool(profile["consent_given"])
 # GDPR consent required before interacting
 if not user_has_consent:
     st.info("""
@@ -526,7 +567,7 @@ if not user_has_consent:
             st.rerun()
     st.stop()
 # ============== SIDEBAR NAVIGATION ==============
-with st.sidebar:
+with st.sidebar, span("page.sidebar"):
     st.markdown('<div class="logo">MedSecure</div>', unsafe_allow_html=True)
    
     # User profile card
@@ -561,6 +602,8 @@ with st.sidebar:
         nav_pages.append("backup")
         nav_options.append("Retention Policy")
         nav_pages.append("retention")
+        nav_options.append("Diagnostics")
+        nav_pages.append("diagnostics")
     else:
         # Doctor: View-only
         nav_options.append("Patient Overview")
@@ -591,6 +634,8 @@ with st.sidebar:
         if st.button("Sign Out", key="logout", type="secondary", use_container_width=True):
             try:
                 add_log(user['user_id'], user['username'], role, "logout", "Session ended")
+                if not flush_logs():
+                    logging.error(f"Logout entry for {user['username']} not yet written to the audit log")
             except Exception as e:
                 logging.error(f"Logout logging failed: {e}")
             st.session_state["user"] = None
@@ -606,47 +651,126 @@ with st.sidebar:
    
     display_uptime()
 # ============== MAIN CONTENT ==============
-# Helper function to render patients table dynamically
+# Pagination helpers: pages are fetched from the DB one at a time (keyset cursors)
+PAGE_SIZES = [25, 50, 100, 250]
+# Browser downloads are built in server memory; bigger exports go through `cli.py export`
+UI_EXPORT_MAX_ROWS = int(os.environ.get("UI_EXPORT_MAX_ROWS", "100000"))
+def export_too_large(total, cli_args):
+    """Explain how to run an export headless when it is over UI_EXPORT_MAX_ROWS."""
+    if total <= UI_EXPORT_MAX_ROWS:
+        return False
+    st.info(f"{total:,} rows is over the {UI_EXPORT_MAX_ROWS:,}-row limit for browser downloads. "
+            "Run the export on the server instead:")
+    st.code("python cli.py export " + " ".join(shlex.quote(str(a)) for a in cli_args), language="bash")
+    return True
+def patient_filter_controls(key, allow_encryption_filter=False, allow_pseudonym_search=False, allow_blind_search=False):
+    """Render patient filter widgets and return the matching fetch_patients_page filters."""
+    filters = {}
+    if allow_blind_search:
+        # Blind-index lookup: the query is hashed and matched on indexed columns, nothing is decrypted
+        col1, col2 = st.columns([4, 1])
+        with col1:
+            query = st.text_input("Find by name or phone", placeholder="e.g., Jane Sm, 0300-555-1234",
+                                  help="Each word matches the start of a name word (3+ letters). "
+                                       "Phone numbers and e-mail addresses must match in full.",
+                                  key=f"{key}_search")
+        with col2:
+            exact = st.checkbox("Exact name", key=f"{key}_exact")
+        filters.update(blind_search_filters(query, exact))
+    if allow_pseudonym_search:
+        # Exact match on the indexed anonymized_name column
+        pseudonym = st.text_input("Find by pseudonym", placeholder="ANON_…", key=f"{key}_pseudonym").strip()
+        if pseudonym:
+            filters["pseudonym"] = "ANON_" + (pseudonym[5:] if pseudonym.upper().startswith("ANON_") else pseudonym).lower()
+    cols = st.columns(4 if allow_encryption_filter else 3)
+    with cols[0]:
+        diagnosis = st.text_input("Diagnosis contains", key=f"{key}_diagnosis")
+    with cols[1]:
+        date_from = st.date_input("Added from", value=None, key=f"{key}_from")
+    with cols[2]:
+        date_to = st.date_input("Added to", value=None, key=f"{key}_to")
+    if diagnosis.strip():
+        filters["diagnosis"] = diagnosis.strip()
+    if date_from:
+        filters["added_from"] = date_from.isoformat()
+    if date_to:
+        filters["added_to"] = (date_to + timedelta(days=1)).isoformat()
+    if allow_encryption_filter:
+        with cols[3]:
+            state = st.selectbox("Encryption", ["Any", "Encrypted", "Not encrypted"], key=f"{key}_enc")
+        if state != "Any":
+            filters["encrypted"] = state == "Encrypted"
+    return filters
+def current_cursor(key, filters, page_size):
+    """Cursor of the page the pager stored under session_state[key] points at."""
+    pager = st.session_state.setdefault(key, {"cursors": [None], "signature": None})
+    signature = (tuple(sorted(filters.items())), page_size)
+    if pager["signature"] != signature:
+        # Filters or page size changed: start again from the first page
+        pager["cursors"] = [None]
+        pager["signature"] = signature
+    return pager["cursors"][-1]
+def fetch_current_page(key, columns, filters, page_size):
+    """Fetch the current patient page for the pager stored under session_state[key]."""
+    return fetch_patients_page(page_size, current_cursor(key, filters, page_size), columns, **filters)
+def pager_controls(key, next_cursor):
+    """Prev/Next buttons for a pager created by current_cursor."""
+    pager = st.session_state[key]
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("Previous", key=f"{key}_prev", disabled=len(pager["cursors"]) <= 1):
+            pager["cursors"].pop()
+            st.rerun()
+    with col2:
+        st.caption(f"Page {len(pager['cursors'])}")
+    with col3:
+        if st.button("Next", key=f"{key}_next", disabled=next_cursor is None):
+            pager["cursors"].append(next_cursor)
+            st.rerun()
+def bulk_progress(total):
+    """Return a progress callback (bulk updates, exports) that drives a progress bar."""
+    bar = st.progress(0.0)
+    def report(done):
+        bar.progress(min(done / total, 1.0) if total else 1.0, text=f"{done:,} / {total:,} records")
+    return report
+@st.fragment(run_every=2)
+@timed("page.job_panel")
+def job_panel(kinds):
+    """Live progress of the most recent background jobs of the given kinds."""
+    jobs = list_jobs(5, kinds)
+    if not jobs:
+        st.caption("No jobs yet.")
+    for job in jobs:
+        label = f"#{job['job_id']} {job['kind']} ({job['created_by']}) – {job['status']}"
+        if job["status"] in ACTIVE_STATUSES:
+            fraction = min(job["done"] / job["total"], 1.0) if job["total"] else 0.0
+            st.progress(fraction, text=f"{label}: {job['done']:,} / {job['total']:,} records")
+            if job["status"] != "cancel_requested" and st.button("Cancel", key=f"cancel_job_{job['job_id']}"):
+                cancel_job(job["job_id"])
+        elif job["status"] == "failed":
+            st.error(f"{label}: {job['error']}")
+        else:
+            st.caption(f"{label}: {job['done']:,} records")
+@st.cache_resource
+def get_crypto_engine():
+    """Process pool shared by all sessions for table-wide encrypt/decrypt."""
+    return ParallelCrypto()
+@timed("page.patients_table")
 def render_patients_table():
-    """Render patient table with role-based masking and error handling."""
+    """Render one page of the patient table with role-based masking and error handling."""
     try:
-        patients = fetch_patients(raw=True)
-        rows = []
-        show_decrypted = st.session_state.get("show_decrypted", False)
-       
-        for p in patients:
-            row = {"patient_id": p["patient_id"], "diagnosis": p.get("diagnosis", "")}
-           
-            if role == "admin":
-                if show_decrypted:
-                    try:
-                        row["name"] = decrypt_value(p["encrypted_name"]) if p.get("encrypted_name") else p.get("name") or "(Plaintext)"
-                    except Exception:
-                        row["name"] = p.get("name") or "[Decryption Failed]"
-                   
-                    try:
-                        row["contact"] = decrypt_value(p["encrypted_contact"]) if p.get("encrypted_contact") else p.get("contact") or "(Plaintext)"
-                    except Exception:
-                        row["contact"] = p.get("contact") or "[Decryption Failed]"
-                else:
-                    row["name"] = p.get("anonymized_name") or anonymize_name(p.get("name") or "")
-                    row["contact"] = p.get("anonymized_contact") or mask_contact(p.get("contact") or "")
-                row["anonymized_name"] = p.get("anonymized_name") or ""
-                row["anonymized_contact"] = p.get("anonymized_contact") or ""
-               
-            elif role == "doctor":
-                row["name"] = p.get("anonymized_name") or anonymize_name(p.get("name") or "")
-                row["contact"] = p.get("anonymized_contact") or mask_contact(p.get("contact") or "")
-            elif role == "receptionist":
-                row["name"] = p.get("name") or ""
-                row["contact"] = p.get("contact") or ""
-           
-            rows.append(row)
+        filters = patient_filter_controls("patients_filter", allow_encryption_filter=role == "admin",
+                                          allow_pseudonym_search=role in ("admin", "doctor"),
+                                          allow_blind_search=role in ("admin", "receptionist"))
+        page_size = st.selectbox("Rows per page", PAGE_SIZES, index=1, key="patients_page_size")
+        patients, next_cursor = fetch_current_page("patients_pager", ROLE_COLUMNS.get(role), filters, page_size)
+        total = count_patients(**filters)
+        rows = build_patient_rows(patients, role, st.session_state.get("show_decrypted", False), user)
        
         df = pd.DataFrame(rows)
        
         if len(df) > 0:
-            st.metric("Total Records", len(df))
+            st.metric("Total Records", total)
             st.dataframe(
                 df,
                 use_container_width=True,
@@ -660,6 +784,7 @@ def render_patients_table():
                     "anonymized_contact": st.column_config.TextColumn("Anonymized Contact", width="medium"),
                 }
             )
+            pager_controls("patients_pager", next_cursor)
         else:
             st.info("No patient records available.")
        
@@ -673,6 +798,9 @@ def render_patients_table():
         st.error(f"Failed to load records: {e}")
         logging.error(f"Table render error: {e}")
 # ============== PAGE CONTENT RENDERING ==============
+# Exactly one page block below runs; its span closes before the footer
+page_timer = ExitStack()
+page_timer.enter_context(span(f"page.{st.session_state['current_tab']}"))
 # --- PAGE: Patients
 if st.session_state["current_tab"] == "patients":
   
@@ -730,7 +858,8 @@ if st.session_state["current_tab"] == "add_patient":
         with col2:
             st.markdown("### Edit Record")
             try:
-                patients_raw = fetch_patients(raw=True)
+                start_id = st.number_input("Jump to ID", min_value=1, value=1, step=1, key="edit_start_id")
+                patients_raw, _ = fetch_patients_page(PAGE_SIZES[1], after_id=start_id - 1, columns=["name"])
                 if not patients_raw:
                     st.info("No records to edit.")
                 else:
@@ -743,7 +872,7 @@ if st.session_state["current_tab"] == "add_patient":
                    
                     if selected:
                         pid = selected[0]
-                        p = next((x for x in patients_raw if x['patient_id'] == pid), None)
+                        p = get_patient(pid)
                         if p:
                             new_diag = st.text_area("Update Notes", value=p.get('diagnosis', ''), key=f"diag_{pid}", height=120)
                            
@@ -770,32 +899,21 @@ if st.session_state["current_tab"] == "anonymize":
         st.divider()
        
         try:
-            patients_all = fetch_patients(raw=True)
-            if not patients_all:
+            if count_patients() == 0:
                 st.info("No data to process.")
             else:
+                # By default only rows whose name/contact changed since the last run are processed
+                reprocess_all = st.checkbox("Re-process unchanged records", value=False)
                 col1, col2 = st.columns(2)
                
                 with col1:
                     st.markdown("### Anonymize Records")
+                    anon_filters = {} if reprocess_all else {"stale": "anonymized"}
+                    st.caption(f"{count_patients(**anon_filters):,} records to process")
                     if st.button("Anonymize All", type="primary"):
-                        count = 0
-                        errors = []
-                       
-                        with st.spinner("Processing..."):
-                            for p in patients_all:
-                                try:
-                                    anon_name = anonymize_name(p.get("name") or "")
-                                    anon_contact = mask_contact(p.get("contact") or "")
-                                    update_patient(p["patient_id"], anonymized_name=anon_name, anonymized_contact=anon_contact)
-                                    add_log(user['user_id'], user['username'], role, "anonymize", f"ID:{p['patient_id']}")
-                                    count += 1
-                                except Exception as e:
-                                    errors.append(f"ID {p['patient_id']}: {e}")
-                       
-                        st.success(f"{count} records anonymized.")
-                        if errors:
-                            st.error(f"{len(errors)} issues encountered.")
+                        job_id = submit_job("anonymize", {"reprocess_all": reprocess_all}, user)
+                        get_job_runner().wake()
+                        st.success(f"Anonymization queued as job #{job_id}.")
                
                 if FERNET_KEY:
                     with col2:
@@ -803,43 +921,39 @@ if st.session_state["current_tab"] == "anonymize":
                         col_enc1, col_enc2 = st.columns(2)
                        
                         with col_enc1:
+                            enc_filters = {} if reprocess_all else {"stale": "encrypted"}
+                            st.caption(f"{count_patients(**enc_filters):,} records to process")
                             if st.button("Encrypt All", type="secondary"):
-                                enc_count = 0
-                                with st.spinner("Securing..."):
-                                    for p in patients_all:
-                                        try:
-                                            en_name = encrypt_value(p.get("name") or "")
-                                            en_contact = encrypt_value(p.get("contact") or "")
-                                            update_patient(p["patient_id"], encrypted_name=en_name, encrypted_contact=en_contact)
-                                            add_log(user['user_id'], user['username'], role, "encrypt", f"ID:{p['patient_id']}")
-                                            enc_count += 1
-                                        except Exception as e:
-                                            logging.error(f"Encrypt error: {e}")
-                                st.success(f"{enc_count} records encrypted.")
+                                job_id = submit_job("encrypt", {"reprocess_all": reprocess_all}, user)
+                                get_job_runner().wake()
+                                st.success(f"Encryption queued as job #{job_id}.")
                        
                         with col_enc2:
-                            if st.button("View Decrypted", type="secondary"):
-                                dec_data = []
-                                with st.spinner("Decrypting..."):
-                                    for p in patients_all:
-                                        try:
-                                            de_name = decrypt_value(p.get("encrypted_name", "")) if p.get("encrypted_name") else "N/A"
-                                            de_contact = decrypt_value(p.get("encrypted_contact", "")) if p.get("encrypted_contact") else "N/A"
-                                            dec_data.append({"ID": p['patient_id'], "Name": de_name, "Contact": de_contact})
-                                        except Exception as e:
-                                            logging.error(f"Decrypt error: {e}")
-                                if dec_data:
-                                    st.dataframe(
-                                        pd.DataFrame(dec_data),
-                                        use_container_width=True,
-                                        hide_index=True,
-                                        column_config={
-                                            "ID": st.column_config.NumberColumn("ID", width="small"),
-                                            "Name": st.column_config.TextColumn("Name", width="medium"),
-                                            "Contact": st.column_config.TextColumn("Contact", width="medium"),
-                                        }
-                                    )
-                                    st.success("Decryption preview complete.")
+                            show_decrypted_page = st.toggle("View Decrypted", key="view_decrypted")
+                    if show_decrypted_page:
+                        # One page at a time; decrypting the whole table belongs in an export
+                        page, next_cursor = fetch_current_page("decrypted_pager", ["encrypted_name", "encrypted_contact"],
+                                                               {"encrypted": True}, PAGE_SIZES[1])
+                        names, _ = decrypt_many([p.get("encrypted_name") for p in page])
+                        contacts, _ = decrypt_many([p.get("encrypted_contact") for p in page])
+                        dec_data = [{"ID": p["patient_id"],
+                                     "Name": name if name is not None else "N/A",
+                                     "Contact": contact if contact is not None else "N/A"}
+                                    for p, name, contact in zip(page, names, contacts)]
+                        if dec_data:
+                            st.dataframe(
+                                pd.DataFrame(dec_data),
+                                use_container_width=True,
+                                hide_index=True,
+                                column_config={
+                                    "ID": st.column_config.NumberColumn("ID", width="small"),
+                                    "Name": st.column_config.TextColumn("Name", width="medium"),
+                                    "Contact": st.column_config.TextColumn("Contact", width="medium"),
+                                }
+                            )
+                            pager_controls("decrypted_pager", next_cursor)
+                        else:
+                            st.info("No encrypted records yet.")
                 else:
                     st.warning("No encryption key. Generate one?")
                     if st.button("Generate Key", type="secondary"):
@@ -851,6 +965,9 @@ if st.session_state["current_tab"] == "anonymize":
                         except Exception as e:
                             st.error(f"Key gen failed: {e}")
        
+           
+            st.markdown("### Background Jobs")
+            job_panel(["anonymize", "encrypt"])
         except Exception as e:
             st.error(f"Tool error: {e}")
             logging.error(f"Anonymize error: {e}")
@@ -862,28 +979,61 @@ if st.session_state["current_tab"] == "logs":
         st.info("Logs: Admin view only.")
     else:
         st.markdown("<h2>Audit Trail</h2>", unsafe_allow_html=True)
+        spilled = audit_writer.fallback_entries()
+        if spilled:
+            st.warning(f"{spilled} audit entries are waiting in {FALLBACK_FILE}; they are replayed after the next successful log write.")
         st.divider()
        
         try:
-            logs = fetch_logs(limit=1000)
+            # Filters run in SQL; pages are fetched by (timestamp, log_id) cursor
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                filter_action = st.selectbox("Filter Action", options=["All"] + fetch_log_actions())
+                filter_role = st.selectbox("Filter Role", options=["All", "admin", "doctor", "receptionist", "system"])
+            with col2:
+                filter_user = st.text_input("Username", key="logs_username")
+                page_size = st.selectbox("Rows per page", PAGE_SIZES, index=2, key="logs_page_size")
+            with col3:
+                log_from = st.date_input("From", value=None, key="logs_from")
+                log_to = st.date_input("To", value=None, key="logs_to")
+            log_filters = {}
+            if filter_action != "All":
+                log_filters["action"] = filter_action
+            if filter_role != "All":
+                log_filters["role"] = filter_role
+            if filter_user.strip():
+                log_filters["username"] = filter_user.strip()
+            if log_from:
+                log_filters["start_day"] = log_from.isoformat()
+            if log_to:
+                log_filters["end_day"] = log_to.isoformat()
+           
+            logs, next_cursor = fetch_logs_page(page_size, current_cursor("logs_pager", log_filters, page_size), **log_filters)
             if logs:
                 df_logs = pd.DataFrame(logs)
                 df_logs['timestamp'] = pd.to_datetime(df_logs['timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
                
-                filter_action = st.selectbox("Filter Action", options=["All"] + sorted(df_logs['action'].unique()))
-               
-                if filter_action != "All":
-                    df_logs = df_logs[df_logs['action'] == filter_action].copy()
-               
+                log_total = count_logs(**log_filters)
                 col1, col2 = st.columns([3, 1])
                 with col1:
-                    st.metric("Total Entries", len(df_logs))
+                    st.metric("Total Entries", f"{log_total:,}")
                 with col2:
                     csv = df_logs.to_csv(index=False).encode("utf-8")
-                    if st.download_button("Download Audit Log", csv, "audit_log.csv", "text/csv", use_container_width=True):
+                    if st.download_button("Download This Page", csv, "audit_log.csv", "text/csv", use_container_width=True):
                         add_log(user['user_id'], user['username'], role, "export_logs", f"{len(df_logs)} entries")
+                    log_cli_args = ["logs", "audit_log_full.csv"]
+                    for key, value in log_filters.items():
+                        log_cli_args += [f"--{key.replace('_', '-')}", value]
+                    if not export_too_large(log_total, log_cli_args) and st.button("Export All Matching", use_container_width=True):
+                        # Streamed from SQL in chunks; the file is capped at UI_EXPORT_MAX_ROWS for the download
+                        with tempfile.TemporaryFile() as export_file:
+                            written = export_logs(export_file, **log_filters)
+                            export_file.seek(0)
+                            st.download_button("Download Audit Log", export_file.read(), "audit_log_full.csv", "text/csv", use_container_width=True)
+                        add_log(user['user_id'], user['username'], role, "export_logs", f"{written} entries (all matching)")
                
                 st.dataframe(df_logs[['timestamp', 'username', 'role', 'action', 'details']], use_container_width=True)
+                pager_controls("logs_pager", next_cursor)
             else:
                 st.info("No logs recorded yet.")
         except Exception as e:
@@ -900,38 +1050,32 @@ if st.session_state["current_tab"] == "backup":
         st.divider()
        
         try:
-            patients = fetch_patients(raw=True)
-            if not patients:
+            total = count_patients()
+            if not total:
                 st.info("No data for export.")
             else:
-                df_export = pd.DataFrame(patients)
-               
                 decrypt_export = st.checkbox("Include Decrypted (Sensitive)", value=False)
+                export_mode = "decrypted" if decrypt_export else "anonymized"
+                export_format = st.selectbox("Format", FORMATS, key="export_format")
                
                 if decrypt_export:
                     st.warning("Exporting sensitive data – secure handling required.")
-                    def decrypt_export_row(r):
-                        try:
-                            if r.get("encrypted_name"):
-                                r["name"] = decrypt_value(r["encrypted_name"])
-                            if r.get("encrypted_contact"):
-                                r["contact"] = decrypt_value(r["encrypted_contact"])
-                        except:
-                            pass
-                        return r
-                    df_export = df_export.apply(decrypt_export_row, axis=1)
-                else:
-                    df_export["name"] = df_export.apply(lambda r: r.get("anonymized_name") or anonymize_name(r.get("name", "")), axis=1)
-                    df_export["contact"] = df_export.apply(lambda r: r.get("anonymized_contact") or mask_contact(r.get("contact", "")), axis=1)
                
-                export_df = df_export[["patient_id", "name", "contact", "diagnosis", "date_added"]]
-                st.metric("Records Ready", len(export_df))
-                st.dataframe(export_df, use_container_width=True)
+                # Preview only the first page; the full export is streamed chunk by chunk
+                preview, _ = fetch_patients_page(PAGE_SIZES[1])
+                st.metric("Records Ready", total)
+                st.dataframe(pd.DataFrame(transform_patients(preview, export_mode)), use_container_width=True)
                
-                if st.button("Download CSV", type="primary"):
-                    csv = export_df.to_csv(index=False).encode()
-                    st.download_button("Export Patients", csv, "patients_export.csv", "text/csv")
-                    add_log(user['user_id'], user['username'], role, "export_patients", f"{len(export_df)} records")
+                patient_cli_args = ["patients", f"patients_export.{export_format}", "--format", export_format, "--mode", export_mode]
+                if not export_too_large(total, patient_cli_args) and st.button("Prepare Export", type="primary"):
+                    progress = bulk_progress(total)
+                    engine = get_crypto_engine() if decrypt_export else None
+                    with tempfile.TemporaryFile() as export_file:
+                        written = export_patients(export_file, export_format, export_mode, progress=progress, engine=engine)
+                        export_file.seek(0)
+                        st.download_button("Export Patients", export_file.read(), f"patients_export.{export_format}",
+                                           MIME_TYPES[export_format])
+                    add_log(user['user_id'], user['username'], role, "export_patients", f"{written} records ({export_format}, {export_mode})")
         except Exception as e:
             st.error(f"Export error: {e}")
             logging.error(f"Backup error: {e}")
@@ -946,31 +1090,36 @@ if st.session_state["current_tab"] == "activity":
         st.divider()
        
         try:
-            logs = fetch_logs(limit=5000)
-            if logs:
-                df_logs = pd.DataFrame(logs)
-                df_logs["timestamp"] = pd.to_datetime(df_logs["timestamp"])
-                df_logs["date"] = df_logs["timestamp"].dt.date
-               
+            # Counts come from the rollup tables, so the charts cover the full history
+            ranges = {"All time": None, "Last 30 days": 30, "Last 90 days": 90, "Last 365 days": 365}
+            range_label = st.selectbox("Range", list(ranges), key="activity_range")
+            days = ranges[range_label]
+            start_day = (datetime.utcnow() - timedelta(days=days)).date().isoformat() if days else None
+            daily = fetch_activity_by_day(start_day)
+            if daily:
                 col1, col2 = st.columns(2)
                
                 with col1:
                     st.markdown("### Daily Actions")
-                    activity_pivot = df_logs.groupby(["date", "action"]).size().reset_index(name="count").pivot(index="date", columns="action", values="count").fillna(0)
+                    activity_pivot = pd.DataFrame(daily).pivot(index="day", columns="action", values="count").fillna(0)
                     st.line_chart(activity_pivot)
                
                 with col2:
                     st.markdown("### User Activity")
-                    user_counts = df_logs.groupby("username").size().reset_index(name="actions").sort_values("actions", ascending=False)
+                    user_counts = pd.DataFrame(fetch_activity_by_user(start_day))
                     st.bar_chart(user_counts.set_index("username"))
                
                 st.divider()
                 st.markdown("### Recent Events")
-                recent = df_logs[["timestamp", "username", "role", "action", "details"]].head(50)
-                recent["timestamp"] = recent["timestamp"].dt.strftime('%Y-%m-%d %H:%M')
+                recent = pd.DataFrame(fetch_logs_page(50)[0])[["timestamp", "username", "role", "action", "details"]]
+                recent["timestamp"] = pd.to_datetime(recent["timestamp"]).dt.strftime('%Y-%m-%d %H:%M')
                 st.dataframe(recent, use_container_width=True)
             else:
                 st.info("No activity data yet.")
+           
+            with st.expander("Read cache"):
+                # Hit rates since this server process started, across all sessions
+                st.dataframe(pd.DataFrame(cache_stats()), use_container_width=True, hide_index=True)
         except Exception as e:
             st.error(f"Analytics error: {e}")
             logging.error(f"Activity error: {e}")
@@ -982,67 +1131,108 @@ if st.session_state["current_tab"] == "retention":
         st.warning("Retention: Admin only.")
     else:
         st.markdown("<h2>Data Retention</h2>", unsafe_allow_html=True)
-        st.info("GDPR Policy: Records auto-anonymized after 365 days for privacy.")
+        st.info(f"GDPR Policy: Records auto-anonymized after {RETENTION_DAYS} days for privacy.")
         st.divider()
        
         try:
-            RETENTION_DAYS = 365
-            patients = fetch_patients(raw=True)
-           
             now = datetime.utcnow()
-            due_for_retention = []
-            upcoming = []
-           
-            for p in patients:
-                added = datetime.fromisoformat(p['date_added'])
-                days_old = (now - added).days
-                if days_old > RETENTION_DAYS:
-                    due_for_retention.append({"ID": p['patient_id'], "Days Over": days_old - RETENTION_DAYS, "Name": p.get('name', 'Unknown')})
-                else:
-                    upcoming.append({"ID": p['patient_id'], "Days Until": RETENTION_DAYS - days_old})
+            cutoff = retention_cutoff(now=now)
+            total = count_patients()
+            due_count = count_patients(added_to=cutoff, retained=False)
            
             col1, col2, col3 = st.columns(3)
             with col1:
-                st.metric("Total", len(patients))
+                st.metric("Total", total)
             with col2:
-                st.metric("Due Now", len(due_for_retention))
+                st.metric("Due Now", due_count)
             with col3:
                 st.metric("Policy", f"{RETENTION_DAYS} days")
            
-            if due_for_retention:
-                st.warning(f"{len(due_for_retention)} records overdue for anonymization.")
+            if due_count:
+                due_page, _ = fetch_patients_page(PAGE_SIZES[2], columns=["name", "date_added"], added_to=cutoff, retained=False)
+                due_for_retention = []
+                for p in due_page:
+                    days_old = (now - datetime.fromisoformat(p['date_added'])).days
+                    due_for_retention.append({"ID": p['patient_id'], "Days Over": days_old - RETENTION_DAYS, "Name": p.get('name', 'Unknown')})
+                st.warning(f"{due_count} records overdue for anonymization.")
                 st.markdown("### Overdue List")
                 st.dataframe(pd.DataFrame(due_for_retention))
                
                 if st.button("Process Now", type="primary"):
-                    count = 0
-                    with st.spinner("Applying retention..."):
-                        for p in patients:
-                            added = datetime.fromisoformat(p['date_added'])
-                            if now - added > timedelta(days=RETENTION_DAYS):
-                                try:
-                                    update_patient(p['patient_id'],
-                                                 anonymized_name="REDACTED",
-                                                 anonymized_contact="REDACTED",
-                                                 name="ARCHIVED",
-                                                 contact="ARCHIVED")
-                                    add_log(user['user_id'], user['username'], role, "retention_cleanup", f"ID:{p['patient_id']}")
-                                    count += 1
-                                except Exception as e:
-                                    logging.error(f"Retention failed: {e}")
-                    st.success(f"{count} records processed.")
+                    job_id = submit_job("retention", {"cutoff": cutoff, "trigger": "manual"}, user)
+                    get_job_runner().wake()
+                    st.success(f"Retention queued as job #{job_id}.")
             else:
                 st.success("All records compliant.")
-                if upcoming:
+                # Lowest IDs first, which in practice are the records closest to the deadline
+                upcoming_page, _ = fetch_patients_page(10, columns=["date_added"], added_from=cutoff)
+                if upcoming_page:
+                    upcoming = [{"ID": p['patient_id'], "Days Until": RETENTION_DAYS - (now - datetime.fromisoformat(p['date_added'])).days}
+                                for p in upcoming_page]
                     st.markdown("### Upcoming")
                     upcoming_df = pd.DataFrame(upcoming).sort_values("Days Until")
-                    st.dataframe(upcoming_df.head(10))
+                    st.dataframe(upcoming_df)
        
+           
+            st.markdown("### Background Jobs")
+            scheduler = get_retention_scheduler()
+            if scheduler.next_run_at:
+                st.caption(f"Next scheduled run: {scheduler.next_run_at.strftime('%Y-%m-%d %H:%M UTC')}")
+            job_panel(["retention"])
+            runs = retention_runs(10)
+            if runs:
+                st.markdown("### Recent Runs")
+                st.dataframe(pd.DataFrame(runs)[["run_id", "started_at", "trigger", "status", "processed", "seconds", "rows_per_sec"]],
+                             use_container_width=True, hide_index=True)
         except Exception as e:
             st.error(f"Retention error: {e}")
             logging.error(f"Retention error: {e}")
        
         st.markdown('</div>', unsafe_allow_html=True)
+# --- PAGE: Diagnostics
+if st.session_state["current_tab"] == "diagnostics":
+    if role != "admin":
+        st.warning("Diagnostics: Admin only.")
+    else:
+        st.markdown("<h2>Diagnostics</h2>", unsafe_allow_html=True)
+        st.divider()
+       
+        try:
+            profile_reruns = st.checkbox("Profile my reruns (cProfile)", value=st.session_state.get("perf_profile", False),
+                                         help="Adds noticeable overhead; applies to this session from the next rerun.")
+            st.session_state["perf_profile"] = profile_reruns
+            history = st.session_state.get("perf_history", [])
+            if history:
+                # The current rerun is still running, so everything here describes earlier ones
+                last = history[-1]
+                st.markdown("### Previous Rerun")
+                col1, col2, col3, col4, col5 = st.columns(5)
+                col1.metric("Total", f"{last['total_ms']:.0f} ms")
+                col2.metric("Database", f"{last['db_ms']:.0f} ms")
+                col3.metric("Crypto/Anonymize", f"{last['utils_ms']:.0f} ms")
+                col4.metric("UI/pandas", f"{last['other_ms']:.0f} ms")
+                col5.metric("SQL statements", last["queries"])
+                st.dataframe(pd.DataFrame([{"span": name, **s} for name, s in last["spans"].items()]),
+                             use_container_width=True, hide_index=True)
+                if last.get("profile"):
+                    with st.expander("cProfile (cumulative)"):
+                        st.code(last["profile"])
+                st.markdown("### This Session")
+                st.dataframe(pd.DataFrame(history)[["at", "tab", "total_ms", "db_ms", "utils_ms", "other_ms", "queries"]],
+                             use_container_width=True, hide_index=True)
+           
+            st.markdown("### Server Totals")
+            totals = span_totals()
+            if totals:
+                st.dataframe(pd.DataFrame(totals), use_container_width=True, hide_index=True)
+            if st.button("Reset Totals", type="secondary"):
+                reset_totals()
+                st.rerun()
+            st.caption(f"Per-rerun records are appended to {PERF_LOG}." if PERF_LOG else "Perf log file disabled (PERF_LOG).")
+        except Exception as e:
+            st.error(f"Diagnostics error: {e}")
+            logging.error(f"Diagnostics error: {e}")
+page_timer.close()
 # --- Footer
 st.markdown("""
 ### Security & Compliance
@@ -1057,4 +1247,7 @@ with col1:
 with col2:
     st.metric("Logs", "Enabled")
 with col3:
-    st.metric("Updated", datetime.utcnow().strftime("%H:%M:%S UTC"))
\ No newline at end of file
+    st.metric("Updated", datetime.utcnow().strftime("%H:%M:%S UTC"))
+perf = end_rerun(session=st.session_state["perf_session"], role=role, tab=st.session_state["current_tab"])
+if perf:
+    st.session_state["perf_history"] = (st.session_state.get("perf_history", []) + [perf])[-20:]
@@ -0,0 +1,52 @@
+# tests/conftest.py
+"""
+Shared fixtures. Every test runs against a fresh database built by
+db_setup.ensure_db in a temp directory; key files are created in a scratch
+working directory, so hospital.db and the repo's keys are never touched.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Before the app modules are imported: they read these at import time
+os.environ.setdefault("AUDIT_MODE", "sync")
+os.environ["PERF_LOG"] = ""
+os.chdir(tempfile.mkdtemp(prefix="hospital_tests_"))
+
+from cryptography.fernet import Fernet  # noqa: E402
+
+with open("fernet.key", "wb") as f:
+    f.write(Fernet.generate_key())
+
+import pytest  # noqa: E402
+
+import db  # noqa: E402
+import db_setup  # noqa: E402
+import utils  # noqa: E402
+
+utils.reload_keys()
+
+@pytest.fixture
+def temp_db(tmp_path):
+    """Point db and db_setup at a freshly created database for one test."""
+    saved = (db.DB_PATH, db_setup.DB_PATH)
+    path = str(tmp_path / "hospital.db")
+    db.close_pools()
+    db.DB_PATH = db_setup.DB_PATH = path
+    db_setup.ensure_db(path)
+    try:
+        yield path
+    finally:
+        db.close_pools()
+        db.DB_PATH, db_setup.DB_PATH = saved
+
+@pytest.fixture
+def patients(temp_db):
+    """temp_db with a few more patients; returns every patient_id in order."""
+    for i in range(23):
+        db.add_patient(f"Patient {i:02d} Example", f"0300-{i:03d}-0000", "Checkup", f"2024-01-{i % 28 + 1:02d}T00:00:00")
+    with db.get_conn(readonly=True) as conn:
+        return [r[0] for r in conn.execute("SELECT patient_id FROM patients ORDER BY patient_id")]
@@ -0,0 +1,113 @@
+# tests/test_audit.py
+import threading
+
+import pytest
+
+import audit
+import db
+
+def test_sync_writes_inline():
+    written = []
+    writer = audit.AuditWriter(written.extend, mode="sync")
+    writer.submit(("a",))
+    assert written == [("a",)] and writer._thread is None
+
+def test_ack_returns_after_commit():
+    written = []
+    writer = audit.AuditWriter(written.extend, mode="ack")
+    for i in range(5):
+        writer.submit((i,))
+        assert written[-1] == (i,)
+
+def test_async_batches_in_order_and_flushes():
+    written, batches = [], []
+    release = threading.Event()
+
+    def write(rows):
+        release.wait(5)
+        batches.append(len(rows))
+        written.extend(rows)
+
+    writer = audit.AuditWriter(write, mode="async", interval=0.05)
+    for i in range(200):
+        writer.submit((i,))
+    release.set()
+    assert writer.flush(5)
+    assert written == [(i,) for i in range(200)]
+    assert len(batches) < 200  # shared commits, not one per entry
+
+def test_writer_survives_a_failing_fallback(monkeypatch, tmp_path):
+    monkeypatch.setattr(audit, "WRITE_RETRIES", 0)
+    monkeypatch.setattr(audit, "FALLBACK_FILE", str(tmp_path / "missing" / "fallback.jsonl"))
+    written, fail = [], [True]
+
+    def write(rows):
+        if fail[0]:
+            raise OSError("disk full")
+        written.extend(rows)
+
+    writer = audit.AuditWriter(write, mode="ack")
+    with pytest.raises(audit.AuditWriteError):
+        writer.submit(("lost",))
+    assert writer.stats["lost"] == 1 and writer._thread.is_alive()
+    fail[0] = False
+    writer.submit(("kept",))
+    assert written == [("kept",)]
+
+def test_spilled_entries_are_replayed_once_writes_succeed(monkeypatch, tmp_path):
+    monkeypatch.setattr(audit, "WRITE_RETRIES", 0)
+    monkeypatch.setattr(audit, "FALLBACK_FILE", str(tmp_path / "fallback.jsonl"))
+    written, fail = [], [True]
+
+    def write(rows):
+        if fail[0]:
+            raise OSError("database is locked")
+        written.extend(rows)
+
+    writer = audit.AuditWriter(write, mode="ack", batch_size=2)
+    for i in range(5):
+        writer.submit(("spilled", i))
+    assert writer.fallback_entries() == 5 and written == []
+
+    fail[0] = False
+    writer.submit(("fresh", 0))
+    assert written == [("fresh", 0)] + [("spilled", i) for i in range(5)]
+    assert writer.fallback_entries() == 0 and not list(tmp_path.iterdir())
+    assert writer.stats == {"submitted": 6, "written": 1, "batches": 1, "spilled": 5, "replayed": 5, "lost": 0}
+
+def test_replay_keeps_what_was_not_committed(monkeypatch, tmp_path):
+    monkeypatch.setattr(audit, "FALLBACK_FILE", str(tmp_path / "fallback.jsonl"))
+    written = []
+    writer = audit.AuditWriter(written.extend, mode="sync", batch_size=2)
+    writer._spill([("old", i) for i in range(5)], "test")
+
+    def write(rows):
+        if rows[0][0] == "old" and len(written) >= 3:  # fails on the second replay batch
+            raise OSError("database is locked")
+        written.extend(rows)
+
+    writer.write_batch = write
+    writer.submit(("new", 0))
+    assert written == [("new", 0), ("old", 0), ("old", 1)]
+    assert writer.fallback_entries() == 3
+
+    writer.write_batch = written.extend
+    writer.submit(("new", 1))
+    assert written[-3:] == [("old", 2), ("old", 3), ("old", 4)]
+    assert writer.fallback_entries() == 0
+
+def test_ack_wait_is_bounded(monkeypatch):
+    monkeypatch.setattr(audit, "ACK_TIMEOUT", 0.1)
+    release = threading.Event()
+    writer = audit.AuditWriter(lambda rows: release.wait(5), mode="ack")
+    with pytest.raises(audit.AuditWriteError):
+        writer.submit(("slow",))
+    assert not writer.flush(0.1)
+    release.set()
+    assert writer.flush(5)
+
+def test_add_log_reaches_the_logs_table(temp_db):
+    db.add_log(1, "admin", "admin", "login", "from test")
+    assert db.flush_logs()
+    rows, _ = db.fetch_logs_page(action="login")
+    assert rows[0]["details"] == "from test"
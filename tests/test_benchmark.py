@@ -0,0 +1,12 @@
+# tests/test_benchmark.py
+import os
+
+import benchmark
+import db
+
+def test_temp_database_is_isolated_and_removed():
+    before = db.DB_PATH
+    with benchmark.temp_database() as path:
+        assert db.DB_PATH == path and os.path.exists(path)
+        assert db.count_patients() == 2
+    assert db.DB_PATH == before and not os.path.exists(path)
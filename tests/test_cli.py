@@ -0,0 +1,29 @@
+# tests/test_cli.py
+import pytest
+
+import cli
+import db
+import jobs
+
+def _run(*argv):
+    with pytest.raises(SystemExit) as exit:
+        cli.main(["--db", db.DB_PATH, "--quiet", *argv])
+    return exit.value.code
+
+def test_dry_run_changes_nothing(patients, capsys):
+    assert _run("anonymize", "--dry-run") == 0
+    assert f"would process {len(patients)} records" in capsys.readouterr().out
+    assert db.count_patients(stale="anonymized") == len(patients) and jobs.list_jobs() == []
+
+def test_anonymize_runs_a_job_and_audits_it(patients):
+    assert _run("anonymize", "--chunk-size", "7") == 0
+    assert db.count_patients(stale="anonymized") == 0
+    job = jobs.list_jobs(1)[0]
+    assert (job["kind"], job["status"], job["created_by"]) == ("anonymize", "finished", cli._cli_user()["username"])
+    assert _run("anonymize") == 0  # nothing left: no new job
+    assert len(jobs.list_jobs()) == 1
+
+def test_export_is_audited(patients, tmp_path):
+    assert _run("export", "patients", str(tmp_path / "out.csv")) == 0
+    rows, _ = db.fetch_logs_page(action="export_patients")
+    assert rows[0]["details"].startswith(f"{len(patients)} rows (csv, anonymized)")
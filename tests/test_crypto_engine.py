@@ -0,0 +1,43 @@
+# tests/test_crypto_engine.py
+import threading
+
+import crypto_engine
+from crypto_engine import ParallelCrypto
+
+def test_parallel_round_trip_keeps_order(monkeypatch):
+    monkeypatch.setattr(crypto_engine, "MIN_PARALLEL_ITEMS", 0)
+    values = [f"value {i}" for i in range(25)]
+    with ParallelCrypto(workers=2, chunk_size=4) as engine:
+        tokens, errors = engine.encrypt(values)
+        assert not errors and engine._pool is not None
+        tokens[6] = "not a token"
+        plain, errors = engine.decrypt(tokens)
+    assert plain[:6] == values[:6] and plain[7:] == values[7:]
+    assert plain[6] is None and list(errors) == [6]
+    assert engine._pool is None
+
+def test_small_inputs_stay_in_process():
+    engine = ParallelCrypto(workers=4)
+    tokens, _ = engine.encrypt(["a", "b"])
+    assert engine.decrypt(tokens)[0] == ["a", "b"] and engine._pool is None
+
+def test_shared_engine_starts_one_pool(monkeypatch):
+    monkeypatch.setattr(crypto_engine, "MIN_PARALLEL_ITEMS", 0)
+    started = []
+    real_pool = crypto_engine.ProcessPoolExecutor
+    monkeypatch.setattr(crypto_engine, "ProcessPoolExecutor", lambda **kw: started.append(1) or real_pool(**kw))
+    values = [f"value {i}" for i in range(20)]
+    barrier = threading.Barrier(6)
+    results = []
+
+    def session():
+        barrier.wait()
+        results.append(engine.decrypt(engine.encrypt(values)[0])[0])
+
+    with ParallelCrypto(workers=2, chunk_size=4) as engine:
+        threads = [threading.Thread(target=session) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    assert len(started) == 1 and results == [values] * 6
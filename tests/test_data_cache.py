@@ -0,0 +1,38 @@
+# tests/test_data_cache.py
+import pytest
+
+pytest.importorskip("streamlit")
+
+import data_cache  # noqa: E402
+import db  # noqa: E402
+
+def test_reads_are_cached_until_their_table_changes(temp_db):
+    calls = []
+
+    def count_diagnoses(diagnosis):
+        calls.append(diagnosis)
+        return db.count_patients(diagnosis=diagnosis)
+
+    cached = data_cache.cached_read("patients")(count_diagnoses)
+    assert cached("Flu") == 1 and cached("Flu") == 1
+    assert calls == ["Flu"]
+
+    db.add_log(1, "admin", "admin", "login")  # other tables do not invalidate
+    assert cached("Flu") == 1 and calls == ["Flu"]
+
+    db.add_patient("Flo Flu", "0300-000-0001", "Flu", "2024-01-01T00:00:00")
+    assert cached("Flu") == 2 and calls == ["Flu", "Flu"]
+    stats = {s["function"]: s for s in data_cache.cache_stats()}["count_diagnoses"]
+    assert (stats["calls"], stats["misses"]) == (4, 2)
+
+def test_log_reads_flush_only_a_non_empty_queue(temp_db, monkeypatch):
+    import audit
+    monkeypatch.setattr(db, "audit_writer", audit.AuditWriter(db._write_log_batch, mode="async", interval=60))
+    flushes = []
+    flush = db.flush_logs
+    monkeypatch.setattr(db, "flush_logs", lambda *a: flushes.append(1) or flush(*a))
+
+    db.add_log(1, "admin", "admin", "login")
+    assert data_cache.count_logs(action="login") == 1 and len(flushes) == 1
+    assert data_cache.count_logs(action="login") == 1 and len(flushes) == 1  # nothing queued: no flush
+    assert data_cache.fetch_logs_page(action="login")[0][0]["action"] == "login" and len(flushes) == 1
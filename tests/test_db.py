@@ -0,0 +1,79 @@
+# tests/test_db.py
+import sqlite3
+
+import pytest
+
+import db
+from utils import blind_search_filters, name_digest, pseudonym_from_digest
+
+def test_patient_pages_return_every_row_once(patients):
+    seen, cursor = [], None
+    while True:
+        rows, cursor = db.fetch_patients_page(page_size=10, after_id=cursor)
+        seen += [r["patient_id"] for r in rows]
+        if cursor is None:
+            break
+    assert seen == patients
+    assert [r["patient_id"] for page in db.iter_patient_pages(7) for r in page] == patients
+
+def test_log_pages_are_newest_first_without_gaps(temp_db):
+    db.add_logs([(None, "admin", "admin", "login", f"entry {i}") for i in range(30)])
+    seen, cursor = [], None
+    while True:
+        rows, cursor = db.fetch_logs_page(page_size=7, before=cursor, action="login")
+        seen += rows
+        if cursor is None:
+            break
+    keys = [(r["timestamp"], r["log_id"]) for r in seen]
+    assert keys == sorted(keys, reverse=True)
+    assert len(seen) == len(set(keys)) == 30 == db.count_logs(action="login")
+
+def test_pseudonym_collision_is_rejected_and_rolled_back(temp_db):
+    john, jane = name_digest("John Doe"), name_digest("Jane Smith")
+    clash = pseudonym_from_digest(john)
+    with pytest.raises(db.PseudonymCollision):
+        db.store_pseudonyms([(clash, "***", john, 1, 1), (clash, "***", jane, 1, 2)])
+    assert {p["anonymized_name"] for p in db.fetch_patients()} == {""}
+
+    db.store_pseudonyms([(pseudonym_from_digest(john), "***", john, 1, 1)])
+    assert db.fetch_patients_page(pseudonym=pseudonym_from_digest(john))[0][0]["patient_id"] == 1
+
+def _names(**filters):
+    return sorted(p["name"] for p in db.fetch_patients_page(**filters)[0])
+
+def test_blind_index_search(temp_db):
+    db.add_patient("Janet O'Brien", "jobrien@example.com", "Flu", "2024-01-01T00:00:00")
+    assert _names(**blind_search_filters("jan")) == ["Jane Smith", "Janet O'Brien"]
+    assert _names(**blind_search_filters("JANE smi")) == ["Jane Smith"]
+    assert _names(**blind_search_filters("o'brien janet", exact=True)) == []
+    assert _names(**blind_search_filters("janet o brien", exact=True)) == ["Janet O'Brien"]
+    assert _names(**blind_search_filters("0300 999 4592")) == ["Jane Smith"]
+    assert _names(**blind_search_filters("JOBrien@Example.com")) == ["Janet O'Brien"]
+    assert db.count_patients(**blind_search_filters("ja")) == 0  # shorter than BLIND_PREFIX_MIN and no whole word
+
+    db.update_patient(2, name="Mary Major")
+    assert _names(**blind_search_filters("smith")) == []
+    assert _names(**blind_search_filters("maj")) == ["Mary Major"]
+
+def test_busy_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(db, "BUSY_BACKOFF", 0)
+    calls = []
+
+    @db.with_busy_retry
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        return "ok"
+
+    assert flaky() == "ok" and len(calls) == 3
+
+    @db.with_busy_retry
+    def broken():
+        calls.append(1)
+        raise sqlite3.OperationalError("no such table: nope")
+
+    calls.clear()
+    with pytest.raises(sqlite3.OperationalError):
+        broken()
+    assert len(calls) == 1
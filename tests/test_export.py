@@ -0,0 +1,32 @@
+# tests/test_export.py
+import csv
+import io
+
+import db
+import export
+from utils import encrypt_many
+
+def _read(buffer):
+    return list(csv.DictReader(io.StringIO(buffer.getvalue().decode("utf-8"))))
+
+def test_anonymized_export_has_no_plaintext(patients):
+    out = io.BytesIO()
+    assert export.export_patients(out, "csv", "anonymized", chunk_size=7) == len(patients)
+    rows = _read(out)
+    assert [int(r["patient_id"]) for r in rows] == patients
+    assert not any("Patient" in r["name"] or "John" in r["name"] for r in rows)
+    assert all(r["name"].startswith("ANON_") for r in rows)
+
+def test_decrypted_export(temp_db):
+    names, _ = encrypt_many(["John Doe"])
+    db.update_patient(1, encrypted_name=names[0], name="")
+    out = io.BytesIO()
+    export.export_patients(out, "csv", "decrypted")
+    assert _read(out)[0]["name"] == "John Doe"
+
+def test_log_export_follows_filters(temp_db):
+    db.add_logs([(None, "admin", "admin", "login", str(i)) for i in range(12)] +
+                [(None, "drbob", "doctor", "logout", "x")])
+    out = io.BytesIO()
+    assert export.export_logs(out, "csv", chunk_size=5, action="login") == 12
+    assert {r["action"] for r in _read(out)} == {"login"}
@@ -0,0 +1,34 @@
+# tests/test_instrumentation.py
+import db
+import instrumentation
+from instrumentation import timed
+
+@timed("utils.outer")
+def outer():
+    return inner() + inner()
+
+@timed("utils.inner")
+def inner():
+    return 1
+
+def test_rerun_records_spans_and_queries(temp_db):
+    db.close_pools()  # the trace callback is installed when a connection is borrowed
+    instrumentation.start_rerun()
+    assert outer() == 2
+    db.get_patient(1)
+    summary = instrumentation.end_rerun(tab="test")
+    assert summary["tab"] == "test"
+    assert summary["spans"]["utils.inner"]["calls"] == 2
+    assert summary["spans"]["db.get_patient"]["calls"] == 1
+    assert summary["queries"] >= 1 and summary["statements"].get("SELECT", 0) >= 1
+    # Nested spans of one category count once towards it
+    assert summary["utils_ms"] <= summary["total_ms"]
+    assert instrumentation.end_rerun() is None
+
+def test_background_threads_are_not_traced(temp_db):
+    db.close_pools()
+    with db.get_conn(readonly=True) as conn:
+        conn.execute("SELECT 1")
+    instrumentation.start_rerun()
+    summary = instrumentation.end_rerun()
+    assert summary["queries"] == 0
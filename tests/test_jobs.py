@@ -0,0 +1,85 @@
+# tests/test_jobs.py
+import threading
+import time
+from datetime import datetime, timedelta
+
+import db
+import jobs
+
+def _age(job_id, seconds):
+    """Pretend the job's last checkpoint was seconds ago."""
+    then = (datetime.utcnow() - timedelta(seconds=seconds)).isoformat()
+    with db.get_conn() as conn:
+        conn.execute("UPDATE jobs SET updated_at = ? WHERE job_id = ?", (then, job_id))
+
+def test_anonymize_job_runs_to_completion(patients):
+    job_id = jobs.submit_job("anonymize", {"chunk_size": 5})
+    assert jobs.submit_job("anonymize") == job_id  # no duplicate while one is active
+    job = jobs.claim_next_job("test")
+    assert job["job_id"] == job_id and jobs.claim_next_job("other") is None
+    assert jobs.run_job(job) == "finished"
+    job = jobs.get_job(job_id)
+    assert job["done"] == job["total"] == len(patients)
+    assert db.count_patients(stale="anonymized") == 0
+    assert db.count_logs(action="anonymize") == len(patients)
+
+def test_cancel_queued_and_running(patients):
+    job_id = jobs.submit_job("anonymize")
+    jobs.cancel_job(job_id)
+    assert jobs.get_job(job_id)["status"] == "cancelled"
+
+    job_id = jobs.submit_job("anonymize", {"chunk_size": 5})
+    job = jobs.claim_next_job("test")
+    jobs.cancel_job(job_id)
+    assert jobs.get_job(job_id)["status"] == "cancel_requested"
+    assert jobs.run_job(job) == "cancelled"
+    assert jobs.get_job(job_id)["done"] == 0
+    assert db.count_patients(stale="anonymized") == len(patients)  # the first chunk was rolled back
+
+def test_stale_job_is_taken_over_and_resumed(patients):
+    job_id = jobs.submit_job("anonymize", {"chunk_size": 5})
+    first = jobs.claim_next_job("runner-a")
+    with db.get_conn() as conn:
+        conn.execute("UPDATE jobs SET done = 5, last_patient_id = ? WHERE job_id = ?", (patients[4], job_id))
+    _age(job_id, jobs.STALE_AFTER + 1)
+
+    second = jobs.claim_next_job("runner-b")
+    assert second["job_id"] == job_id and second["owner"] != first["owner"]
+    assert jobs.run_job(first) == "lost"  # its checkpoint sees the new owner
+    assert jobs.run_job(second) == "finished"
+    job = jobs.get_job(job_id)
+    assert job["status"] == "finished" and job["done"] == len(patients)
+    assert db.count_patients(stale="anonymized") == 5  # resumed after the recorded checkpoint
+
+def test_concurrent_submits_queue_one_job(patients, monkeypatch):
+    now = jobs._now
+    monkeypatch.setattr(jobs, "_now", lambda: time.sleep(0.02) or now())  # widen the check-then-insert window
+    barrier = threading.Barrier(8)
+    ids = []
+
+    def submit():
+        barrier.wait()
+        ids.append(jobs.submit_job("anonymize"))
+
+    threads = [threading.Thread(target=submit) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(ids)) == 1 and len(jobs.list_jobs()) == 1
+
+def test_swept_cancel_stops_a_slow_runner(patients):
+    job_id = jobs.submit_job("anonymize", {"chunk_size": 5})
+    job = jobs.claim_next_job("slow")
+    _age(job_id, jobs.STALE_AFTER + 1)
+    jobs.cancel_job(job_id)
+    assert jobs.claim_next_job("other") is None  # the cancel request restarted the stale clock
+    assert jobs.get_job(job_id)["status"] == "cancel_requested"
+
+    _age(job_id, jobs.STALE_AFTER + 1)
+    jobs.claim_next_job("other")  # sweeps the unacknowledged cancel
+    assert jobs.get_job(job_id)["status"] == "cancelled"
+    assert jobs.run_job(job) == "cancelled"
+    job = jobs.get_job(job_id)
+    assert job["status"] == "cancelled" and job["done"] == 0
+    assert db.count_patients(stale="anonymized") == len(patients)
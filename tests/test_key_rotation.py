@@ -0,0 +1,70 @@
+# tests/test_key_rotation.py
+import os
+
+import pytest
+from cryptography.fernet import Fernet
+
+import db
+import jobs
+import key_rotation
+import utils
+
+@pytest.fixture
+def key_files(tmp_path, monkeypatch):
+    """Give the test its own fernet.key / fernet.key.previous."""
+    monkeypatch.setattr(utils, "KEY_FILE", str(tmp_path / "fernet.key"))
+    monkeypatch.setattr(utils, "PREVIOUS_KEYS_FILE", str(tmp_path / "fernet.key.previous"))
+    with open(utils.KEY_FILE, "wb") as f:
+        f.write(Fernet.generate_key())
+    utils.reload_keys()
+    yield
+    monkeypatch.undo()
+    utils.reload_keys()
+
+def _encrypt_all():
+    jobs.submit_job("encrypt", {"workers": 1})
+    assert jobs.run_job(jobs.claim_next_job("test")) == "finished"
+
+def _unreadable_with_primary():
+    primary = Fernet(utils.FERNET_KEY)
+    bad = 0
+    for p in db.fetch_patients():
+        for token in (p["encrypted_name"], p["encrypted_contact"]):
+            try:
+                primary.decrypt(token.encode())
+            except Exception:
+                bad += 1
+    return bad
+
+def test_interrupted_rotation_resumes(patients, key_files):
+    _encrypt_all()
+    old_key = utils.FERNET_KEY
+    key_rotation.start_rotation()
+    assert utils.FERNET_KEY != old_key and utils.PREVIOUS_KEYS == [old_key]
+
+    def crash(done):
+        raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        key_rotation.run_rotation(chunk_size=10, progress=crash)
+    rotation = key_rotation.active_rotation()
+    assert rotation["rotated"] == 10 and rotation["last_patient_id"] == patients[9]
+
+    result = key_rotation.run_rotation(chunk_size=10)
+    assert result["status"] == "finished" and result["rotated"] == len(patients)
+    assert not os.path.exists(utils.PREVIOUS_KEYS_FILE)
+    assert _unreadable_with_primary() == 0
+
+def test_rotation_waits_for_encrypt_jobs(patients, key_files):
+    job_id = jobs.submit_job("encrypt")
+    with pytest.raises(RuntimeError, match="Encrypt job"):
+        key_rotation.start_rotation()
+    jobs.cancel_job(job_id)
+    key_rotation.start_rotation()
+    assert key_rotation.run_rotation()["status"] == "finished"
+
+def test_resume_without_a_key_is_refused(patients, key_files):
+    key_rotation.start_rotation()
+    os.remove(utils.KEY_FILE)
+    with pytest.raises(ValueError, match="Fernet key not loaded"):
+        key_rotation.run_rotation()
+    assert key_rotation.active_rotation()["rotated"] == 0
@@ -0,0 +1,28 @@
+# tests/test_patient_view.py
+import db
+from patient_view import ROLE_COLUMNS, build_patient_rows
+
+def _page(role):
+    return db.fetch_patients_page(columns=ROLE_COLUMNS[role])[0]
+
+def test_rows_are_masked_per_role(temp_db):
+    receptionist = build_patient_rows(_page("receptionist"), "receptionist")
+    assert [r["name"] for r in receptionist] == ["John Doe", "Jane Smith"]
+
+    doctor = build_patient_rows(_page("doctor"), "doctor")
+    assert all(r["name"].startswith("ANON_") and "555" not in r["contact"] for r in doctor)
+
+    admin = build_patient_rows(_page("admin"), "admin", show_decrypted=True)
+    assert [r["name"] for r in admin] == ["John Doe", "Jane Smith"]  # plaintext rows, nothing encrypted yet
+    assert [r["anonymized_name"] for r in admin] == [r["name"] for r in doctor]
+
+def test_pseudonym_write_back_is_audited(temp_db):
+    doctor = {"user_id": 2, "username": "drbob", "role": "doctor"}
+    build_patient_rows(_page("doctor"), "doctor", user=doctor)
+    assert db.count_patients(stale="anonymized") == 0
+    rows, _ = db.fetch_logs_page(action="anonymize")
+    assert sorted(r["details"] for r in rows) == ["ID:1", "ID:2"]
+    assert {r["username"] for r in rows} == {"drbob"}
+
+    build_patient_rows(_page("doctor"), "doctor", user=doctor)  # nothing left to back-fill
+    assert db.count_logs(action="anonymize") == 2
@@ -0,0 +1,62 @@
+# tests/test_query_plans.py
+import sqlite3
+
+import pytest
+
+import db
+from utils import blind_search_filters
+
+def test_checked_queries_use_indexes(temp_db):
+    assert db.find_full_scans() == []
+
+# The reads behind each dashboard tab (data_cache wraps the same functions), with the filters the tabs offer.
+# allow_scan: ordered newest-N / first-page walks that stop at their LIMIT.
+DASHBOARD_READS = [
+    ("first patients page", lambda: db.fetch_patients_page(), True),
+    ("next patients page", lambda: db.fetch_patients_page(after_id=1), False),
+    ("patients by date", lambda: db.fetch_patients_page(added_from="2024-01-01", added_to="2024-02-01"), False),
+    ("patients stale", lambda: db.fetch_patients_page(stale="encrypted"), False),
+    ("patients pseudonym", lambda: db.fetch_patients_page(pseudonym="ANON_0"), False),
+    ("patients name search", lambda: db.fetch_patients_page(**blind_search_filters("jane smi")), False),
+    ("patients exact name", lambda: db.fetch_patients_page(**blind_search_filters("Jane Smith", exact=True)), False),
+    ("patients contact", lambda: db.fetch_patients_page(**blind_search_filters("0300-999-4592")), False),
+    ("count name search", lambda: db.count_patients(**blind_search_filters("jane")), False),
+    ("count stale", lambda: db.count_patients(stale="anonymized"), False),
+    ("count retention due", lambda: db.count_patients(added_to="2024-01-01", retained=False), False),
+    ("retention due", lambda: db.fetch_retention_due("2024-01-01", 100), False),
+    ("get patient", lambda: db.get_patient(1), False),
+    ("first logs page", lambda: db.fetch_logs_page(), True),
+    ("next logs page", lambda: db.fetch_logs_page(before=("2024-01-01", 10)), False),
+    ("logs by action", lambda: db.fetch_logs_page(action="login"), False),
+    ("logs by user", lambda: db.fetch_logs_page(username="admin"), False),
+    ("logs by role", lambda: db.fetch_logs_page(role="admin"), False),
+    ("logs by day", lambda: db.fetch_logs_page(start_day="2024-01-01", end_day="2024-01-31"), False),
+    ("count logs", lambda: db.count_logs(action="login", start_day="2024-01-01"), False),
+    ("count logs by role", lambda: db.count_logs(role="admin"), False),
+    ("log actions", lambda: db.fetch_log_actions(), True),
+    ("activity by day", lambda: db.fetch_activity_by_day("2024-01-01"), False),
+    ("activity by user", lambda: db.fetch_activity_by_user("2024-01-01"), False),
+    ("login", lambda: db.get_user_by_username("admin"), False),
+    ("profile", lambda: db.get_user_by_id(1), False),
+    ("consent", lambda: db.check_consent(1), False),
+]
+
+@pytest.mark.parametrize("name, read, allow_scan", DASHBOARD_READS, ids=[r[0] for r in DASHBOARD_READS])
+def test_dashboard_reads_use_indexes(temp_db, monkeypatch, name, read, allow_scan):
+    """Plan the SQL the read functions actually run, so new filters and queries are covered too."""
+    statements = []
+    monkeypatch.setattr(db, "PERF_TRACE", True)
+    monkeypatch.setattr(db, "is_recording", lambda: True)
+    monkeypatch.setattr(db, "count_statement", statements.append)
+    db.close_pools()  # connections pick up the trace callback when borrowed
+    read()
+    selects = [s for s in statements if s.lstrip().upper().startswith(("SELECT", "WITH"))]
+    assert selects, f"{name} ran no query"
+    conn = sqlite3.connect(temp_db)
+    try:
+        scans = {s: db.plan_full_scans(conn, s) for s in selects}
+    finally:
+        conn.close()
+    if allow_scan:
+        scans = {s: d for s, d in scans.items() if not (" LIMIT " in s.upper() or "DISTINCT" in s.upper())}
+    assert {s: d for s, d in scans.items() if d} == {}
@@ -0,0 +1,30 @@
+# tests/test_retention.py
+import db
+import retention
+from utils import blind_search_filters
+
+def test_old_records_are_redacted_once(temp_db):
+    old = db.add_patient("Olga Oldrecord", "0300-111-2222", "Flu", "2020-01-01T00:00:00")
+    new = db.add_patient("Nina Newrecord", "0300-333-4444", "Flu", "2099-01-01T00:00:00")
+    cutoff = "2021-01-01T00:00:00"
+    audit = (None, "system", "system", "retention_cleanup")
+
+    run = retention.run_retention(cutoff, batch_size=1, trigger="test", audit=audit)
+    assert run["status"] == "finished" and run["processed"] == 1
+    redacted = db.get_patient(old)
+    assert (redacted["name"], redacted["anonymized_name"]) == ("ARCHIVED", "REDACTED")
+    assert redacted["encrypted_name"] is None and redacted["retention_applied_at"]
+    assert db.get_patient(new)["name"] == "Nina Newrecord"
+    assert db.count_patients(**blind_search_filters("olga")) == 0  # search terms went with the name
+    assert db.count_logs(action="retention_cleanup") == 1
+
+    assert retention.run_retention(cutoff)["processed"] == 0
+    assert db.count_patients(stale="encrypted") == 3  # the live rows; redacted ones are never stale
+
+def test_scheduler_skips_ticks_with_nothing_due(temp_db):
+    cutoffs = []
+    scheduler = retention.RetentionScheduler(cutoffs.append)
+    assert not scheduler.tick() and cutoffs == []  # the seeded patients are recent
+
+    db.add_patient("Olga Oldrecord", "0300-111-2222", "Flu", "2000-01-01T00:00:00")
+    assert scheduler.tick() and len(cutoffs) == 1
@@ -0,0 +1,17 @@
+# tests/test_seed_data.py
+import db
+import seed_data
+
+def test_seed_builds_a_consistent_database(tmp_path, monkeypatch):
+    path = str(tmp_path / "seeded.db")
+    monkeypatch.setattr(db, "DB_PATH", path)
+    db.close_pools()
+    counts = seed_data.seed(path, patients=300, users=5, logs=400, years=1, seed_value=7)
+    try:
+        assert (counts["patients"], counts["users"], counts["logs"]) == (300, 5, 400)
+        assert db.count_patients() == 302  # plus the two demo patients
+        assert db.count_logs() == 400  # rollup totals match the raw table
+        assert sum(r["actions"] for r in db.fetch_activity_by_user()) == 400
+        assert db.find_full_scans() == []  # indexes were rebuilt after the bulk load
+    finally:
+        db.close_pools()
@@ -1,14 +1,54 @@
 # utils.py
 import hashlib
+import hmac
 import re
-from cryptography.fernet import Fernet
+import secrets
+import unicodedata
+import threading
+import time
+from collections import OrderedDict
+from cryptography.fernet import Fernet, MultiFernet
+from instrumentation import timed
 import os
 
+KEY_FILE = "fernet.key"
+# Keys retired by key_rotation.py; kept for decryption until every row is re-encrypted
+PREVIOUS_KEYS_FILE = "fernet.key.previous"
+KEY_RELOAD_INTERVAL = 5.0  # seconds between checks for key files changed by another process
+
+def _read_key_files():
+    primary, previous = None, []
+    if os.path.exists(KEY_FILE):
+        with open(KEY_FILE, "rb") as f:
+            primary = f.read().strip() or None
+    if os.path.exists(PREVIOUS_KEYS_FILE):
+        with open(PREVIOUS_KEYS_FILE, "rb") as f:
+            previous = [line.strip() for line in f if line.strip()]
+    return primary, previous
+
+def _key_files_stamp():
+    return tuple(os.stat(p).st_mtime_ns if os.path.exists(p) else None for p in (KEY_FILE, PREVIOUS_KEYS_FILE))
+
 # Try to load a Fernet key from file (optional; generate with create_key.py)
-FERNET_KEY = None
-if os.path.exists("fernet.key"):
-    with open("fernet.key", "rb") as f:
-        FERNET_KEY = f.read()
+FERNET_KEY, PREVIOUS_KEYS = _read_key_files()
+_keys_stamp = _key_files_stamp()
+_keys_checked = time.monotonic()
+
+def reload_keys():
+    """Re-read fernet.key and fernet.key.previous (called after a rotation step)."""
+    global FERNET_KEY, PREVIOUS_KEYS, _keys_stamp, _keys_checked
+    FERNET_KEY, PREVIOUS_KEYS = _read_key_files()
+    _keys_stamp = _key_files_stamp()
+    _keys_checked = time.monotonic()
+
+def current_keys() -> tuple:
+    """Primary key first, then retired keys still accepted for decryption."""
+    global _keys_checked
+    if time.monotonic() - _keys_checked > KEY_RELOAD_INTERVAL:
+        _keys_checked = time.monotonic()
+        if _key_files_stamp() != _keys_stamp:
+            reload_keys()
+    return tuple(k for k in [FERNET_KEY, *PREVIOUS_KEYS] if k)
 
 def generate_fernet_key():
     key = Fernet.generate_key()
@@ -16,27 +56,304 @@ def generate_fernet_key():
     FERNET_KEY = key
     return key
 
-def encrypt_value(value: str) -> str:
-    if not FERNET_KEY:
+# Fernet objects are reused: building one per value costs more than the encryption itself
+_CIPHERS = {}
+
+def get_cipher(key=None):
+    """Return a cached cipher for the given key material.
+
+    key may be one key or a sequence of keys (primary first); by default the
+    loaded keyring is used. Several keys give a MultiFernet that encrypts with
+    the primary and decrypts with any of them.
+    """
+    if not key:
+        keys = current_keys()
+    elif isinstance(key, (list, tuple)):
+        keys = tuple(key)
+    else:
+        keys = (key,)
+    keys = tuple(k.encode() if isinstance(k, str) else k for k in keys)
+    if not keys:
         raise ValueError("Fernet key not loaded")
-    f = Fernet(FERNET_KEY)
-    return f.encrypt(value.encode()).decode()
+    cipher = _CIPHERS.get(keys)
+    if cipher is None:
+        cipher = Fernet(keys[0]) if len(keys) == 1 else MultiFernet([Fernet(k) for k in keys])
+        _CIPHERS[keys] = cipher
+    return cipher
+
+@timed()
+def encrypt_value(value: str) -> str:
+    return get_cipher().encrypt(value.encode()).decode()
 
+@timed()
 def decrypt_value(value: str) -> str:
-    if not FERNET_KEY:
-        raise ValueError("Fernet key not loaded")
-    f = Fernet(FERNET_KEY)
-    return f.decrypt(value.encode()).decode()
+    return get_cipher().decrypt(value.encode()).decode()
+
+def _apply_many(func, values, skip_empty=False):
+    """Apply func to every item, collecting failures instead of raising.
+
+    Returns (results, errors). results matches the input: a pandas Series with
+    the same index if a Series was passed, otherwise a list. None/NaN items
+    (and "" when skip_empty) and failed items come back as None; errors maps
+    the item's index label (or position) to the error message.
+    """
+    index = getattr(values, "index", None)
+    labels = list(index) if index is not None and not callable(index) else None
+    items = values.tolist() if hasattr(values, "tolist") else list(values)
+    results, errors = [], {}
+    for pos, item in enumerate(items):
+        if item is None or item != item or (skip_empty and item == ""):  # item != item catches NaN
+            results.append(None)
+            continue
+        try:
+            results.append(func(item))
+        except Exception as e:
+            results.append(None)
+            errors[labels[pos] if labels else pos] = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+    if labels is not None:
+        import pandas as pd
+        return pd.Series(results, index=index, dtype=object, name=getattr(values, "name", None)), errors
+    return results, errors
+
+@timed()
+def encrypt_many(values, key=None):
+    """Encrypt a sequence or pandas Series of strings with one cipher. See _apply_many for the return value."""
+    cipher = get_cipher(key)
+    return _apply_many(lambda v: cipher.encrypt(v.encode()).decode(), values)
+
+@timed()
+def decrypt_many(values, key=None):
+    """Decrypt a sequence or pandas Series of tokens with one cipher. See _apply_many for the return value."""
+    cipher = get_cipher(key)
+    return _apply_many(lambda v: cipher.decrypt(v.encode()).decode(), values, skip_empty=True)
+
+_NON_DIGITS = re.compile(r"\D")
+PSEUDONYM_CACHE_SIZE = 50_000  # entries per cache (names, contacts)
+
+class LRUCache:
+    """Bounded, thread-safe memo table that evicts the least recently used entry."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get_or_compute(self, key, func):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+        value = func(key)
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": round(self.hits / lookups, 3) if lookups else None}
+
+def _mask(contact: str) -> str:
+    return "XXX-XXX-" + _NON_DIGITS.sub("", contact)[-4:]
+
+# Pseudonyms are ANON_ + a prefix of HMAC-SHA256(pseudonym key, name). Without the key they cannot
+# be recomputed from a list of likely names. The full digest is stored as name_digest, so
+# two names sharing a prefix are caught when written (db.store_pseudonyms).
+PSEUDONYM_KEY_FILE = os.environ.get("PSEUDONYM_KEY_FILE", "pseudonym.key")
+PSEUDONYM_LENGTH = min(max(int(os.environ.get("PSEUDONYM_LENGTH", "16")), 8), 64)  # hex chars (16 = 64 bits)
+
+_name_hmac = None
+_name_hmac_lock = threading.Lock()
+
+def _load_or_create_key(path) -> bytes:
+    """Read a secret key file, creating a random key (mode 600) on first use."""
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secrets.token_hex(32).encode())
+        try:
+            os.link(tmp, path)  # atomic create-if-absent: a concurrent creator's key wins, not both
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(path, "rb") as f:
+        key = f.read().strip()
+    if not key:
+        raise ValueError(f"{path} is empty")
+    return key
+
+def load_pseudonym_key(path=None) -> bytes:
+    """Read the pseudonymisation key, creating a random one on first use."""
+    return _load_or_create_key(path or PSEUDONYM_KEY_FILE)
+
+def _digest(name: str) -> str:
+    global _name_hmac
+    if _name_hmac is None:
+        with _name_hmac_lock:
+            if _name_hmac is None:
+                _name_hmac = hmac.new(load_pseudonym_key(), digestmod=hashlib.sha256)
+    h = _name_hmac.copy()
+    h.update(name.encode())
+    return h.hexdigest()
+
+def pseudonym_from_digest(digest: str) -> str:
+    return f"ANON_{digest[:PSEUDONYM_LENGTH]}" if digest else ""
+
+def _pseudonym(name: str) -> str:
+    return pseudonym_from_digest(_digest(name))
+
+_CONTACT_CACHE = LRUCache(PSEUDONYM_CACHE_SIZE)
+_NAME_CACHE = LRUCache(PSEUDONYM_CACHE_SIZE)  # name -> digest
+
 def mask_contact(contact: str) -> str:
     if not contact:
         return ""
-    digits = re.sub(r'\D', '', contact)
-    if len(digits) <= 4:
-        return "XXX-XXX-" + digits
-    return "XXX-XXX-" + digits[-4:]
+    return _CONTACT_CACHE.get_or_compute(contact, _mask)
 
-def anonymize_name(name: str) -> str:
+def name_digest(name: str) -> str:
     if not name:
         return ""
-    h = hashlib.sha256(name.encode()).hexdigest()
-    return f"ANON_{h[:8]}"
\ No newline at end of file
+    return _NAME_CACHE.get_or_compute(name, _digest)
+
+def anonymize_name(name: str) -> str:
+    return pseudonym_from_digest(name_digest(name))
+
+def pseudonym_cache_stats():
+    return {"names": _NAME_CACHE.stats(), "contacts": _CONTACT_CACHE.stats()}
+
+# The column versions below bypass the LRU caches: they already compute each
+# distinct value once per call, and a bulk pass would only evict the hot entries.
+
+def _map_unique(func, values):
+    """Apply func once per distinct non-empty value; returns a list, or a Series for a Series input."""
+    if hasattr(values, "map") and hasattr(values, "index"):
+        clean = values.where(values.notna(), "")
+        return clean.map({v: func(v) if v else "" for v in clean.unique()})
+    items = ["" if v is None or v != v else v for v in values]  # v != v catches NaN
+    table = {v: func(v) if v else "" for v in set(items)}
+    return [table[v] for v in items]
+
+@timed()
+def name_digests(values):
+    """name_digest over a list or pandas Series; each distinct name is hashed once."""
+    return _map_unique(_digest, values)
+
+@timed()
+def anonymize_names(values):
+    """anonymize_name over a list or pandas Series; each distinct name is hashed once."""
+    return _map_unique(_pseudonym, values)
+
+@timed()
+def mask_contacts(values):
+    """mask_contact over a list or pandas Series; Series use pandas .str operations."""
+    if hasattr(values, "str") and hasattr(values, "index"):
+        contacts = values.where(values.notna(), "").astype(str)
+        masked = "XXX-XXX-" + contacts.str.replace(_NON_DIGITS, "", regex=True).str[-4:]
+        return masked.where(contacts != "", "")
+    return [_mask(v) if v and v == v else "" for v in values]
+
+# Blind indexes: keyed 64-bit HMACs of normalised names, contacts and name-word prefixes,
+# stored next to the ciphertext (db.store_encrypted, db.write_blind_index_with) so that
+# searches are indexed equality lookups instead of decrypting every row. They use their own
+# key so that pseudonyms and search terms cannot be correlated.
+BLIND_INDEX_KEY_FILE = os.environ.get("BLIND_INDEX_KEY_FILE", "blind_index.key")
+BLIND_PREFIX_MIN = 3  # shortest indexed word prefix; shorter words are indexed whole only
+
+_NAME_SEPARATORS = re.compile(r"[\W_]+")
+_blind_hmac = None
+_blind_hmac_lock = threading.Lock()
+
+def load_blind_index_key(path=None) -> bytes:
+    """Read the blind-index key, creating a random one on first use."""
+    return _load_or_create_key(path or BLIND_INDEX_KEY_FILE)
+
+def _blind(kind: str, value: str) -> int:
+    """Keyed hash of value in the kind domain ("name", "contact", "term"), as a signed 64-bit integer."""
+    global _blind_hmac
+    if _blind_hmac is None:
+        with _blind_hmac_lock:
+            if _blind_hmac is None:
+                _blind_hmac = hmac.new(load_blind_index_key(), digestmod=hashlib.sha256)
+    h = _blind_hmac.copy()
+    h.update(f"{kind}\0{value}".encode())
+    return int.from_bytes(h.digest()[:8], "big", signed=True)
+
+def normalise_name(name: str) -> str:
+    """Case-folded words of name, separated by single spaces ("  O'Brien,  JANE" -> "o brien jane")."""
+    return " ".join(_NAME_SEPARATORS.sub(" ", unicodedata.normalize("NFKC", name or "").casefold()).split())
+
+def normalise_contact(contact: str) -> str:
+    """Digits of a phone number; e-mail addresses and digit-less values are case-folded instead."""
+    contact = unicodedata.normalize("NFKC", contact or "").strip()
+    digits = _NON_DIGITS.sub("", contact)
+    return digits if digits and "@" not in contact else contact.casefold()
+
+def _name_terms(normalised: str) -> list:
+    """Term hashes for every word of a normalised name and its prefixes of BLIND_PREFIX_MIN or more letters."""
+    terms = set()
+    for word in normalised.split():
+        terms.add(word)
+        terms.update(word[:k] for k in range(BLIND_PREFIX_MIN, len(word)))
+    return sorted(_blind("term", t) for t in terms)
+
+def _name_blind_index(name: str) -> tuple:
+    normalised = normalise_name(name)
+    if not normalised:
+        return None, []
+    return _blind("name", normalised), _name_terms(normalised)
+
+def _contact_blind_index(contact: str):
+    normalised = normalise_contact(contact)
+    return _blind("contact", normalised) if normalised else None
+
+def blind_index(name: str, contact: str) -> tuple:
+    """(name_bidx, contact_bidx, name_terms) for one patient; empty values give None / []."""
+    name_bidx, terms = _name_blind_index(name)
+    return name_bidx, _contact_blind_index(contact), terms
+
+@timed()
+def blind_indexes(names, contacts) -> list:
+    """blind_index over two columns; each distinct name and contact is hashed once."""
+    by_name, by_contact = {}, {}
+    out = []
+    for name, contact in zip(names, contacts):
+        name, contact = name or "", contact or ""
+        if name not in by_name:
+            by_name[name] = _name_blind_index(name)
+        if contact not in by_contact:
+            by_contact[contact] = _contact_blind_index(contact)
+        name_bidx, terms = by_name[name]
+        out.append((name_bidx, by_contact[contact], terms))
+    return out
+
+def blind_search_filters(query: str, exact=False) -> dict:
+    """db patient filters for a name or phone/e-mail search, as blind-index hashes.
+
+    Phone numbers and e-mail addresses match the whole stored contact. Names
+    match the whole normalised name when exact, otherwise every word of the
+    query must start a word of the name (at least BLIND_PREFIX_MIN letters, or
+    a whole word). Returns {} for an empty query.
+    """
+    query = (query or "").strip()
+    if not query:
+        return {}
+    if "@" in query or not any(ch.isalpha() for ch in query):
+        return {"contact_bidx": _contact_blind_index(query)} if normalise_contact(query) else {}
+    normalised = normalise_name(query)
+    if exact:
+        return {"name_bidx": _blind("name", normalised)}
+    return {"name_terms": sorted({_blind("term", word) for word in normalised.split()})}